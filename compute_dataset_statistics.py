@@ -1,5 +1,6 @@
 from lightning_modules.utils import create_lightning_module
 from lightning_data_modules.utils import create_lightning_datamodule
+from gaussian_prior import StreamingGaussianFit
 from tqdm import tqdm
 import os
 import torch 
@@ -33,6 +34,12 @@ def compute_dataset_statistics(config):
 
     LightningModule = create_lightning_module(config).to('cuda:0')
 
+    #low-rank plus diagonal Gaussian fit of the data, the prior of config.data.use_gaussian_prior. The fit (a float64
+    #SVD) is only done for configs that use the prior, or with an explicit config.data.gaussian_prior_rank > 0.
+    gaussian_prior_rank = config.data.get('gaussian_prior_rank', None)
+    if gaussian_prior_rank is None:
+      gaussian_prior_rank = 32 if config.data.get('use_gaussian_prior', False) else 0
+    gaussian_fit = StreamingGaussianFit(gaussian_prior_rank) if gaussian_prior_rank > 0 else None
 
     with torch.no_grad():
       total_sum = None
@@ -61,6 +68,9 @@ def compute_dataset_statistics(config):
             total_sum = batch_sum
           else:
             total_sum += batch_sum
+
+          if gaussian_fit is not None:
+            gaussian_fit.update(hf)
     
     #print('Max pairwise distance: %.4f' % max_distance)
 
@@ -81,6 +91,12 @@ def compute_dataset_statistics(config):
     plt.title('Mean values histogram')
     _ = plt.hist(mean, bins='auto')
     plt.savefig(os.path.join(mean_save_dir, 'mean_histogram.png'))
+
+    if gaussian_fit is not None:
+      gaussian = gaussian_fit.get_gaussian()
+      gaussian.save(os.path.join(mean_save_dir, 'gaussian_prior.pt'))
+      explained = gaussian.eigenvalues.sum() / (gaussian.eigenvalues.sum() + gaussian.diagonal.sum())
+      print('Gaussian prior: rank %d, %.2f%% of the variance explained by the components' % (gaussian.rank, 100 * explained))
   
   elif config.data.dataset == 'mri_to_pet':
     dataset_info_dir = os.path.join(config.data.base_dir, 'datasets_info', config.data.dataset)
@@ -42,6 +42,8 @@ def get_config():
   sampling.probability_flow = False
   sampling.snr = 0.15 #0.15 in VE sde (you typically need to play with this term - more details in the main paper)
   sampling.use_path = False #new. We use a specific path of the forward diffusion of the condition instead of getting new samples from the perturbation kernel p(y_t|y_0) each time.
+  sampling.dpm_solver_steps = 20 #used when sampling.method = 'dpm_solver' (multistep DPM-Solver++ on the probability flow ODE)
+  sampling.dpm_solver_order = 2
   
   # evaluation (this file is not modified at all - subject to change)
   config.eval = evaluate = ml_collections.ConfigDict()
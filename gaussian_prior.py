@@ -0,0 +1,132 @@
+"""Low-rank plus diagonal Gaussian fit of the data, used as the prior of the VE SDEs.
+
+The fit N(mean, U diag(eigenvalues) U^T + diag(diagonal)) keeps the top-k principal components U
+of the data and the per-dimension variance that they leave unexplained. It is computed in a single
+streaming pass over the dataset (see `StreamingGaussianFit` and `compute_dataset_statistics`).
+Diffused to a noise level sigma it stays Gaussian with covariance Sigma + sigma^2 I, so the
+sampler can draw from it at a time t_start < T and skip the high-noise part of the trajectory,
+where the score is close to the one of this Gaussian anyway.
+"""
+import numpy as np
+import torch
+
+
+class LowRankGaussian:
+  """Gaussian with a low-rank plus diagonal covariance on data of a fixed shape."""
+
+  def __init__(self, mean, components, eigenvalues, diagonal):
+    """Construct the Gaussian.
+    Args:
+      mean: The mean, with the shape of one data sample.
+      components: A (k, D) tensor with orthonormal rows, D the number of elements of a sample.
+      eigenvalues: The (k,) variances along the components.
+      diagonal: The (D,) residual variances.
+    """
+    self.mean = mean
+    self.components = components
+    self.eigenvalues = eigenvalues
+    self.diagonal = diagonal
+
+  @property
+  def rank(self):
+    return self.components.size(0)
+
+  def to(self, device):
+    self.mean = self.mean.to(device)
+    self.components = self.components.to(device)
+    self.eigenvalues = self.eigenvalues.to(device)
+    self.diagonal = self.diagonal.to(device)
+    return self
+
+  def sample(self, shape, std=0.):
+    """Samples of the Gaussian convolved with N(0, std^2 I)."""
+    self.to('cpu')
+    if tuple(shape[1:]) != tuple(self.mean.shape):
+      raise ValueError(f'The Gaussian prior was fitted on samples of shape {list(self.mean.shape)}, not {list(shape[1:])}.')
+    z_low_rank = torch.randn(shape[0], self.rank) * torch.sqrt(self.eigenvalues)
+    z_diagonal = torch.randn(shape[0], self.diagonal.numel()) * torch.sqrt(self.diagonal + std ** 2)
+    x = self.mean.reshape(1, -1) + z_low_rank @ self.components + z_diagonal
+    return x.reshape(shape)
+
+  def log_prob(self, z, std=0.):
+    """Log-density of the Gaussian convolved with N(0, std^2 I), using the Woodbury identity."""
+    self.to(z.device)
+    U, eigenvalues = self.components, self.eigenvalues
+    r = (z - self.mean.unsqueeze(0)).reshape(z.shape[0], -1)
+    diagonal = self.diagonal + std ** 2
+    # capacitance matrix diag(1/eigenvalues) + U diag(1/diagonal) U^T
+    capacitance = torch.diag(1. / eigenvalues) + (U / diagonal) @ U.t()
+    b = (r / diagonal) @ U.t()
+    quadratic = torch.sum(r ** 2 / diagonal, dim=1) - torch.sum(b * torch.linalg.solve(capacitance, b.t()).t(), dim=1)
+    logdet = torch.sum(torch.log(diagonal)) + torch.logdet(capacitance) + torch.sum(torch.log(eigenvalues))
+    return -0.5 * (r.shape[1] * np.log(2 * np.pi) + logdet + quadratic)
+
+  def state_dict(self):
+    return {'mean': self.mean, 'components': self.components,
+            'eigenvalues': self.eigenvalues, 'diagonal': self.diagonal}
+
+  def save(self, path):
+    torch.save(self.state_dict(), path)
+
+
+def load_gaussian_prior(path):
+  """Load a `LowRankGaussian` saved by `LowRankGaussian.save`. It is kept on the cpu like the data mean."""
+  return LowRankGaussian(**torch.load(path, map_location='cpu'))
+
+
+class StreamingGaussianFit:
+  """Streaming mean, per-dimension variance and top-k principal components (incremental PCA,
+  Ross et al., 2008) of batches of samples."""
+
+  def __init__(self, rank, min_variance=1e-6):
+    """Configure the fit.
+    Args:
+      rank: The number of principal components.
+      min_variance: Lower bound of the residual variances, which keeps the covariance invertible.
+    """
+    self.rank = rank
+    self.min_variance = min_variance
+    self.count = 0
+    self.shape = None
+    self.mean = None
+    self.m2 = None
+    self.components = None
+    self.singular_values = None
+
+  def update(self, batch):
+    """Add a batch of samples to the fit."""
+    if self.shape is None:
+      self.shape = batch.shape[1:]
+    x = batch.reshape(batch.size(0), -1).double()
+    m = x.size(0)
+    batch_mean = x.mean(dim=0)
+    batch_m2 = torch.sum((x - batch_mean) ** 2, dim=0)
+
+    if self.count == 0:
+      centred = x - batch_mean
+      self.mean, self.m2 = batch_mean, batch_m2
+    else:
+      n = self.count
+      delta = batch_mean - self.mean
+      # previous components, the new centred samples and the shift of the mean
+      centred = torch.cat([self.singular_values[:, None] * self.components,
+                           x - batch_mean,
+                           np.sqrt(n * m / (n + m)) * delta.unsqueeze(0)], dim=0)
+      self.mean = self.mean + delta * m / (n + m)
+      self.m2 = self.m2 + batch_m2 + delta ** 2 * n * m / (n + m)
+
+    _, S, Vt = torch.linalg.svd(centred, full_matrices=False)
+    self.components, self.singular_values = Vt[:self.rank], S[:self.rank]
+    self.count += m
+
+  def get_gaussian(self):
+    """The fitted `LowRankGaussian` in float32 on the cpu."""
+    if self.count < 2:
+      raise ValueError('The Gaussian fit needs at least two samples.')
+    variance = self.m2 / (self.count - 1)
+    eigenvalues = torch.clamp(self.singular_values ** 2 / (self.count - 1), min=self.min_variance)
+    diagonal = torch.clamp(variance - torch.sum(eigenvalues[:, None] * self.components ** 2, dim=0), min=self.min_variance)
+    return LowRankGaussian(mean=self.mean.reshape(self.shape).float().cpu(),
+                           components=self.components.float().cpu(),
+                           eigenvalues=eigenvalues.float().cpu(),
+                           diagonal=diagonal.float().cpu())
@@ -4,6 +4,7 @@ from pytorch_lightning.callbacks import Callback
 from torchvision.utils import make_grid
 import numpy as np
 from torch.nn import Upsample
+from sampling.evolution import get_evolution_recorder
 
 def normalise_per_image(x, value_range=None):
     for i in range(x.size(0)):
@@ -69,9 +70,11 @@ class HaarMultiScaleVisualizationCallback(Callback):
 
     def on_validation_epoch_end(self, trainer, pl_module):
         if self.show_evolution:
-            samples, sampling_info = pl_module.sample(show_evolution=True)
+            #strided/quantised frames (config.sampling.evolution_*) keep the host memory bounded
+            samples, sampling_info = pl_module.sample(show_evolution=get_evolution_recorder(pl_module.config))
             evolution = sampling_info['evolution']
-            self.visualise_evolution(evolution, pl_module)
+            if evolution is not None:
+                self.visualise_evolution(evolution, pl_module)
         else:
             samples, _ = pl_module.sample(show_evolution=False)
             normalised_samples = normalise_per_band(samples)
@@ -9,6 +9,10 @@ from pathlib import Path
 import os
 import matplotlib.pyplot as plt
 import pickle
+from sampling.evolution import get_evolution_recorder
+from sampling.checkpoint import get_checkpointer
+from sampling.rng import mix_seed
+from lightning_data_modules.DUALGLOWDataset import save_volume
 
 def normalise(c, value_range=None):
     x = c.clone()
@@ -60,9 +64,12 @@ class PairedVisualizationCallback(Callback):
 
             if self.show_evolution:
                 print('sde_y sigma_max: %.5f ' % pl_module.sde['y'].sigma_max)
-                conditional_samples, sampling_info = pl_module.sample(y.to(pl_module.device), show_evolution=True)
+                #strided/quantised frames (config.sampling.evolution_*) keep the host memory bounded
+                recorder = get_evolution_recorder(pl_module.config)
+                conditional_samples, sampling_info = pl_module.sample(y.to(pl_module.device), show_evolution=recorder)
                 evolution = sampling_info['evolution']
-                self.visualise_evolution(evolution, pl_module, tag='val_joint_evolution_batch_%d_epoch_%d' % (i, current_epoch))
+                if evolution is not None:
+                    self.visualise_evolution(evolution, pl_module, tag='val_joint_evolution_batch_%d_epoch_%d' % (i, current_epoch))
             else:
                 conditional_samples, _ = pl_module.sample(y.to(pl_module.device), show_evolution=False)
 
@@ -102,15 +109,19 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
         self.c_steps = eval_config.c_steps
         self.denoise = eval_config.denoise
         self.use_path = eval_config.use_path
+        self.schedule = eval_config.get('schedule', 'default')
+        #start the reverse process at warm_start_t0 from the diffused initial estimate (bicubic upsample / masked input) of x.
+        self.warm_start_t0 = eval_config.get('warm_start_t0', 'default')
+        #'default' reads the corrector schedule of config.eval (or config.sampling). It can be replaced by a function (i, t) -> int.
+        self.corrector_schedule = 'default'
         
         #settings for determining the sampling process and saving the samples
         self.save_samples = eval_config.save_samples
+        self.base_dir = eval_config.base_log_dir
+        self.dataset = data_config.dataset
+        self.task = data_config.task
+        self.approach = approach
         if self.save_samples:
-            self.base_dir = eval_config.base_log_dir
-            self.dataset = data_config.dataset
-            self.task = data_config.task
-            self.approach = approach
-
             self.samples_dir = os.path.join(self.base_dir, self.task, self.dataset, self.approach, 'images', 'samples')
             self.gt_x_dir = os.path.join(self.base_dir, self.task, self.dataset, self.approach, 'images', 'x_gt')
             self.gt_y_dir = os.path.join(self.base_dir, self.task, self.dataset, self.approach, 'images','y_gt')
@@ -120,6 +131,18 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
             Path(self.gt_y_dir).mkdir(parents=True, exist_ok=True)
         
         self.draws = eval_config.draws
+        #fold the draws into the batch dimension: one sampler pass for all the draws, split into micro-batches of at most max_sampling_batch_size samples.
+        self.batch_draws = eval_config.get('batch_draws', False)
+        self.max_sampling_batch_size = eval_config.get('max_sampling_batch_size', None)
+        #sample all the snr values of eval.snr in the same sampler pass (per-sample snr of the Langevin correctors).
+        self.batch_snrs = eval_config.get('batch_snrs', False)
+        #snapshot the sampling trajectories every sampling_checkpoint_every steps, so that a pre-empted job resumes them.
+        self.checkpoint_every = eval_config.get('sampling_checkpoint_every', None)
+        self.checkpoint_dir = os.path.join(self.base_dir, self.task, self.dataset, self.approach, 'sampling_checkpoints')
+        #per-sample noise streams seeded by (sampling_seed, image index, snr, draw): the samples do not depend on the batching.
+        #every step then reseeds and draws once per sample (a Python loop over the batch, see sampling.rng).
+        self.sampling_seed = eval_config.get('sampling_seed', None)
+        self.current_batch_idx = 0
         self.evaluation_metrics = eval_config.evaluation_metrics
         
         if not isinstance(eval_config.snr, list):
@@ -155,7 +178,81 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
     def on_test_start(self, trainer, pl_module):
         pl_module.loss_fn_alex = lpips.LPIPS(net='alex').to(pl_module.device)
 
-    def generate_metric_vals(self, y, x, pl_module, snr):
+    def get_seeds(self, indices, snrs, draws):
+        #the seed of every sample from the index of its image (0 for 1.png), its snr and its draw
+        if self.sampling_seed is None:
+            return None
+        return [mix_seed(self.sampling_seed, index, int(round(snr * 1e6)), draw) for index, snr, draw in zip(indices, snrs, draws)]
+
+    def sample(self, y, pl_module, snr, name, seeds=None):
+        #name identifies the sampler call within the test batch for its checkpoint
+        checkpoint = get_checkpointer(self.checkpoint_dir, 'batch_%d_%s' % (self.current_batch_idx, name), self.checkpoint_every)
+        samples, _ = pl_module.sample(y, show_evolution=False, 
+                                      predictor=self.predictor, corrector=self.corrector, 
+                                      p_steps=self.p_steps, c_steps=self.c_steps, snr=snr, 
+                                      denoise=self.denoise, use_path=self.use_path,
+                                      schedule=self.schedule, corrector_schedule=self.corrector_schedule,
+                                      warm_start_t0=self.warm_start_t0, checkpoint=checkpoint, seeds=seeds)
+        return samples
+
+    def sample_tiled(self, y, pl_module, snrs, draws, name):
+        #samples of the draws for every snr in one (micro-batched) sampler pass, in a tensor of shape (snrs, draws, batch, ...)
+        #sample i of the tiled batch is conditioned on y[i % batch_size] with snrs[i // (num_draws * batch_size)]. Every micro-batch builds only its own conditions.
+        batch_size, num_draws = y.size(0), len(draws)
+        total = len(snrs) * num_draws * batch_size
+        snr_per_sample = torch.tensor(snrs, device=y.device).repeat_interleave(num_draws * batch_size)
+        seeds = self.get_seeds([self.images_tested + i % batch_size for i in range(total)],
+                               [snrs[i // (num_draws * batch_size)] for i in range(total)],
+                               [draws[(i // batch_size) % num_draws] for i in range(total)])
+        samples = []
+        for start, end in self.get_micro_batches(total, num_draws * batch_size):
+            #the Langevin correctors accept the snr of every sample
+            group = start // (num_draws * batch_size)
+            snr = snrs[group] if end <= (group + 1) * num_draws * batch_size else snr_per_sample[start:end]
+            samples.append(self.sample(self.get_tiled_conditions(y, start, end), pl_module, snr, '%s_start_%d' % (name, start),
+                                       seeds[start:end] if seeds is not None else None))
+        return torch.cat(samples).view(len(snrs), num_draws, batch_size, *samples[0].shape[1:])
+
+    def get_tiled_conditions(self, y, start, end):
+        #the conditions of the samples start..end-1 of the tiled batch: a view of y within a draw, y repeated for whole draws
+        #and a gather only for the micro-batches that cut a draw and span more than one.
+        batch_size = y.size(0)
+        if start // batch_size == (end - 1) // batch_size:
+            return y[start % batch_size:(end - 1) % batch_size + 1]
+        if start % batch_size == 0 and end % batch_size == 0:
+            return y.unsqueeze(0).expand((end - start) // batch_size, *y.shape).reshape(-1, *y.shape[1:])
+        return y.index_select(0, torch.arange(start, end, device=y.device) % batch_size)
+
+    def get_micro_batches(self, total, group_size):
+        #(start, end) of the micro-batches of at most max_sampling_batch_size samples of a tiled batch. A micro-batch holds whole
+        #snr groups of group_size samples or a part of one group, so that the batch statistics of the correctors never mix snr values.
+        #with sampling_seed the samples do not depend on the micro-batches, without it they depend on how a group is split.
+        micro_batch_size = self.max_sampling_batch_size if self.max_sampling_batch_size else total
+        if micro_batch_size >= group_size:
+            micro_batch_size -= micro_batch_size % group_size
+            return [(start, min(start + micro_batch_size, total)) for start in range(0, total, micro_batch_size)]
+        return [(start, min(start + micro_batch_size, group_start + group_size))
+                for group_start in range(0, total, group_size)
+                for start in range(group_start, group_start + group_size, micro_batch_size)]
+
+    def sample_draws(self, y, pl_module, snr):
+        #returns the samples of all the draws stacked in a tensor of shape (draws, batch, ...)
+        if not self.batch_draws:
+            indices = [self.images_tested + i for i in range(y.size(0))]
+            return torch.stack([self.sample(y, pl_module, snr, 'snr_%.3f_draw_%d' % (snr, draw),
+                                            self.get_seeds(indices, [snr] * len(indices), [draw] * len(indices)))
+                                for draw in self.draws])
+        return self.sample_tiled(y, pl_module, [snr], self.draws, 'snr_%.3f_draws' % snr)[0]
+
+    def sample_snr_sweep(self, y, pl_module):
+        #samples of all the draws for all the snr values, keyed by snr
+        if self.batch_draws:
+            samples = self.sample_tiled(y, pl_module, self.snr, self.draws, 'snr_sweep_draws')
+        else:
+            samples = torch.stack([self.sample_tiled(y, pl_module, self.snr, [draw], 'snr_sweep_draw_%d' % draw)[:, 0] for draw in self.draws], dim=1)
+        return {e_snr: samples[k] for k, e_snr in enumerate(self.snr)}
+
+    def generate_metric_vals(self, y, x, pl_module, snr, draw_samples=None):
         metric_vals = {}
         for eval_metric in self.evaluation_metrics:
             if eval_metric == 'diversity' and len(self.draws) == 1:
@@ -163,16 +260,14 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
             
             metric_vals[eval_metric]=[]
 
-        for draw in self.draws:
-            #sample x conditioned on y
-            samples, _ = pl_module.sample(y, show_evolution=False, 
-                                          predictor=self.predictor, corrector=self.corrector, 
-                                          p_steps=self.p_steps, c_steps=self.c_steps, snr=snr, 
-                                          denoise=self.denoise, use_path=self.use_path) 
+        #sample x conditioned on y, unless the samples of the draws come from an snr sweep
+        if draw_samples is None:
+            draw_samples = self.sample_draws(y, pl_module, snr)
                     
-            #some reverse diffused values might be slightly off - correct them. Bear in mind we podel p_epsilon not p_0...
-            samples = torch.clamp(samples, min=0, max=1)
+        #some reverse diffused values might be slightly off - correct them. Bear in mind we podel p_epsilon not p_0...
+        draw_samples = torch.clamp(draw_samples, min=0, max=1)
 
+        for draw, samples in zip(self.draws, draw_samples):
             #save the generated samples if self.save_samples is True
             if self.save_samples:
                 samples_save_dir = os.path.join(self.samples_dir, 'snr_%.3f' % snr, 'draw_%d' % (draw))
@@ -190,7 +285,7 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
             numpy_gt = torch.swapaxes(x.clone().cpu(), axis0=1, axis1=-1).numpy()*255
 
             if 'psnr' in self.evaluation_metrics:
-                metric_vals['psnr'] = eval_tools.calculate_mean_psnr(numpy_samples, numpy_gt)
+                metric_vals['psnr'].append(eval_tools.calculate_mean_psnr(numpy_samples, numpy_gt))
                     
             if 'ssim' in self.evaluation_metrics:
                 metric_vals['ssim'].append(eval_tools.calculate_mean_ssim(numpy_samples, numpy_gt))
@@ -202,10 +297,9 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
                 print(lr_gt.shape)
                 metric_vals['consistency'].append(eval_tools.calculate_mean_psnr(lr_synthetic, lr_gt))
                     
-            if 'diversity' in self.evaluation_metrics:
-                if len(self.draws) > 1:
-                    samples = samples * 255.
-                    metric_vals['diversity'].append(samples.to('cpu'))
+        if 'diversity' in self.evaluation_metrics and len(self.draws) > 1:
+            #std over the draws of every pixel
+            metric_vals['diversity'].append(torch.mean(torch.std(draw_samples * 255., dim=0)).item())
         
         return metric_vals
 
@@ -213,23 +307,21 @@ class TestPairedVisualizationCallback(PairedVisualizationCallback):
         if batch_idx >= self.first_test_batch and batch_idx < self.last_test_batch:
             print('batch_idx: ', batch_idx)
             y, x = batch
+            self.current_batch_idx = batch_idx
 
             if self.save_samples:
                 for i in range(x.size(0)):
                     save_image(x[i, :, :, :], fp = os.path.join(self.gt_x_dir, '%d.png' % (self.images_tested+i+1)))
                     save_image(y[i, :, :, :], fp = os.path.join(self.gt_y_dir, '%d.png' % (self.images_tested+i+1)))
 
+            sweep_samples = self.sample_snr_sweep(y, pl_module) if self.batch_snrs else {}
             for e_snr in self.snr:
-                metric_vals = self.generate_metric_vals(y, x, pl_module, e_snr)
+                metric_vals = self.generate_metric_vals(y, x, pl_module, e_snr, sweep_samples.get(e_snr))
                     
                 for eval_metric in self.evaluation_metrics:
-                    if eval_metric == 'diversity':
-                        if len(self.draws) > 1:
-                            self.results[e_snr][eval_metric].append(torch.mean(torch.std(torch.stack(metric_vals['diversity']), dim=0)).item())
-                        else:
-                            continue
-                    else:
-                        self.results[e_snr][eval_metric].append(np.mean(metric_vals[eval_metric]))
+                    if eval_metric == 'diversity' and len(self.draws) == 1:
+                        continue
+                    self.results[e_snr][eval_metric].append(np.mean(metric_vals[eval_metric]))
             
             self.images_tested += x.size(0)
     
@@ -348,4 +440,72 @@ class PairedVisualizationCallback(Callback):
         pl_module.logger.experiment.add_scalar('val_rec_loss_batch_%d_p' % batch_idx, val_rec_loss, pl_module.current_epoch)
         self.visualise3D(y, cond_samples, x, pl_module, batch_idx, sampling_scheme='p')
 
-        
\ No newline at end of file
+
+@utils.register_callback(name='test_paired3D')
+class TestPaired3DCallback(Callback):
+    def __init__(self, show_evolution, eval_config, data_config, approach):
+        super().__init__()
+        #settings related to the conditional sampling function. 'default' reads config.sampling.
+        #full volumes are sampled with the sliding window of config.sampling.tile_size / tile_stride.
+        self.predictor = eval_config.get('predictor', 'default')
+        self.corrector = eval_config.get('corrector', 'default')
+        self.p_steps = eval_config.get('p_steps', 'default')
+        self.c_steps = eval_config.get('c_steps', 'default')
+        self.denoise = eval_config.get('denoise', 'default')
+        #every snr of eval.snr is tested, with every draw of eval.draws
+        snr = eval_config.get('snr', 'default')
+        self.snr = snr if isinstance(snr, list) else [snr]
+        self.draws = eval_config.get('draws', [1])
+        #per-sample noise streams seeded by (sampling_seed, volume index, snr, draw): the samples do not depend on the batching.
+        #every step then reseeds and draws once per sample (a Python loop over the batch, see sampling.rng).
+        self.sampling_seed = eval_config.get('sampling_seed', None)
+
+        #every sampled volume is written as soon as its batch is done, in the layout of the DUAL-GLOW dataset (ID/quantity.npy).
+        #with several snr values or draws, every (snr, draw) pair has its own dataset in volumes/snr_<snr>/draw_<draw>.
+        self.base_dir = eval_config.base_log_dir
+        self.volumes_dir = os.path.join(self.base_dir, data_config.dataset, approach, 'volumes')
+        self.checkpoint_every = eval_config.get('sampling_checkpoint_every', None)
+        self.checkpoint_dir = os.path.join(self.base_dir, data_config.dataset, approach, 'sampling_checkpoints')
+        self.volumes_tested = 0
+        self.errors = {}
+
+    def on_test_start(self, trainer, pl_module):
+        self.snr = [pl_module.config.sampling.snr if snr == 'default' else snr for snr in self.snr]
+        self.errors = {(snr, draw): [] for snr in self.snr for draw in self.draws}
+
+    def get_volumes_dir(self, snr, draw):
+        if len(self.snr) == 1 and len(self.draws) == 1:
+            return self.volumes_dir
+        return os.path.join(self.volumes_dir, 'snr_%.3f' % snr, 'draw_%d' % draw)
+
+    def get_seeds(self, batch_size, snr, draw):
+        if self.sampling_seed is None:
+            return None
+        return [mix_seed(self.sampling_seed, self.volumes_tested + i, int(round(snr * 1e6)), draw) for i in range(batch_size)]
+
+    def on_test_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx):
+        y, x = batch
+        #the IDs of the DUAL-GLOW test set, the index of the volume otherwise
+        IDs = getattr(getattr(trainer.datamodule, 'test_dataset', None), 'IDs', None)
+        for snr in self.snr:
+            for draw in self.draws:
+                checkpoint = get_checkpointer(self.checkpoint_dir, 'batch_%d_snr_%.3f_draw_%d' % (batch_idx, snr, draw), self.checkpoint_every)
+                samples, _ = pl_module.sample(y, show_evolution=False,
+                                              predictor=self.predictor, corrector=self.corrector,
+                                              p_steps=self.p_steps, c_steps=self.c_steps, snr=snr,
+                                              denoise=self.denoise, checkpoint=checkpoint,
+                                              seeds=self.get_seeds(y.size(0), snr, draw))
+
+                for i in range(samples.size(0)):
+                    index = self.volumes_tested + i
+                    ID = IDs[index] if IDs is not None else 'volume_%d' % index
+                    save_volume(self.get_volumes_dir(snr, draw), ID, {'img_mri': y[i, 0].cpu().numpy(),
+                                                                      'img_pet': samples[i, 0].cpu().numpy()})
+
+                self.errors[(snr, draw)].append(torch.mean(torch.abs(x.to(samples.device)-samples)).item())
+        self.volumes_tested += y.size(0)
+
+    def on_test_epoch_end(self, trainer, pl_module):
+        for (snr, draw), errors in self.errors.items():
+            print('snr %.3f, draw %d: %d volumes saved in %s - mean absolute error: %.5f'
+                  % (snr, draw, self.volumes_tested, self.get_volumes_dir(snr, draw), np.mean(errors)))
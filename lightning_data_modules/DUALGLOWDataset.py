@@ -31,6 +31,16 @@ def load_data(path):
     
     return data
 
+def load_IDs(path):
+    #the IDs in the order of the indices of load_data
+    return listdir_nothidden_filenames(path)
+
+def save_volume(path, ID, volumes):
+    #inverse of load_data for one ID: writes path/ID/quantity.npy for every quantity of volumes
+    Path(os.path.join(path, ID)).mkdir(parents=True, exist_ok=True)
+    for quantity, volume in volumes.items():
+        np.save(os.path.join(path, ID, '%s.npy' % quantity), volume)
+
 
 class DUALGLOW_Dataset(Dataset):
     """A template dataset class for you to implement custom datasets."""
@@ -38,6 +48,7 @@ class DUALGLOW_Dataset(Dataset):
         # get the image paths of your dataset;
         self.phase = phase
         self.data = load_data(os.path.join(config.data.base_dir, config.data.dataset, phase))
+        self.IDs = load_IDs(os.path.join(config.data.base_dir, config.data.dataset, phase))
         self.use_data_augmentation = config.data.use_data_augmentation
 
     def __getitem__(self, index):
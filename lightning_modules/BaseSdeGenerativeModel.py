@@ -34,7 +34,9 @@ class BaseSdeGenerativeModel(pl.LightningModule):
                 data_mean = torch.load(data_mean_path)
             else:
                 data_mean = None
-            self.sde = sde_lib.VESDE(sigma_min=config.model.sigma_min, sigma_max=config.model.sigma_max, N=config.model.num_scales, data_mean=data_mean)
+            gaussian_prior, t_start = utils.get_gaussian_prior(config)
+            self.sde = sde_lib.VESDE(sigma_min=config.model.sigma_min, sigma_max=config.model.sigma_max, N=config.model.num_scales, data_mean=data_mean,
+                                     gaussian_prior=gaussian_prior, t_start=t_start)
             self.sampling_eps = 1e-5
         else:
             raise NotImplementedError(f"SDE {config.training.sde} unknown.")
@@ -29,7 +29,9 @@ class ConditionalSdeGenerativeModel(BaseSdeGenerativeModel.BaseSdeGenerativeMode
             else:
                 data_mean = None
 
-            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean)
+            gaussian_prior, t_start = utils.get_gaussian_prior(config)
+            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean,
+                                   gaussian_prior=gaussian_prior, t_start=t_start)
             self.sampling_eps = 1e-5
 
             if config.training.conditioning_approach == 'sr3':
@@ -74,15 +76,20 @@ class ConditionalSdeGenerativeModel(BaseSdeGenerativeModel.BaseSdeGenerativeMode
         #samples, _ = self.sample(y) 
         
         
-    def sample(self, y, show_evolution=False, predictor='default', corrector='default', p_steps='default', c_steps='default', snr='default', denoise='default', use_path='default'):
+    def sample(self, y, show_evolution=False, predictor='default', corrector='default', p_steps='default', c_steps='default', snr='default', denoise='default', use_path='default', schedule='default', corrector_schedule='default', warm_start_t0='default', checkpoint=None, seeds=None, precision='default'):
         sampling_shape = [y.size(0)]+self.config.data.shape_x
+        if self.config.sampling.get('tile_size', None) is not None:
+            #tiled sampling runs on inputs larger than the training shape: x has the spatial size of y
+            sampling_shape = [y.size(0), self.config.data.shape_x[0]]+list(y.shape[2:])
         conditional_sampling_fn = get_conditional_sampling_fn(config=self.config, sde=self.sde, 
                                                               shape=sampling_shape, eps=self.sampling_eps, 
                                                               predictor=predictor, corrector=corrector, 
                                                               p_steps=p_steps, c_steps=c_steps, snr=snr, 
-                                                              denoise=denoise, use_path=use_path)
+                                                              denoise=denoise, use_path=use_path, schedule=schedule,
+                                                              corrector_schedule=corrector_schedule, warm_start_t0=warm_start_t0,
+                                                              precision=precision)
 
-        return conditional_sampling_fn(self.score_model, y, show_evolution)
+        return conditional_sampling_fn(self.score_model, y, show_evolution, checkpoint=checkpoint, seeds=seeds)
 
 @utils.register_lightning_module(name='deprecated_conditional_decreasing_variance')
 class DecreasingVarianceConditionalSdeGenerativeModel(ConditionalSdeGenerativeModel):
@@ -111,7 +118,9 @@ class DecreasingVarianceConditionalSdeGenerativeModel(ConditionalSdeGenerativeMo
                 data_mean = torch.load(data_mean_path)
             else:
                 data_mean = None
-            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean)
+            gaussian_prior, t_start = utils.get_gaussian_prior(config)
+            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean,
+                                   gaussian_prior=gaussian_prior, t_start=t_start)
             
             self.sde = {'x':sde_x, 'y':sde_y}
             self.sampling_eps = 1e-5
@@ -169,7 +178,9 @@ class DecreasingVarianceConditionalSdeGenerativeModel(ConditionalSdeGenerativeMo
             else:
                 data_mean = None
                 
-            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean)
+            gaussian_prior, t_start = utils.get_gaussian_prior(config)
+            sde_x = sde_lib.cVESDE(sigma_min=config.model.sigma_min_x, sigma_max=config.model.sigma_max_x, N=config.model.num_scales, data_mean=data_mean,
+                                   gaussian_prior=gaussian_prior, t_start=t_start)
             
             self.sde = {'x':sde_x, 'y':sde_y}
             self.sampling_eps = 1e-5
@@ -1,3 +1,6 @@
+import os
+import gaussian_prior
+
 _LIGHTNING_MODULES = {}
 def register_lightning_module(cls=None, *, name=None):
   """A decorator for registering model classes."""
@@ -25,4 +28,12 @@ def create_lightning_module(config, checkpoint_path=None):
   lightning_module = get_lightning_module_by_name(config.training.lightning_module)(config)
   if checkpoint_path:
     lightning_module = lightning_module.load_from_checkpoint(checkpoint_path)
-  return lightning_module
\ No newline at end of file
+  return lightning_module
+
+def get_gaussian_prior(config):
+  """The Gaussian prior fitted by `compute_dataset_statistics` and its start time
+  `config.sampling.prior_t_start` (default T), or (None, None) without `config.data.use_gaussian_prior`."""
+  if not config.data.get('use_gaussian_prior', False):
+    return None, None
+  path = os.path.join(config.data.base_dir, 'datasets_mean', '%s_%d' % (config.data.dataset, config.data.image_size), 'gaussian_prior.pt')
+  return gaussian_prior.load_gaussian_prior(path), config.sampling.get('prior_t_start', None)
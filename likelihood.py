@@ -21,6 +21,7 @@ import torch
 import numpy as np
 from scipy import integrate
 from models import utils as mutils
+from sampling import ode_solvers
 
 
 def get_div_fn(fn):
@@ -38,7 +39,7 @@ def get_div_fn(fn):
 
 
 def get_likelihood_fn(sde, inverse_scaler, hutchinson_type='Rademacher',
-                      rtol=1e-5, atol=1e-5, method='RK45', eps=1e-5):
+                      rtol=1e-5, atol=1e-5, method='RK45', eps=1e-5, solver='torch', step_control='batch'):
   """Create a function to compute the unbiased log-likelihood estimate of a given data point.
 
   Args:
@@ -50,6 +51,9 @@ def get_likelihood_fn(sde, inverse_scaler, hutchinson_type='Rademacher',
     method: A `str`. The algorithm for the black-box ODE solver.
       See documentation for `scipy.integrate.solve_ivp`.
     eps: A `float` number. The probability flow ODE is integrated to `eps` for numerical stability.
+    solver: 'torch' integrates on the device with `sampling.ode_solvers`. 'scipy' uses `scipy.integrate.solve_ivp`.
+    step_control: 'batch' treats the whole batch as one ODE system. 'per_sample' gives every sample
+      its own step size and error norm (torch solver only) and reports the NFE per sample.
 
   Returns:
     A function that a batch of data points and returns the log-likelihoods in bits/dim,
@@ -78,6 +82,7 @@ def get_likelihood_fn(sde, inverse_scaler, hutchinson_type='Rademacher',
       z: A PyTorch tensor of the same shape as `data`. The latent representation of `data` under the
         probability flow ODE.
       nfe: An integer. The number of function evaluations used for running the black-box ODE solver.
+        A tensor of shape [batch size] when `step_control` is 'per_sample'.
     """
     with torch.no_grad():
       shape = data.shape
@@ -88,19 +93,48 @@ def get_likelihood_fn(sde, inverse_scaler, hutchinson_type='Rademacher',
       else:
         raise NotImplementedError(f"Hutchinson type {hutchinson_type} unknown.")
 
-      def ode_func(t, x):
-        sample = mutils.from_flattened_numpy(x[:-shape[0]], shape).to(data.device).type(torch.float32)
-        vec_t = torch.ones(sample.shape[0], device=sample.device) * t
-        drift = mutils.to_flattened_numpy(drift_fn(model, sample, vec_t))
-        logp_grad = mutils.to_flattened_numpy(div_fn(model, sample, vec_t, epsilon))
-        return np.concatenate([drift, logp_grad], axis=0)
-
-      init = np.concatenate([mutils.to_flattened_numpy(data), np.zeros((shape[0],))], axis=0)
-      solution = integrate.solve_ivp(ode_func, (eps, sde.T), init, rtol=rtol, atol=atol, method=method)
-      nfe = solution.nfev
-      zp = solution.y[:, -1]
-      z = mutils.from_flattened_numpy(zp[:-shape[0]], shape).to(data.device).type(torch.float32)
-      delta_logp = mutils.from_flattened_numpy(zp[-shape[0]:], (shape[0],)).to(data.device).type(torch.float32)
+      if solver == 'torch' and step_control == 'per_sample':
+        # Each row holds the flattened sample followed by its log-density change.
+        def ode_func(vec_t, x, index):
+          sample = x[:, :-1].reshape((x.shape[0],) + tuple(shape[1:]))
+          drift = drift_fn(model, sample, vec_t).reshape(x.shape[0], -1)
+          logp_grad = div_fn(model, sample, vec_t, epsilon[index])
+          return torch.cat([drift, logp_grad[:, None]], dim=1)
+
+        init = torch.cat([data.reshape(shape[0], -1), torch.zeros(shape[0], 1).type_as(data)], dim=1).type(torch.float32)
+        solution = ode_solvers.solve_ivp_per_sample(ode_func, (eps, sde.t_start), init, rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        z = solution.y[:, :-1].reshape(shape)
+        delta_logp = solution.y[:, -1]
+      elif solver == 'torch':
+        def ode_func(t, x):
+          sample = x[:-shape[0]].reshape(shape)
+          vec_t = torch.ones(sample.shape[0], device=sample.device) * t
+          drift = drift_fn(model, sample, vec_t).reshape((-1,))
+          logp_grad = div_fn(model, sample, vec_t, epsilon)
+          return torch.cat([drift, logp_grad], dim=0)
+
+        init = torch.cat([data.reshape((-1,)), torch.zeros(shape[0]).type_as(data)], dim=0).type(torch.float32)
+        solution = ode_solvers.solve_ivp(ode_func, (eps, sde.t_start), init, rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        z = solution.y[:-shape[0]].reshape(shape)
+        delta_logp = solution.y[-shape[0]:]
+      elif solver == 'scipy':
+        def ode_func(t, x):
+          sample = mutils.from_flattened_numpy(x[:-shape[0]], shape).to(data.device).type(torch.float32)
+          vec_t = torch.ones(sample.shape[0], device=sample.device) * t
+          drift = mutils.to_flattened_numpy(drift_fn(model, sample, vec_t))
+          logp_grad = mutils.to_flattened_numpy(div_fn(model, sample, vec_t, epsilon))
+          return np.concatenate([drift, logp_grad], axis=0)
+
+        init = np.concatenate([mutils.to_flattened_numpy(data), np.zeros((shape[0],))], axis=0)
+        solution = integrate.solve_ivp(ode_func, (eps, sde.t_start), init, rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        zp = solution.y[:, -1]
+        z = mutils.from_flattened_numpy(zp[:-shape[0]], shape).to(data.device).type(torch.float32)
+        delta_logp = mutils.from_flattened_numpy(zp[-shape[0]:], (shape[0],)).to(data.device).type(torch.float32)
+      else:
+        raise NotImplementedError(f"ODE solver {solver} unknown.")
       prior_logp = sde.prior_logp(z)
       bpd = -(prior_logp + delta_logp) / np.log(2)
       N = np.prod(shape[1:])
@@ -10,7 +10,9 @@ config_flags.DEFINE_config_file(
 flags.DEFINE_string("checkpoint_path", None, "Checkpoint directory.")
 flags.DEFINE_string("data_path", None, "Checkpoint directory.")
 flags.DEFINE_string("log_path", "./", "Checkpoint directory.")
-flags.DEFINE_enum("mode", "train", ["train", "test", "multi_scale_test", "compute_dataset_statistics", 'evaluation_pipeline'], "Running mode: train or test")
+flags.DEFINE_enum("mode", "train", ["train", "test", "multi_scale_test", "compute_dataset_statistics", 'evaluation_pipeline', 'tune_sampler', 'sharded_test', 'sampling_farm', 'precision_drift'], "Running mode: train or test")
+flags.DEFINE_integer("num_shards", 1, "Number of worker processes of the sharded_test mode.")
+flags.DEFINE_integer("shard", None, "Run only this shard of the sharded_test mode (e.g. to re-run a failed shard).")
 flags.DEFINE_string("eval_folder", "eval",
                     "The folder name for storing evaluation results")
 flags.mark_flags_as_required(["config", "mode", "log_path"])
@@ -27,6 +29,14 @@ def main(argv):
     run_lib.compute_data_stats(FLAGS.config)
   elif FLAGS.mode == 'evaluation_pipeline':
     run_lib.evaluation_pipeline(FLAGS.config)
+  elif FLAGS.mode == 'tune_sampler':
+    run_lib.tune_sampler(FLAGS.config, FLAGS.log_path, FLAGS.checkpoint_path)
+  elif FLAGS.mode == 'sharded_test':
+    run_lib.sharded_test(FLAGS.config, FLAGS.log_path, FLAGS.checkpoint_path, FLAGS.num_shards, FLAGS.shard)
+  elif FLAGS.mode == 'sampling_farm':
+    run_lib.run_sampling_farm(FLAGS.config, FLAGS.log_path, FLAGS.checkpoint_path)
+  elif FLAGS.mode == 'precision_drift':
+    run_lib.check_precision_drift(FLAGS.config, FLAGS.log_path, FLAGS.checkpoint_path)
 
 if __name__ == "__main__":
   app.run(main)
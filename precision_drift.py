@@ -0,0 +1,111 @@
+"""Drift of the samples of the reduced-precision inference policy against float32.
+
+The first batches of the validation set are sampled twice with the same per-sample seeds (see
+`sampling.rng`), once with the score network in float32 and once in the reduced precision (see
+`sampling.precision`). Both runs draw the same noise, so the differences only come from the
+precision of the network. For every sample the tool reports the max and mean absolute difference,
+the relative L2 error and the PSNR of the reduced-precision sample against the float32 one, and the
+PSNR of both against the ground truth. The check fails if the mean PSNR against float32 is below
+`eval.drift_min_psnr`.
+
+The tool is configured with the following optional keys of `config.eval`:
+  drift_precision (config.sampling.precision, or bfloat16 if it is float32), drift_num_batches,
+  drift_seed (defaults to config.seed), drift_min_psnr.
+"""
+from lightning_modules.utils import create_lightning_module
+from lightning_data_modules.utils import create_lightning_datamodule
+from sampling.rng import sample_seeds
+import pickle
+import time
+import os
+import torch
+import numpy as np
+from pathlib import Path
+
+
+def psnr(a, b):
+  """PSNR of every sample of `a` against `b`, both clamped to [0, 1]."""
+  mse = torch.mean((torch.clamp(a, 0, 1) - torch.clamp(b, 0, 1)).reshape(a.size(0), -1) ** 2, dim=1)
+  return (10 * torch.log10(1. / torch.clamp(mse, min=1e-12))).tolist()
+
+
+def sample_drift(reference, samples):
+  """The drift of every sample of `samples` against the float32 `reference`."""
+  difference = (samples - reference).reshape(samples.size(0), -1)
+  reference = reference.reshape(reference.size(0), -1)
+  return {'max_abs': difference.abs().max(dim=1)[0].tolist(),
+          'mean_abs': difference.abs().mean(dim=1).tolist(),
+          'relative_l2': (difference.norm(dim=1) / reference.norm(dim=1).clamp(min=1e-12)).tolist()}
+
+
+def get_drift_settings(config):
+  evaluate = config.eval
+  precision = evaluate.get('drift_precision', None)
+  if precision is None:
+    precision = config.sampling.get('precision', 'float32')
+  if precision == 'float32':
+    precision = 'bfloat16'
+  seed = evaluate.get('drift_seed', None)
+  return {'precision': precision,
+          'num_batches': evaluate.get('drift_num_batches', 1),
+          'seed': config.seed if seed is None else seed,
+          'min_psnr': evaluate.get('drift_min_psnr', 35.)}
+
+
+def precision_drift(config, log_path, checkpoint_path):
+  """Compare the samples of the reduced precision with float32 and save the report in `log_path`."""
+  settings = get_drift_settings(config)
+  device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+  evaluate = config.eval
+  snr = evaluate.snr[0] if isinstance(evaluate.snr, list) else evaluate.snr
+  sample_kwargs = {'predictor': evaluate.get('predictor', 'default'), 'corrector': evaluate.get('corrector', 'default'),
+                   'p_steps': evaluate.get('p_steps', 'default'), 'c_steps': evaluate.get('c_steps', 'default'),
+                   'denoise': evaluate.get('denoise', 'default'), 'use_path': evaluate.get('use_path', 'default'),
+                   'schedule': evaluate.get('schedule', 'default'), 'snr': snr}
+
+  DataModule = create_lightning_datamodule(config)
+  DataModule.setup()
+  batches = []
+  for i, (y, x) in enumerate(DataModule.val_dataloader()):
+    if i >= settings['num_batches']:
+      break
+    batches.append((y.to(device), x.to(device)))
+
+  LightningModule = create_lightning_module(config, checkpoint_path).to(device)
+  LightningModule.eval()
+
+  precisions = ['float32', settings['precision']]
+  samples = {precision: [] for precision in precisions}
+  times = {}
+  for precision in precisions:
+    start, index = time.time(), 0
+    for y, _ in batches:
+      #the same seeds for both precisions
+      seeds = sample_seeds(settings['seed'], range(index, index + y.size(0)))
+      batch_samples, _ = LightningModule.sample(y, precision=precision, seeds=seeds, **sample_kwargs)
+      samples[precision].append(batch_samples.float().cpu())
+      index += y.size(0)
+    times[precision] = time.time() - start
+
+  reference, reduced = torch.cat(samples['float32']), torch.cat(samples[settings['precision']])
+  gt = torch.cat([x.cpu() for _, x in batches])
+  report = {'precision': settings['precision'], 'num_samples': reference.size(0), 'times': times,
+            'psnr': psnr(reduced, reference),
+            'psnr_gt': {precision: psnr(torch.cat(samples[precision]), gt) for precision in precisions}}
+  report.update(sample_drift(reference, reduced))
+  report['passed'] = bool(np.mean(report['psnr']) >= settings['min_psnr'])
+
+  print('%s vs float32 on %d samples (seed %d):' % (settings['precision'], report['num_samples'], settings['seed']))
+  print('  max abs drift: %.5f, mean abs drift: %.5f, relative L2: %.5f'
+        % (max(report['max_abs']), np.mean(report['mean_abs']), np.mean(report['relative_l2'])))
+  print('  PSNR against float32: mean %.2f dB, min %.2f dB (threshold %.2f dB)'
+        % (np.mean(report['psnr']), min(report['psnr']), settings['min_psnr']))
+  for precision in precisions:
+    print('  %s: PSNR against the ground truth %.2f dB, sampling time %.1fs'
+          % (precision, np.mean(report['psnr_gt'][precision]), times[precision]))
+  print('  check %s' % ('passed' if report['passed'] else 'FAILED'))
+
+  Path(log_path).mkdir(parents=True, exist_ok=True)
+  with open(os.path.join(log_path, 'precision_drift.pkl'), 'wb') as f:
+    pickle.dump(report, f)
+  return report
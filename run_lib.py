@@ -15,17 +15,25 @@ from lightning_data_modules.utils import create_lightning_datamodule
 from lightning_modules import BaseSdeGenerativeModel, HaarMultiScaleSdeGenerativeModel, ConditionalSdeGenerativeModel #need for lightning module registration
 from lightning_modules.utils import create_lightning_module
 
+from sampling.checkpoint import get_checkpointer
+from sampling.cascade import CascadeStage, run_cascade
+
 from torchvision.transforms import RandomCrop, CenterCrop, ToTensor, Resize
 from torchvision.transforms.functional import InterpolationMode
 
 from evaluation import run_evaluation_pipeline
 import create_dataset
 import compute_dataset_statistics
+import sampler_tuner
+import sharded_sampling
+import sampling_farm
+import precision_drift
 from torch.nn import Upsample
 import torch 
 
 from pathlib import Path
 import os
+import time
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
@@ -144,16 +152,23 @@ def multi_scale_test(master_config, log_path):
 
   def get_autoregressive_sampler(scale_info, coord_space='bicubic', 
                                  predictor='default', corrector='default', 
-                                 p_steps='default', c_steps='default'):
-
-    def bicubic_autoregressive_sampler(lr, return_intermediate_images = True,  show_evolution = False):
+                                 p_steps='default', c_steps='default',
+                                 checkpoint_dir=None, checkpoint_every=None):
+    #each scale of a batch snapshots its sampling trajectory in checkpoint_dir/<checkpoint_name>_scale_<scale>.pt
+    def get_scale_checkpointer(checkpoint_name, scale):
+      if checkpoint_name is None:
+        return None
+      return get_checkpointer(checkpoint_dir, '%s_scale_%d' % (checkpoint_name, scale), checkpoint_every)
+
+    def bicubic_autoregressive_sampler(lr, return_intermediate_images = True,  show_evolution = False, checkpoint_name = None):
       if return_intermediate_images:
         scales_bicubic = []
         scales_bicubic.append(lr.clone().cpu())
       
       for count, scale in enumerate(sorted(scale_info.keys())):
         lightning_module = scale_info[scale]['LightningModule']
-        lr, info = lightning_module.sample(lr, show_evolution, predictor, corrector, p_steps, c_steps)
+        lr, info = lightning_module.sample(lr, show_evolution, predictor, corrector, p_steps, c_steps,
+                                           checkpoint=get_scale_checkpointer(checkpoint_name, scale))
         if return_intermediate_images:
           scales_bicubic.append(lr.clone().cpu())
       
@@ -162,7 +177,7 @@ def multi_scale_test(master_config, log_path):
       else:
         return lr, []
 
-    def haar_autoregressive_sampler(dc, return_intermediate_images = False, show_evolution = False):
+    def haar_autoregressive_sampler(dc, return_intermediate_images = False, show_evolution = False, checkpoint_name = None):
       if return_intermediate_images:
         scales_dc = []
         scales_dc.append(dc.clone().cpu())
@@ -178,7 +193,8 @@ def multi_scale_test(master_config, log_path):
         print('dc.device: ', dc.device)
 
         #inpaint the high frequencies of the next resolution level
-        hf, info = lightning_module.sample(dc, show_evolution, predictor, corrector, p_steps, c_steps) 
+        hf, info = lightning_module.sample(dc, show_evolution, predictor, corrector, p_steps, c_steps,
+                                           checkpoint=get_scale_checkpointer(checkpoint_name, scale)) 
 
         if show_evolution:
           evolution = info['evolution']
@@ -221,6 +237,28 @@ def multi_scale_test(master_config, log_path):
     else:
       return NotImplementedError('%s space is not supported for autoregressive sampling.' % coord_space)
   
+  def get_cascade_stages(scale_info, coord_space='bicubic',
+                         predictor='default', corrector='default',
+                         p_steps='default', c_steps='default',
+                         checkpoint_dir=None, checkpoint_every=None):
+    #one pipeline stage per scale, from the lowest resolution. A stage runs on the device of its scale model.
+    def get_scale_fn(scale):
+      lightning_module = scale_info[scale]['LightningModule']
+
+      def scale_fn(x, name):
+        checkpoint = get_checkpointer(checkpoint_dir, '%s_scale_%d' % (name, scale), checkpoint_every)
+        samples, info = lightning_module.sample(x, False, predictor, corrector, p_steps, c_steps, checkpoint=checkpoint)
+        if coord_space == 'haar':
+          #inverse the haar transform to get the dc coefficients of the new scale
+          return lightning_module.haar_backward(torch.cat([x, samples], dim=1))
+        return samples
+
+      return scale_fn
+
+    return [CascadeStage(get_scale_fn(scale), device=scale_info[scale]['device'],
+                         batch_size=scale_info[scale]['batch_size'], name='scale_%d' % scale)
+            for scale in sorted(scale_info.keys())]
+
   def rescale_and_concatenate(intermediate_images):
     #rescale all images to the highest detected resolution with NN interpolation and normalise them
     max_sr_factor = 2**(len(intermediate_images)-1)
@@ -256,10 +294,36 @@ def multi_scale_test(master_config, log_path):
     return concat_video
 
 
+  def log_autoregressive_samples(i, intermediate_images, hr):
+    concat_upsampled_images = rescale_and_concatenate(intermediate_images)
+
+    vis_concat = torch.cat((concat_upsampled_images, normalise_per_image(hr)), dim=-1) #concatenated intermediate images and the GT hr batch
+    
+    concat_grid = make_grid(vis_concat, nrow=1, normalize=False)
+    logger.experiment.add_image('Autoregressive_Sampling_batch_%d' % i, concat_grid)
+
   #script code for multi_scale testing starts here.
   #create the loggger
   logger = pl.loggers.TensorBoardLogger(log_path, name='autoregressive_samples') 
 
+  #the settings of the whole cascade must agree across the configs of the scales
+  def get_cascade_setting(name, default):
+    values = {repr(config.eval.get(name, default)): config.eval.get(name, default) for config in master_config.values()}
+    if len(values) > 1:
+      raise ValueError('eval.%s differs between the configs of the scales: %s' % (name, ', '.join(values)))
+    return next(iter(values.values()))
+
+  #the pipelined cascade runs every scale in its own thread and on its own gpu. By default it is only used
+  #when there is a gpu per scale, since scales sharing a device contend for it instead of overlapping.
+  pipelined = get_cascade_setting('pipelined_cascade', None)
+  if pipelined is None:
+    pipelined = torch.cuda.is_available() and torch.cuda.device_count() >= len(master_config)
+  queue_size = get_cascade_setting('cascade_queue_size', 2)
+  #finished scales and the last snapshot of the running one are reloaded when a pre-empted job is restarted.
+  checkpoint_every = get_cascade_setting('sampling_checkpoint_every', None)
+  #the k-th scale from the lowest resolution runs on cuda:k
+  scale_index = {scale: k for k, scale in enumerate(sorted(config.data.image_size for config in master_config.values()))}
+
   #store the models, dataloaders and configure sdes (especially the conditioning sde) for all scales
   scale_info = {}
   for config_name, config in master_config.items():
@@ -274,11 +338,28 @@ def multi_scale_test(master_config, log_path):
     LightningModule = LightningModule.load_from_checkpoint(config.model.checkpoint_path)
     LightningModule.configure_sde(config, sigma_max_y = LightningModule.sigma_max_y)
 
-    scale_info[scale]['LightningModule'] = LightningModule.to('cuda:0')
+    if pipelined and torch.cuda.is_available():
+      device = config.eval.get('cascade_device', 'cuda:%d' % (scale_index[scale] % torch.cuda.device_count()))
+    elif pipelined:
+      device = config.eval.get('cascade_device', 'cpu')
+    else:
+      device = 'cuda:0'
+    scale_info[scale]['device'] = device
+    scale_info[scale]['batch_size'] = config.eval.get('cascade_batch_size', None)
+
+    scale_info[scale]['LightningModule'] = LightningModule.to(device)
     scale_info[scale]['LightningModule'].eval()
   
+  if pipelined:
+    #sample batch i+1 at scale k while batch i is sampled at scale k+1
+    cascade_stages = get_cascade_stages(scale_info, coord_space, p_steps=2000, corrector='conditional_none',
+                                        checkpoint_dir=os.path.join(log_path, 'sampling_checkpoints'),
+                                        checkpoint_every=checkpoint_every)
+
   #instantiate the autoregressive sampling function
-  autoregressive_sampler = get_autoregressive_sampler(scale_info, coord_space, p_steps=2000, corrector='conditional_none')
+  autoregressive_sampler = get_autoregressive_sampler(scale_info, coord_space, p_steps=2000, corrector='conditional_none',
+                                                      checkpoint_dir=os.path.join(log_path, 'sampling_checkpoints'),
+                                                      checkpoint_every=checkpoint_every)
 
   #instantiate the function that computes the dc coefficients of the input batch at the required depth/level.
   #lowest_level_fn = get_lowest_level_fn(scale_info, coord_space)
@@ -296,6 +377,28 @@ def multi_scale_test(master_config, log_path):
   min_scale_datamodule.setup()
   min_scale_datamodule.test_batch = max_test_batch
   min_test_dataloader = min_scale_datamodule.test_dataloader()
+
+  if pipelined:
+    max_scale_module = scale_info[max_scale]['LightningModule']
+
+    def cascade_source():
+      #runs in the loader thread of the cascade
+      for i, (batch_lr, batch_hr) in enumerate(zip(min_test_dataloader, max_test_dataloader)):
+        if coord_space == 'haar':
+          with torch.no_grad():
+            hr = max_scale_module.haar_backward(torch.cat(batch_hr, dim=1).to(max_scale_module.device)).cpu()
+        else:
+          hr = batch_hr[1].cpu()
+        yield 'batch_%d' % i, batch_lr[0], hr
+
+    start = time.time()
+    for i, (name, intermediate_images, hr) in enumerate(run_cascade(cascade_source(), cascade_stages, queue_size=queue_size)):
+      log_autoregressive_samples(i, intermediate_images, hr)
+
+    print('Pipelined cascade: %.1fs in total' % (time.time() - start))
+    for stage in cascade_stages:
+      print('%s (%s): %.1fs busy' % (stage.name, stage.device, stage.busy_time))
+    return
   
   #iterate over the test dataloader of the highest scale
   for i, (batch_lr, batch_hr) in enumerate(zip(min_test_dataloader, max_test_dataloader)):
@@ -320,17 +423,41 @@ def multi_scale_test(master_config, log_path):
     else:
       hr = batch_hr[1].cpu()
 
-    intermediate_images, scale_evolutions = autoregressive_sampler(lr, return_intermediate_images=True, show_evolution=False)
-    concat_upsampled_images = rescale_and_concatenate(intermediate_images)
-
-    vis_concat = torch.cat((concat_upsampled_images, normalise_per_image(hr)), dim=-1) #concatenated intermediate images and the GT hr batch
-    
-    concat_grid = make_grid(vis_concat, nrow=1, normalize=False)
-    logger.experiment.add_image('Autoregressive_Sampling_batch_%d' % i, concat_grid)
+    intermediate_images, scale_evolutions = autoregressive_sampler(lr, return_intermediate_images=True, show_evolution=False,
+                                                                   checkpoint_name='batch_%d' % i)
+    log_autoregressive_samples(i, intermediate_images, hr)
 
     #concat_video = create_scale_evolution_video(scale_evolutions['haar']).unsqueeze(0)
     #logger.experiment.add_video('Autoregressive_Sampling_evolution_batch_%d' % i, concat_video, fps=50)
 
 
 def compute_data_stats(config):
-  compute_dataset_statistics.compute_dataset_statistics(config)
\ No newline at end of file
+  compute_dataset_statistics.compute_dataset_statistics(config)
+
+def tune_sampler(config, log_path, checkpoint_path):
+  if checkpoint_path is None:
+    checkpoint_path = config.model.checkpoint_path
+  if checkpoint_path is None:
+    return 'Tuning cannot be completed because no checkpoint has been provided.'
+  return sampler_tuner.tune_sampler(config, log_path, checkpoint_path)
+
+def sharded_test(config, log_path, checkpoint_path, num_shards, shard=None):
+  if checkpoint_path is None:
+    checkpoint_path = config.model.checkpoint_path
+  if checkpoint_path is None:
+    return 'Testing cannot be completed because no checkpoint has been provided.'
+  return sharded_sampling.sharded_test(config, checkpoint_path, num_shards, shard)
+
+def run_sampling_farm(config, log_path, checkpoint_path):
+  if checkpoint_path is None:
+    checkpoint_path = config.model.checkpoint_path
+  if checkpoint_path is None:
+    return 'Sampling cannot be completed because no checkpoint has been provided.'
+  return sampling_farm.run_sampling_farm(config, checkpoint_path)
+
+def check_precision_drift(config, log_path, checkpoint_path):
+  if checkpoint_path is None:
+    checkpoint_path = config.model.checkpoint_path
+  if checkpoint_path is None:
+    return 'The drift cannot be measured because no checkpoint has been provided.'
+  return precision_drift.precision_drift(config, log_path, checkpoint_path)
@@ -0,0 +1,217 @@
+"""Search for the best conditional sampler within a budget of score evaluations (NFE).
+
+The candidates combine a predictor, a corrector, an snr, a time schedule and a corrector
+schedule. For every candidate the number of predictor steps is the largest one whose NFE fits
+the budget. The candidates are scored with the metrics of `TestPairedVisualizationCallback`
+(LPIPS/PSNR/SSIM) on the first batches of the validation set and the fastest candidate whose
+score is within a tolerance of the best one is written out as a `config.eval` block.
+
+The search is configured with the following optional keys of `config.eval`:
+  tuner_nfe_budget, tuner_budget_fractions, tuner_num_batches, tuner_draws, tuner_metric,
+  tuner_tolerance, tuner_predictors, tuner_correctors, tuner_snrs, tuner_schedules,
+  tuner_corrector_t_stars, tuner_max_trials, tuner_seed.
+"""
+from lightning_modules.utils import create_lightning_module
+from lightning_data_modules.utils import create_lightning_datamodule
+from lightning_callbacks.PairedCallback import TestPairedVisualizationCallback
+from sampling import schedules
+import itertools
+import pickle
+import time
+import os
+import torch
+import numpy as np
+from pathlib import Path
+
+#metrics for which a lower value is better
+_LOWER_IS_BETTER = ['lpips']
+
+
+def get_tuner_settings(config):
+  evaluate = config.eval
+  return {'nfe_budget': evaluate.get('tuner_nfe_budget', 100),
+          'budget_fractions': evaluate.get('tuner_budget_fractions', [0.5, 1.]),
+          'num_batches': evaluate.get('tuner_num_batches', 2),
+          'draws': evaluate.get('tuner_draws', 1),
+          'metric': evaluate.get('tuner_metric', 'lpips'),
+          'tolerance': evaluate.get('tuner_tolerance', 0.02),
+          'predictors': evaluate.get('tuner_predictors', ['conditional_reverse_diffusion', 'conditional_euler_maruyama', 'conditional_ddim']),
+          'correctors': evaluate.get('tuner_correctors', ['conditional_none', 'conditional_langevin']),
+          'snrs': evaluate.get('tuner_snrs', [0.1, 0.15, 0.2]),
+          'schedules': evaluate.get('tuner_schedules', ['uniform', 'log_sigma', 'karras']),
+          #the corrector runs for t < t_star. t_star >= T is the constant schedule of the original samplers.
+          'corrector_t_stars': evaluate.get('tuner_corrector_t_stars', [1., 0.5, 0.2]),
+          'max_trials': evaluate.get('tuner_max_trials', None),
+          'seed': evaluate.get('tuner_seed', 0)}
+
+
+def get_candidates(settings):
+  """All combinations of the search space. The snr and the corrector schedule only matter with a corrector."""
+  candidates = []
+  for predictor, corrector, schedule in itertools.product(settings['predictors'], settings['correctors'], settings['schedules']):
+    if corrector.endswith('none'):
+      candidates.append({'predictor': predictor, 'corrector': corrector, 'snr': settings['snrs'][0],
+                         'schedule': schedule, 'corrector_t_star': None})
+      continue
+    for snr, t_star in itertools.product(settings['snrs'], settings['corrector_t_stars']):
+      candidates.append({'predictor': predictor, 'corrector': corrector, 'snr': snr,
+                         'schedule': schedule, 'corrector_t_star': t_star})
+
+  if settings['max_trials'] is not None and len(candidates) > settings['max_trials']:
+    rng = np.random.RandomState(settings['seed'])
+    index = rng.choice(len(candidates), settings['max_trials'], replace=False)
+    candidates = [candidates[i] for i in sorted(index)]
+  return candidates
+
+
+def get_corrector_schedule(candidate, sde):
+  t_star = candidate['corrector_t_star']
+  if t_star is None or t_star >= sde.T:
+    return schedules.constant_corrector_schedule()
+  return schedules.below_corrector_schedule(t_star)
+
+
+def count_nfe(sde, eps, candidate, p_steps, c_steps, schedule_fn):
+  """The score evaluations of the PC sampler: one per predictor update, c_steps per corrector update."""
+  timesteps = schedules.get_timesteps(sde, p_steps, eps, schedule_fn)
+  if candidate['corrector'].endswith('none'):
+    return timesteps.size(0)
+  budget = schedules.get_corrector_budget(get_corrector_schedule(candidate, sde), timesteps)
+  return timesteps.size(0) + c_steps * sum(budget)
+
+
+def fit_p_steps(sde, eps, candidate, c_steps, schedule_fn, nfe_budget):
+  """The largest number of predictor steps whose NFE fits the budget (bisection). `None` if none fits."""
+  low, high = 1, nfe_budget + 1
+  while high - low > 1:
+    mid = (low + high) // 2
+    if count_nfe(sde, eps, candidate, mid, c_steps, schedule_fn) <= nfe_budget:
+      low = mid
+    else:
+      high = mid
+  if low < 2 or count_nfe(sde, eps, candidate, low, c_steps, schedule_fn) > nfe_budget:
+    return None
+  return low
+
+
+def is_better(a, b, metric):
+  return a < b if metric in _LOWER_IS_BETTER else a > b
+
+
+def is_acceptable(score, best_score, metric, tolerance):
+  if metric in _LOWER_IS_BETTER:
+    return score <= best_score + tolerance * abs(best_score)
+  return score >= best_score - tolerance * abs(best_score)
+
+
+def evaluate_candidate(callback, pl_module, batches, candidate, sde, seed):
+  """Mean metrics of the candidate on the held-out batches and the sampling time in seconds."""
+  callback.predictor = candidate['predictor']
+  callback.corrector = candidate['corrector']
+  callback.p_steps = candidate['p_steps']
+  callback.schedule = candidate['schedule']
+  callback.corrector_schedule = get_corrector_schedule(candidate, sde)
+
+  #the same noise for every candidate
+  torch.manual_seed(seed)
+  results = {metric: [] for metric in callback.evaluation_metrics}
+  start = time.time()
+  for y, x in batches:
+    metric_vals = callback.generate_metric_vals(y, x, pl_module, candidate['snr'])
+    for metric in callback.evaluation_metrics:
+      results[metric].append(np.mean(metric_vals[metric]))
+  duration = time.time() - start
+  return {metric: float(np.mean(vals)) for metric, vals in results.items()}, duration
+
+
+def format_eval_block(best, sde, settings, c_steps, denoise):
+  lines = ['  # Tuned sampler: %d score evaluations (budget %d), %s = %.5f on %d validation batches.'
+           % (best['nfe'], settings['nfe_budget'], settings['metric'], best['metrics'][settings['metric']], settings['num_batches']),
+           "  evaluate.predictor = '%s'" % best['predictor'],
+           "  evaluate.corrector = '%s'" % best['corrector'],
+           '  evaluate.p_steps = %d' % best['p_steps'],
+           '  evaluate.c_steps = %d' % c_steps,
+           '  evaluate.snr = [%s]' % best['snr'],
+           '  evaluate.denoise = %s' % denoise,
+           '  evaluate.use_path = False',
+           "  evaluate.schedule = '%s'" % best['schedule']]
+  t_star = best['corrector_t_star']
+  if best['corrector'].endswith('none') or t_star is None or t_star >= sde.T:
+    lines.append("  evaluate.corrector_schedule = 'constant'")
+  else:
+    lines += ["  evaluate.corrector_schedule = 'below'",
+              '  evaluate.corrector_t_star = %s' % t_star]
+  lines.append('  evaluate.corrector_steps = 1')
+  return '\n'.join(lines)
+
+
+def tune_sampler(config, log_path, checkpoint_path):
+  """Search the sampler settings and save the selected `config.eval` block and all results in `log_path`."""
+  settings = get_tuner_settings(config)
+  metric = settings['metric']
+  device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+  DataModule = create_lightning_datamodule(config)
+  DataModule.setup()
+  batches = []
+  for i, (y, x) in enumerate(DataModule.val_dataloader()):
+    if i >= settings['num_batches']:
+      break
+    batches.append((y.to(device), x.to(device)))
+
+  LightningModule = create_lightning_module(config, checkpoint_path).to(device)
+  LightningModule.eval()
+  sde = LightningModule.sde['x'] if isinstance(LightningModule.sde, dict) else LightningModule.sde
+  eps = LightningModule.sampling_eps
+
+  #score the samples like the test callback, without saving them
+  eval_config = config.eval.copy_and_resolve_references()
+  eval_config.save_samples = False
+  eval_config.draws = list(range(1, settings['draws'] + 1))
+  eval_config.evaluation_metrics = [m for m in ['lpips', 'psnr', 'ssim'] if m in config.eval.evaluation_metrics or m == metric]
+  callback = TestPairedVisualizationCallback(show_evolution=False, eval_config=eval_config,
+                                             data_config=config.data, approach=config.training.conditioning_approach)
+  callback.on_test_start(None, LightningModule)
+  callback.checkpoint_every = None
+  c_steps = config.sampling.n_steps_each if config.eval.c_steps == 'default' else config.eval.c_steps
+  callback.c_steps = c_steps
+  denoise = config.sampling.noise_removal if config.eval.denoise == 'default' else config.eval.denoise
+  callback.denoise = denoise
+  callback.use_path = False
+
+  results = []
+  budgets = sorted(set(max(2, int(round(f * settings['nfe_budget']))) for f in settings['budget_fractions']))
+  for nfe_budget in budgets:
+    for candidate in get_candidates(settings):
+      schedule_fn = schedules.get_schedule_fn(config, candidate['schedule'])
+      p_steps = fit_p_steps(sde, eps, candidate, c_steps, schedule_fn, nfe_budget)
+      if p_steps is None:
+        continue
+      candidate['p_steps'] = p_steps
+      candidate['nfe'] = count_nfe(sde, eps, candidate, p_steps, c_steps, schedule_fn)
+      candidate['metrics'], candidate['time'] = evaluate_candidate(callback, LightningModule, batches, candidate, sde, settings['seed'])
+      print('nfe: %d - %s / %s - snr: %.3f - schedule: %s - corrector t*: %s --- %s: %.5f (%.1fs)'
+            % (candidate['nfe'], candidate['predictor'], candidate['corrector'], candidate['snr'], candidate['schedule'],
+               candidate['corrector_t_star'], metric, candidate['metrics'][metric], candidate['time']))
+      results.append(candidate)
+
+  if not results:
+    return 'Tuning cannot be completed because no candidate fits an NFE budget of %d.' % settings['nfe_budget']
+
+  best_score = results[0]['metrics'][metric]
+  for result in results[1:]:
+    if is_better(result['metrics'][metric], best_score, metric):
+      best_score = result['metrics'][metric]
+  acceptable = [r for r in results if is_acceptable(r['metrics'][metric], best_score, metric, settings['tolerance'])]
+  #fastest acceptable sampler, the best score among equally fast ones
+  best = min(acceptable, key=lambda r: (r['nfe'], r['metrics'][metric] if metric in _LOWER_IS_BETTER else -r['metrics'][metric]))
+
+  eval_block = format_eval_block(best, sde, settings, c_steps, denoise)
+  print(eval_block)
+
+  Path(log_path).mkdir(parents=True, exist_ok=True)
+  with open(os.path.join(log_path, 'tuned_eval_config.py'), 'w') as f:
+    f.write(eval_block + '\n')
+  with open(os.path.join(log_path, 'tuner_results.pkl'), 'wb') as f:
+    pickle.dump(results, f)
+  return eval_block
@@ -0,0 +1,117 @@
+"""Adaptive step-size integration of the reverse SDE.
+
+Used by `pc_sampler` and `pc_conditional_sampler` in place of the fixed time grid when the
+predictor is adaptive (`sampling.predictors.AdaptivePredictor`). Every sample keeps its own time
+and step size; samples that reached `eps` drop out of the batch.
+"""
+import torch
+
+from sampling import evolution
+
+
+def get_predictor_kwargs(config, predictor):
+  """Tolerances of the adaptive predictors from `config.sampling`. `None` for other predictors."""
+  if not getattr(predictor, 'adaptive', False):
+    return None
+  return {'abstol': config.sampling.get('adaptive_abstol', 0.0078),
+          'reltol': config.sampling.get('adaptive_reltol', 0.05),
+          'h_init': config.sampling.get('adaptive_h_init', 0.01)}
+
+
+def get_condition_fn(plan, y, z_y, index):
+  """The condition of the samples `index` as a function of their time.
+  With a diffused condition, y_t follows the single path mean_coeff_y(t) * y + std_y(t) * z_y.
+  """
+  y = y[index]
+  if not plan.diffuse_y:
+    return lambda vec_t: y
+  z_y = z_y[index]
+
+  def condition(vec_t):
+    y_mean, y_std = plan.sde['y'].marginal_prob(y, vec_t)
+    return y_mean + y_std[(...,) + (None,) * len(y.shape[1:])] * z_y
+  return condition
+
+
+def solve_reverse_sde(plan, x, eps, y=None, show_evolution=False):
+  """Integrate the reverse SDE from `plan.timesteps[0]` to `eps` with adaptive steps.
+  The corrector of the plan runs after every accepted step that has not reached `eps`.
+  Args:
+    plan: A `SamplingPlan` or `ConditionalSamplingPlan` with an adaptive predictor.
+    x: The initial states.
+    eps: A `float` number. The final time.
+    y: The condition. Required for conditional plans.
+    show_evolution: If `True` or an `EvolutionRecorder`, record the states after the iterations.
+  Returns:
+    The final states, the final states without the noise of the last step and the sampling
+    information: accepted and rejected steps and score evaluations ('steps') of every sample.
+  """
+  predictor, corrector = plan.predictor, plan.corrector
+  conditional = y is not None
+  batch_size, device = x.shape[0], x.device
+  all_samples = torch.arange(batch_size, device=device)
+
+  t = torch.full((batch_size,), plan.timesteps[0].item(), dtype=torch.float64, device=device)
+  h = torch.full_like(t, predictor.h_init)
+  x, x_mean, x_prev = x.clone(), x.clone(), x.clone()
+  accepted = torch.zeros(batch_size, dtype=torch.long, device=device)
+  rejected = torch.zeros_like(accepted)
+  nfe = torch.zeros_like(accepted)
+  z_y = torch.randn_like(y) if conditional and plan.diffuse_y else None
+  corrector_steps = getattr(corrector, 'n_steps', 0)
+  if plan.noise is not None:
+    raise ValueError('The adaptive solver steps subsets of the batch and does not support per-sample noise streams.')
+  if getattr(corrector, 'snr_groups', None) is not None:
+    raise ValueError('The adaptive solver corrects subsets of the batch and does not support per-sample SNRs.')
+
+  recorder = evolution.get_recorder(show_evolution)
+  if recorder is not None:
+    recorder.start()
+  times = {}
+  iteration = 0
+  active = t > eps
+  while active.any():
+    index = active.nonzero().squeeze(1)
+    t_active = t[index]
+    h_active = torch.minimum(h[index], t_active - eps)
+    condition = get_condition_fn(plan, y, z_y, index) if conditional else None
+
+    x_low, x_high, x_high_mean, error = predictor.propose(x[index], t_active.float(), h_active.float(),
+                                                          x_prev[index], condition)
+    nfe[index] += 2
+
+    accept = error <= 1.
+    acc = index[accept]
+    # The last step of every sample lands exactly on eps.
+    t_next = torch.where(h_active >= t_active - eps, torch.full_like(t_active, eps), t_active - h_active)
+    x[acc], x_mean[acc], x_prev[acc] = x_high[accept], x_high_mean[accept], x_low[accept]
+    t[acc] = t_next[accept]
+    accepted[acc] += 1
+    rejected[index[~accept]] += 1
+    h[index] = predictor.next_step_size(h_active, error.double())
+
+    correct = acc[t[acc] > eps]
+    if corrector_steps > 0 and correct.numel() > 0:
+      vec_t = t[correct].float()
+      if conditional:
+        x[correct], _ = corrector.update_fn(x[correct], get_condition_fn(plan, y, z_y, correct)(vec_t), vec_t)
+      else:
+        x[correct], _ = corrector.update_fn(x[correct], vec_t)
+      nfe[correct] += corrector_steps
+
+    active = t > eps
+    if recorder is not None and recorder.should_record(iteration):
+      times[iteration] = t.mean().float()
+      if conditional:
+        recorder.record(iteration, {'x': x, 'y': get_condition_fn(plan, y, z_y, all_samples)(t.float())})
+      else:
+        recorder.record(iteration, x)
+    iteration += 1
+
+  sampling_info = {'accepted': accepted, 'rejected': rejected, 'steps': nfe}
+  if recorder is not None:
+    evolution.add_to_sampling_info(sampling_info, recorder)
+    #mean time of the samples in the recorded frames
+    steps = sampling_info['evolution_steps']
+    sampling_info['times'] = torch.stack([times[i] for i in steps]) if steps else None
+  return x, x_mean, sampling_info
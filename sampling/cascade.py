@@ -0,0 +1,150 @@
+"""Pipelined execution of a cascade of samplers (e.g. the scales of `run_lib.multi_scale_test`).
+
+Every stage runs in its own thread, on its own device and (on GPUs) on its own CUDA stream. The
+stages are connected by bounded queues, so while stage k+1 processes batch i, stage k already
+processes batch i+1 and the loader prepares batch i+2. The throughput of the cascade approaches
+the one of its slowest stage, and the queues bound the number of batches held in memory.
+"""
+import contextlib
+import queue
+import threading
+import time
+import torch
+
+_DONE = object()
+
+
+class _Failure:
+  def __init__(self, exception):
+    self.exception = exception
+
+
+class CascadeStage:
+  """One stage of the cascade."""
+
+  def __init__(self, fn, device='cpu', batch_size=None, name=None):
+    """Configure the stage.
+    Args:
+      fn: A function (x, name) -> output, the input of the next stage. `name` identifies the
+        (part of the) batch, e.g. for sampling checkpoints.
+      device: The device of the stage. The input is moved there before `fn` is called.
+      batch_size: If given, `fn` is called on parts of at most `batch_size` samples and the
+        outputs are concatenated.
+      name: The name of the stage in the timings.
+    """
+    self.fn = fn
+    self.device = torch.device(device)
+    self.batch_size = batch_size
+    self.name = name
+    self.busy_time = 0.
+    self.stream = None
+
+  def process(self, x, name):
+    start = time.time()
+    if self.device.type == 'cuda' and self.stream is None:
+      self.stream = torch.cuda.Stream(self.device)
+    stream = self.stream
+    #the grad mode is thread local
+    with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+      x = x.to(self.device)
+      if self.batch_size is None or x.size(0) <= self.batch_size:
+        out = self.fn(x, name)
+      else:
+        out = torch.cat([self.fn(part, '%s_part_%d' % (name, j)) for j, part in enumerate(x.split(self.batch_size))], dim=0)
+    if stream is not None:
+      #the next stage reads the output on another stream
+      stream.synchronize()
+    self.busy_time += time.time() - start
+    return out
+
+
+def _put(q, item, stop):
+  """Put into a bounded queue unless the cascade is stopped. Returns False if it was stopped."""
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+
+def _get(q, stop):
+  while not stop.is_set():
+    try:
+      return q.get(timeout=0.1)
+    except queue.Empty:
+      continue
+  return _DONE
+
+
+def _feed(source, q_out, stop):
+  try:
+    for item in source:
+      if not _put(q_out, item, stop):
+        return
+  except BaseException as e:
+    _put(q_out, _Failure(e), stop)
+    return
+  _put(q_out, _DONE, stop)
+
+
+def _work(stage, q_in, q_out, stop, keep_outputs):
+  while True:
+    item = _get(q_in, stop)
+    if item is _DONE or isinstance(item, _Failure):
+      _put(q_out, item, stop)
+      return
+    name, outputs, payload = item
+    try:
+      x = stage.process(outputs[-1], name)
+    except BaseException as e:
+      _put(q_out, _Failure(e), stop)
+      return
+    if keep_outputs:
+      outputs = outputs + [x.detach().cpu()]
+    else:
+      outputs = [x]
+    if not _put(q_out, (name, outputs, payload), stop):
+      return
+
+
+def run_cascade(source, stages, queue_size=2, keep_outputs=True):
+  """Run the batches of `source` through the stages, one thread per stage.
+  Args:
+    source: An iterable of (name, x, payload). It is consumed in a separate thread as well, so
+      the loading of the next batches overlaps with sampling. `payload` is passed through untouched.
+    stages: A list of `CascadeStage`, in the order of the cascade.
+    queue_size: The number of batches that can wait between two stages.
+    keep_outputs: If `True`, the input and the output of every stage are kept (on the cpu).
+      Otherwise only the output of the last stage.
+  Yields:
+    (name, outputs, payload) in the order of `source`. `outputs` holds the input followed by the
+    output of every stage if `keep_outputs`, else the output of the last stage only.
+  """
+  stop = threading.Event()
+  queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+  def to_items():
+    for name, x, payload in source:
+      yield name, [x.detach().cpu() if keep_outputs else x], payload
+
+  threads = [threading.Thread(target=_feed, args=(to_items(), queues[0], stop), daemon=True)]
+  for k, stage in enumerate(stages):
+    threads.append(threading.Thread(target=_work, args=(stage, queues[k], queues[k+1], stop, keep_outputs), daemon=True))
+  for thread in threads:
+    thread.start()
+
+  try:
+    while True:
+      item = queues[-1].get()
+      if item is _DONE:
+        break
+      if isinstance(item, _Failure):
+        raise item.exception
+      yield item
+  finally:
+    #stops the threads if the consumer fails or stops early
+    stop.set()
+    for thread in threads:
+      thread.join()
@@ -0,0 +1,121 @@
+"""Snapshots of sampling trajectories for pre-emptible jobs.
+
+A `SamplingCheckpointer` stores the state of one sampler call (the step index, `x`, `x_mean`,
+the path sample `y_tplustau` of `use_path`, the RNG states and the counter of the per-sample noise
+streams) every `every` steps and the final
+samples once the trajectory is complete. A restarted job that calls the sampler with the same
+checkpointer continues from the last snapshot, or gets the final samples back immediately, and
+produces bit-identical results because the RNG states are restored as well.
+The snapshots are written before `step` and `finish` return and keep no reference to the state,
+so the reused buffers of the in-place samplers can be passed directly.
+
+Every snapshot carries the fingerprint of its sampler call (`get_fingerprint`: the sampler arguments,
+the time grid, the seeds, the condition y and the weights of the score model), so that a snapshot left
+by a different configuration, batch or model checkpoint under the same name is not resumed.
+"""
+import hashlib
+import os
+import torch
+
+
+def _digest(tensor):
+  shape = list(tensor.shape)
+  tensor = tensor.detach().double().flatten()
+  #the weighted sum depends on the order of the values, e.g. of the samples of a batch
+  weights = torch.linspace(1., 2., tensor.numel(), dtype=tensor.dtype, device=tensor.device)
+  return shape, tensor.sum().item(), tensor.abs().sum().item(), (weights * tensor).sum().item()
+
+
+def _plain(value):
+  if torch.is_tensor(value):
+    #a cheap digest of the values (e.g. of the condition y), not the values themselves
+    return _digest(value)
+  if callable(value):
+    #the name of a predictor or corrector class, not its address
+    return getattr(value, '__qualname__', type(value).__name__)
+  if isinstance(value, dict):
+    return sorted((key, _plain(item)) for key, item in value.items())
+  if isinstance(value, (list, tuple)):
+    return [_plain(item) for item in value]
+  return value
+
+
+def get_fingerprint(model, **arguments):
+  """A hash of the arguments of a sampler call and of the weights of the score model `model`."""
+  with torch.no_grad():
+    #independent of the names, so that wrappers of the same network (e.g. the autocast one) share it
+    weights = [_digest(p) for p in model.state_dict().values() if torch.is_tensor(p) and p.is_floating_point()]
+  return hashlib.sha1(repr((_plain(arguments), weights)).encode()).hexdigest()
+
+
+def get_rng_state(device):
+  state = {'cpu': torch.get_rng_state()}
+  if torch.device(device).type == 'cuda':
+    state['cuda'] = torch.cuda.get_rng_state(device)
+  return state
+
+
+def set_rng_state(state, device):
+  torch.set_rng_state(state['cpu'])
+  if 'cuda' in state:
+    torch.cuda.set_rng_state(state['cuda'], device)
+
+
+class SamplingCheckpointer:
+  """Periodic snapshots of a single sampler call in the file `path`."""
+
+  def __init__(self, path, every=100):
+    self.path = path
+    self.every = every
+    self.fingerprint = None
+
+  def load(self, device, num_steps, shape, noise=None, fingerprint=None):
+    """The last snapshot (with the RNG states and the counter of the `sampling.rng.SampleNoise` restored) or `None`.
+    `fingerprint` (see `get_fingerprint`) identifies the sampler call and is saved with the next snapshots.
+    Raises a `ValueError` if the snapshot belongs to a different trajectory.
+    """
+    self.fingerprint = fingerprint
+    if not os.path.exists(self.path):
+      return None
+    #the RNG states must stay on the cpu
+    state = torch.load(self.path, map_location='cpu')
+    if state['num_steps'] != num_steps or list(state['shape']) != list(shape):
+      raise ValueError(f'The sampling checkpoint {self.path} was saved for {state["num_steps"]} steps '
+                       f'and shape {list(state["shape"])}, not {num_steps} steps and shape {list(shape)}.')
+    if state.get('fingerprint') != fingerprint:
+      raise ValueError(f'The sampling checkpoint {self.path} was saved with different sampler arguments, seeds '
+                       f'or model weights. Delete it to sample this trajectory from the start.')
+    state.pop('fingerprint', None)
+    set_rng_state(state.pop('rng'), device)
+    noise_counter = state.pop('noise_counter', None)
+    if noise is not None and noise_counter is not None:
+      noise.counter = noise_counter
+    return {key: value.to(device) if torch.is_tensor(value) else value for key, value in state.items()}
+
+  def save(self, state, device):
+    state = dict(state, rng=get_rng_state(device), fingerprint=self.fingerprint)
+    #write to a temporary file first so that a pre-emption during the write keeps the previous snapshot
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    tmp_path = self.path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, self.path)
+
+  def step(self, i, num_steps, shape, device, noise=None, **tensors):
+    """Snapshot after the i-th step if it is due. `tensors` is the state needed to continue."""
+    if self.every and (i + 1) % self.every == 0 and i + 1 < num_steps:
+      if noise is not None:
+        tensors['noise_counter'] = noise.counter
+      self.save(dict(tensors, step=i, num_steps=num_steps, shape=list(shape), done=False), device)
+
+  def finish(self, samples, sampling_info, num_steps, shape, device):
+    """Keep the final samples, so that a restarted job does not sample them again."""
+    sampling_info = {key: value for key, value in sampling_info.items() if key not in ('evolution', 'evolution_steps')}
+    self.save({'samples': samples, 'sampling_info': sampling_info, 'step': num_steps - 1,
+               'num_steps': num_steps, 'shape': list(shape), 'done': True}, device)
+
+
+def get_checkpointer(directory, name, every):
+  """The checkpointer `directory/name.pt`, or `None` if checkpointing is disabled (`every` is `None` or 0)."""
+  if not every:
+    return None
+  return SamplingCheckpointer(os.path.join(directory, name + '.pt'), every)
@@ -0,0 +1,138 @@
+"""Compiled predictor and corrector updates (`config.sampling.compile`).
+
+Eager sampling runs the score network and the elementwise SDE arithmetic around it op by op, for
+every update of every step. With `compile='torch_compile'` the update functions of the predictor
+and of the corrector of a sampling plan go through `torch.compile` with static shapes: the network
+call and the arithmetic of the update (score scaling, drift, step sizes, noise) are captured in one
+graph and the elementwise ops are fused. The random ops stay the eager ones (`fallback_random`), so
+a compiled sampler draws the same noise as the eager one, and the per-sample noise streams of
+`sampling.rng` are not traced (one graph break per draw).
+
+The compiled graphs are cached on disk in `config.sampling.compile_cache_dir`, in one directory per
+configuration (the inductor caches, whose entries are keyed by the graph and the input shapes), so
+that later runs skip the code generation. `compile='torchscript'` traces the updates with `torch.jit.trace` instead, for runtimes
+without `torch.compile`. The traces embed the weights and the constants of the trajectory, so they
+are made once per trajectory and input shape and are not cached on disk.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import torch
+
+COMPILE_BACKENDS = ['none', 'torch_compile', 'torchscript']
+
+
+@contextlib.contextmanager
+def _environ(name, value):
+  """Set the environment variable `name` to `value` (unchanged if `None`) and restore it on exit."""
+  if value is None:
+    yield
+    return
+  previous = os.environ.get(name)
+  os.environ[name] = value
+  try:
+    yield
+  finally:
+    if previous is None:
+      del os.environ[name]
+    else:
+      os.environ[name] = previous
+
+
+def _shape_key(args):
+  return tuple((tuple(arg.shape), str(arg.dtype), arg.device.type) for arg in args if torch.is_tensor(arg))
+
+
+class StepCompiler:
+  """Compiles the update functions of the predictor and the corrector of sampling plans."""
+
+  def __init__(self, backend='torch_compile', mode=None, cache_dir=None, config_key=''):
+    """Configure the compilation.
+    Args:
+      backend: 'torch_compile' or 'torchscript'. 'torch_compile' falls back to 'torchscript' on
+        runtimes without `torch.compile`.
+      mode: The `mode` of `torch.compile` (e.g. 'max-autotune'), `None` for the default.
+      cache_dir: The directory of the compiled graphs, the default cache of inductor if `None`.
+      config_key: A string identifying the configuration, hashed into the name of its cache directory.
+    """
+    if backend not in COMPILE_BACKENDS[1:]:
+      raise ValueError(f'Unknown compile backend {backend}, expected one of {COMPILE_BACKENDS}.')
+    if backend == 'torch_compile' and not hasattr(torch, 'compile'):
+      print('torch.compile is not available in torch %s, the sampling updates are traced with TorchScript.' % torch.__version__)
+      backend = 'torchscript'
+    self.backend = backend
+    self.mode = mode
+    self.cache_dir = cache_dir
+    self.config_key = config_key
+
+  def compile_fn(self, fn, model):
+    """The compiled version of an update function fn(*inputs, coeffs=None) -> (x, x_mean) of the score model `model`."""
+    if self.backend == 'torchscript':
+      return self.trace_fn(fn, model)
+
+    import torch._inductor.config
+    compiled_fn = torch.compile(fn, dynamic=False, mode=self.mode)
+    #the graphs are compiled on the first calls, so the settings are scoped to every call instead of the whole process
+    patches = {'fallback_random': True}
+    if self.cache_dir is not None:
+      patches['fx_graph_cache'] = True
+    cache_dir = self.get_cache_dir() if self.cache_dir is not None else None
+
+    def scoped_fn(*inputs, **kwargs):
+      with torch._inductor.config.patch(patches), _environ('TORCHINDUCTOR_CACHE_DIR', cache_dir):
+        return compiled_fn(*inputs, **kwargs)
+
+    return scoped_fn
+
+  def get_cache_dir(self):
+    """The directory of the compiled graphs of this configuration."""
+    key = hashlib.sha1(repr((self.config_key, torch.__version__)).encode()).hexdigest()[:16]
+    return os.path.join(self.cache_dir, 'sampling_%s' % key)
+
+  def trace_fn(self, fn, model):
+    traces = {}
+
+    def traced_fn(*inputs, coeffs=None):
+      if coeffs is None:
+        return fn(*inputs)
+      shape_key = _shape_key(inputs)
+      if shape_key not in traces:
+        devices = [arg.device for arg in inputs if torch.is_tensor(arg) and arg.is_cuda][:1]
+        #the weights become constants of the trace, which cannot require gradients
+        parameters = [p for p in model.parameters() if p.requires_grad]
+        #tracing runs the update once, without advancing the RNG of the sampler
+        with torch.random.fork_rng(devices=devices):
+          try:
+            for p in parameters:
+              p.requires_grad_(False)
+            traces[shape_key] = torch.jit.trace(lambda *args: fn(*args[:-1], coeffs=args[-1]),
+                                                inputs + (coeffs,), check_trace=False, strict=False)
+          finally:
+            for p in parameters:
+              p.requires_grad_(True)
+      return traces[shape_key](*inputs, coeffs)
+
+    return traced_fn
+
+  def compile_plan(self, plan):
+    """Replace the update functions of the predictor and the corrector of `plan` by compiled ones."""
+    if self.backend == 'torchscript' and plan.noise is not None:
+      raise ValueError('The per-sample noise streams cannot be traced with TorchScript, use torch_compile.')
+    plan.predictor.update_fn = self.compile_fn(plan.predictor.update_fn, plan.model)
+    plan.corrector.update_fn = self.compile_fn(plan.corrector.update_fn, plan.model)
+
+
+def get_step_compiler(config):
+  """A `StepCompiler` configured by `config.sampling.compile` ('none', 'torch_compile' or 'torchscript'),
+  `compile_mode` and `compile_cache_dir`, or `None` if `compile` is not set. Only the PC samplers are compiled."""
+  backend = config.sampling.get('compile', None)
+  if backend is None or backend == 'none':
+    return None
+  #the caches are specific to the sampling, model and data configuration
+  config_key = json.dumps({name: config[name].to_dict() for name in ['sampling', 'model', 'data'] if name in config},
+                          sort_keys=True, default=str)
+  return StepCompiler(backend=backend,
+                      mode=config.sampling.get('compile_mode', None),
+                      cache_dir=config.sampling.get('compile_cache_dir', None),
+                      config_key=config_key)
@@ -1,13 +1,26 @@
-from sampling.predictors import get_predictor, NonePredictor
-from sampling.correctors import get_corrector, NoneCorrector
+from sampling.predictors import get_predictor
+from sampling.correctors import get_corrector
+from sampling.plan import ConditionalSamplingPlan
+from sampling.dpm_solver import get_conditional_dpm_solver_sampler
+from sampling.parallel import get_conditional_picard_sampler
+from sampling import adaptive
+from sampling import schedules
+from sampling import evolution
+from sampling import warm_start
+from sampling import rng
+from sampling import checkpoint as checkpoint_lib
+from sampling import compilation
+from sampling import tiling as tiling_lib
+from sampling import precision as precision_lib
 import functools
 import torch
 from tqdm import tqdm
-from models import utils as mutils
 
 def get_conditional_sampling_fn(config, sde, shape, eps, 
                           predictor='default', corrector='default', p_steps='default', 
-                          c_steps='default', snr='default', denoise='default', use_path='default'):
+                          c_steps='default', snr='default', denoise='default', use_path='default',
+                          schedule='default', corrector_schedule='default', warm_start_t0='default',
+                          precision='default'):
 
     if predictor == 'default':
       predictor = get_predictor(config.sampling.predictor.lower())
@@ -19,8 +32,13 @@ def get_conditional_sampling_fn(config, sde, shape, eps,
     else:
       corrector = get_corrector(corrector.lower())
 
+    sampler_name = config.sampling.method.lower()
+
     if p_steps == 'default':
-      p_steps = config.model.num_scales
+      if sampler_name == 'dpm_solver':
+        p_steps = config.sampling.get('dpm_solver_steps', 20)
+      else:
+        p_steps = config.model.num_scales
     if c_steps == 'default':
       c_steps = config.sampling.n_steps_each
     if snr == 'default':
@@ -29,6 +47,49 @@ def get_conditional_sampling_fn(config, sde, shape, eps,
       denoise = config.sampling.noise_removal
     if use_path =='default':
       use_path = False
+    if warm_start_t0 == 'default':
+      warm_start_t0 = config.sampling.get('warm_start_t0', None)
+    if precision == 'default':
+      precision = config.sampling.get('precision', 'float32')
+    tiling = tiling_lib.get_tiling_fn(config)
+
+    # The DPM-Solver keeps its own logSNR spacing unless a schedule is selected explicitly.
+    use_schedule = schedule != 'default' or 'schedule' in config.sampling
+    schedule = schedules.get_schedule_fn(config, schedule)
+
+    # Multistep DPM-Solver++ for the probability flow ODE. p_steps is the number of solver steps.
+    if sampler_name == 'dpm_solver':
+      if warm_start_t0 is not None:
+        raise ValueError('The warm start is not supported by the DPM-Solver sampler.')
+      if tiling is not None:
+        raise ValueError('Tiled sampling is not supported by the DPM-Solver sampler.')
+      sampling_fn = get_conditional_dpm_solver_sampler(sde=sde,
+                                                       shape=shape,
+                                                       steps=p_steps,
+                                                       order=config.sampling.get('dpm_solver_order', 2),
+                                                       skip_type=config.sampling.get('dpm_solver_skip_type', 'logSNR'),
+                                                       continuous=config.training.continuous,
+                                                       denoise=denoise,
+                                                       eps=eps,
+                                                       schedule=schedule if use_schedule else None)
+      return precision_lib.with_precision(sampling_fn, precision)
+
+    # Parallel-in-time Euler-Maruyama sampling by Picard iterations over windows of steps.
+    if sampler_name == 'picard':
+      if warm_start_t0 is not None:
+        raise ValueError('The warm start is not supported by the Picard sampler.')
+      sampling_fn = get_conditional_picard_sampler(sde=sde,
+                                                   shape=shape,
+                                                   p_steps=p_steps,
+                                                   window=config.sampling.get('picard_window', 16),
+                                                   tolerance=config.sampling.get('picard_tolerance', 0.1),
+                                                   probability_flow=config.sampling.probability_flow,
+                                                   continuous=config.training.continuous,
+                                                   denoise=denoise,
+                                                   eps=eps,
+                                                   schedule=schedule,
+                                                   tiling=tiling)
+      return precision_lib.with_precision(sampling_fn, precision)
     
     sampling_fn = get_pc_conditional_sampler(sde=sde, 
                                             shape = shape,
@@ -41,12 +102,22 @@ def get_conditional_sampling_fn(config, sde, shape, eps,
                                             continuous=config.training.continuous,
                                             denoise = denoise,
                                             use_path = use_path,
-                                            eps=eps)
-    return sampling_fn
+                                            eps=eps,
+                                            predictor_kwargs=adaptive.get_predictor_kwargs(config, predictor),
+                                            schedule=schedule,
+                                            corrector_schedule=schedules.get_corrector_schedule_fn(config, corrector_schedule),
+                                            warm_start_t0=warm_start_t0,
+                                            initial_estimate_fn=warm_start.get_initial_estimate_fn(config) if warm_start_t0 is not None else None,
+                                            inplace=config.sampling.get('inplace', False),
+                                            tiling=tiling,
+                                            compiler=compilation.get_step_compiler(config))
+    return precision_lib.with_precision(sampling_fn, precision)
 
 def get_pc_conditional_sampler(sde, shape, predictor, corrector, snr, p_steps,
                    c_steps=1, probability_flow=False, continuous=False, 
-                   denoise=True, use_path=False, eps=1e-5):
+                   denoise=True, use_path=False, eps=1e-5, predictor_kwargs=None, schedule=None,
+                   corrector_schedule=None, warm_start_t0=None, initial_estimate_fn=None, inplace=False,
+                   tiling=None, compiler=None):
 
   """Create a Predictor-Corrector (PC) sampler.
   Args:
@@ -54,202 +125,176 @@ def get_pc_conditional_sampler(sde, shape, predictor, corrector, snr, p_steps,
     shape: A sequence of integers. The expected shape of a single sample.
     predictor: A subclass of `sampling.Predictor` representing the predictor algorithm.
     corrector: A subclass of `sampling.Corrector` representing the corrector algorithm.
-    snr: A `float` number. The signal-to-noise ratio for configuring correctors.
+    snr: A `float` number or a tensor with the SNR of every sample. The signal-to-noise ratio for configuring correctors.
     c_steps: An integer. The number of corrector steps per predictor update.
     probability_flow: If `True`, solve the reverse-time probability flow ODE when running the predictor.
     continuous: `True` indicates that the score model was continuously trained.
     denoise: If `True`, add one-step denoising to the final samples.
     eps: A `float` number. The reverse-time SDE and ODE are integrated to `epsilon` to avoid numerical issues.
-    device: PyTorch device.
+    predictor_kwargs: Optional dict of extra arguments of the predictor. With an adaptive predictor
+      the fixed grid of `p_steps` times is replaced by adaptive step sizes.
+    schedule: The time schedule (see `sampling.schedules.get_timesteps`). Uniform if `None`.
+    corrector_schedule: A function (i, t) -> number of corrector updates before the i-th predictor
+      update (see `sampling.schedules.get_corrector_schedule_fn`). One update per step if `None`.
+    warm_start_t0: If given, the reverse process starts at `warm_start_t0` from the forward diffusion
+      of `initial_estimate_fn(y, x_shape)` instead of the prior at T, on the times of the grid <= warm_start_t0.
+    initial_estimate_fn: The initial estimate of x given y (see `sampling.warm_start.get_initial_estimate_fn`).
+    inplace: If `True`, the updates write into preallocated buffers (see `sampling.plan`).
+    tiling: If given, a function score_fn -> tiled score function (see `sampling.tiling.get_tiling_fn`).
+    compiler: Optional `sampling.compilation.StepCompiler` compiling the predictor and corrector updates.
   Returns:
     A conditional sampling function that returns samples and the number of function evaluations during sampling.
   """
-  # Create predictor & corrector update functions
-  predictor_update_fn = functools.partial(conditional_shared_predictor_update_fn,
-                                          sde=sde,
-                                          predictor=predictor,
-                                          probability_flow=probability_flow,
-                                          continuous=continuous)
-
-  corrector_update_fn = functools.partial(conditional_shared_corrector_update_fn,
-                                          sde=sde,
-                                          corrector=corrector,
-                                          continuous=continuous,
-                                          snr=snr,
-                                          n_steps=c_steps)
-
-  def get_conditional_update_fn(update_fn, sampler_type):
-    """Modify the update function of predictor & corrector to incorporate data information."""
-
-    if isinstance(sde, dict) and len(sde.keys())==2:
-      if use_path:
-        if sampler_type == 'predictor':
-          def conditional_update_fn(x, y, t, model, y_tplustau, tau):
-            with torch.no_grad():
-              vec_t = torch.ones(x.shape[0]).to(model.device) * t
-              vec_tau = torch.ones(x.shape[0]).to(model.device) * tau
-              y_t_mean, y_t_std = sde['y'].compute_backward_kernel(y, y_tplustau, vec_t, vec_tau)
-              y_t_perturbed = y_t_mean + torch.randn_like(y) * y_t_std[(...,) + (None,) * len(y.shape[1:])]
-              x, x_mean = update_fn(x=x, y=y_t_perturbed, t=vec_t, model=model)
-              return x, x_mean, y_t_perturbed
-        elif sampler_type == 'corrector':
-          #y_t is the sample from P(y_t|y_{t+tau}, y0). We do not resample that. 
-          #The mean and std that created y_t should be saved before. No need to return them with this function.
-          def conditional_update_fn(x, y_t, t, model):
-            vec_t = torch.ones(x.shape[0]).to(model.device) * t
-            return update_fn(x=x, y=y_t, t=vec_t, model=model)
-        else:
-          return NotImplementedError('Sampler type %s is not supported. Available sampler type options: [predictor, corrector]' % sampler_type)
-      else:
-        def conditional_update_fn(x, y, t, model):
-          with torch.no_grad():
-            vec_t = torch.ones(x.shape[0]).to(model.device) * t
-            y_mean, y_std = sde['y'].marginal_prob(y, vec_t)
-            y_perturbed = y_mean + torch.randn_like(y) * y_std[(...,) + (None,) * len(y.shape[1:])]
-            x, x_mean = update_fn(x=x, y=y_perturbed, t=vec_t, model=model)
-            return x, x_mean, y_perturbed, y_mean
-    else:
-      def conditional_update_fn(x, y, t, model):
-        with torch.no_grad():
-          vec_t = torch.ones(x.shape[0]).to(model.device) * t
-          x, x_mean = update_fn(x=x, y=y, t=vec_t, model=model)
-        return x, x_mean, y, y
-
-    return conditional_update_fn
-
-  predictor_conditional_update_fn = get_conditional_update_fn(predictor_update_fn, sampler_type='predictor')
-  corrector_conditional_update_fn = get_conditional_update_fn(corrector_update_fn, sampler_type='corrector')
-
   if use_path:
-    def pc_conditional_sampler(model, y, show_evolution=False):
+    def pc_conditional_sampler(model, y, show_evolution=False, checkpoint=None, seeds=None):
       """ The PC conditional sampler function.
       Args:
         model: A score model.
+        checkpoint: Optional `sampling.checkpoint.SamplingCheckpointer`. The trajectory continues
+          from its last snapshot and is snapshotted periodically.
+        seeds: Optional seed of every sample. The noise then comes from per-sample streams (see `sampling.rng`).
       Returns:
         Samples, number of function evaluations.
       """
 
-      #this function can be used for the exploration of variable correction schemes
-      #i.e. the num of correction steps is a function of the diffusion time. 
-      #This can possibly increase sampling speed or sampling quality. To be explored.
-      def corrections_steps(i):
-          return 1
-
       c_sde = sde['x'] if isinstance(sde, dict) else sde
+      recorder = evolution.get_recorder(show_evolution)
+      noise = rng.get_sample_noise(seeds)
 
       with torch.no_grad():
         # Initial sample
-        x = c_sde.prior_sampling(shape).to(model.device)
-
-        timesteps = torch.linspace(c_sde.T, eps, p_steps, device=model.device)
-        tau = timesteps[0]-timesteps[1]
+        timesteps = schedules.get_timesteps(c_sde, p_steps, eps, schedule, device=model.device)
+        if warm_start_t0 is None:
+          x = rng.prior_sampling(c_sde, shape, noise).to(model.device)
+        else:
+          timesteps, x = warm_start.warm_start(c_sde, initial_estimate_fn(y, shape), timesteps, warm_start_t0, noise)
+        num_steps = timesteps.size(0)
+        #the number of corrector updates is a function of the diffusion time
+        corrections_steps = schedules.get_corrector_budget(corrector_schedule, timesteps)
+        plan = ConditionalSamplingPlan(sde, model, predictor, corrector, timesteps, shape[0],
+                                       snr=snr, n_steps=c_steps, probability_flow=probability_flow, continuous=continuous,
+                                       predictor_kwargs=predictor_kwargs, inplace=inplace, tiling=tiling, noise=noise,
+                                       compiler=compiler)
+        if getattr(plan.predictor, 'adaptive', False):
+          if checkpoint is not None:
+            raise ValueError('Checkpointing is not supported by the adaptive solver.')
+          x, x_mean, sampling_info = adaptive.solve_reverse_sde(plan, x, eps, y=y, show_evolution=show_evolution)
+          return x_mean if denoise else x, sampling_info
+        #score evaluations: one per predictor update and n_steps per corrector update
+        nfe = num_steps + getattr(plan.corrector, 'n_steps', 0) * sum(corrections_steps)
+        #tau[i] is the gap between the i-th time of the grid and the previous one (T+tau[0] for the first)
+        taus = torch.cat([timesteps[:1] - timesteps[1:2], timesteps[:-1] - timesteps[1:]])
         T = timesteps[0]
-        y_tplustau_mean, y_tplustau_std  = sde['y'].marginal_prob(y, torch.ones(x.shape[0]).to(model.device) * (T+tau))
-        y_tplustau = y_tplustau_mean + torch.randn_like(y)*y_tplustau_std[(...,) + (None,) * len(y.shape[1:])]
-
-        if show_evolution:
-          evolution = {'x':[], 'y':[]}
-
-        for i in tqdm(range(p_steps)):
-          t = timesteps[i]
+        y_tplustau_mean, y_tplustau_std  = sde['y'].marginal_prob(y, torch.ones(x.shape[0]).to(model.device) * (T+taus[0]))
+        y_tplustau = y_tplustau_mean + plan.randn_like(y)*y_tplustau_std[(...,) + (None,) * len(y.shape[1:])]
+
+        start = 0
+        if checkpoint is not None:
+          fingerprint = checkpoint_lib.get_fingerprint(model, predictor=predictor, corrector=corrector, snr=snr, c_steps=c_steps,
+                                                       timesteps=timesteps, corrections_steps=corrections_steps, denoise=denoise,
+                                                       probability_flow=probability_flow, use_path=True, seeds=seeds, y=y)
+          state = checkpoint.load(model.device, num_steps, x.shape, noise, fingerprint)
+          if state is not None and state['done']:
+            return state['samples'], state['sampling_info']
+          if state is not None:
+            x, x_mean, y_tplustau, start = state['x'], state['x_mean'], state['y_tplustau'], state['step'] + 1
+
+        if recorder is not None:
+          recorder.start(num_steps)
+
+        for i in tqdm(range(start, num_steps)):
+          x, x_mean, y_tplustau = plan.path_predictor_step(i, x, y, y_tplustau, taus[i])
+
+          for _ in range(corrections_steps[i]):
+            x, x_mean = plan.path_corrector_step(i, x, y_tplustau)
           
-          x, x_mean, y_tplustau = predictor_conditional_update_fn(x, y, t, model, y_tplustau, tau)
+          if recorder is not None:
+            recorder.record(i, {'x': x, 'y': y_tplustau})
 
-          for _ in range(corrections_steps(i)):
-            x, x_mean = corrector_conditional_update_fn(x, y_tplustau, t, model)
-          
-          if show_evolution:
-            evolution['x'].append(x.cpu())
-            evolution['y'].append(y_tplustau.cpu())
+          if checkpoint is not None:
+            checkpoint.step(i, num_steps, x.shape, model.device, noise=noise, x=x, x_mean=x_mean, y_tplustau=y_tplustau)
 
-        print('torch.mean(torch.abs(y-y_tplustau)): %.8f' % torch.mean(torch.abs(y-y_tplustau)))
-
-        if show_evolution:
+        samples, sampling_info = x_mean if denoise else x, {'steps': nfe}
+        if checkpoint is not None:
+          checkpoint.finish(samples, sampling_info, num_steps, x.shape, model.device)
+        if recorder is not None:
           #check the effect of denoising
-          #evolution['x'].append(x_mean.cpu())
-          #evolution['y'].append(y_mean.cpu())
-
-          evolution['x'], evolution['y'] = torch.stack(evolution['x']), torch.stack(evolution['y'])
-          sampling_info = {'evolution': evolution}
-          return x_mean if denoise else x, sampling_info
-        else:
-          return x_mean if denoise else x, {}
+          #recorder.record(num_steps, {'x': x_mean, 'y': y_mean})
+          evolution.add_to_sampling_info(sampling_info, recorder)
+        return samples, sampling_info
           
     return pc_conditional_sampler
   else:
-    def pc_conditional_sampler(model, y, show_evolution=False):
+    def pc_conditional_sampler(model, y, show_evolution=False, checkpoint=None, seeds=None):
       """ The PC conditional sampler function.
       Args:
         model: A score model.
+        checkpoint: Optional `sampling.checkpoint.SamplingCheckpointer`. The trajectory continues
+          from its last snapshot and is snapshotted periodically.
+        seeds: Optional seed of every sample. The noise then comes from per-sample streams (see `sampling.rng`).
       Returns:
         Samples, number of function evaluations.
       """
 
-      #this function can be used for the exploration of variable correction schemes
-      #i.e. the num of correction steps is a function of the diffusion time. 
-      #This can possibly increase sampling speed or sampling quality. To be explored.
-      def corrections_steps(i):
-          return 1
-
       c_sde = sde['x'] if isinstance(sde, dict) else sde
+      recorder = evolution.get_recorder(show_evolution)
+      noise = rng.get_sample_noise(seeds)
 
       with torch.no_grad():
         # Initial sample
-        x = c_sde.prior_sampling(shape).to(model.device)
-        if show_evolution:
-          evolution = {'x':[], 'y':[]}
-
-        timesteps = torch.linspace(c_sde.T, eps, p_steps, device=model.device)
-
-        for i in tqdm(range(p_steps)):
-          t = timesteps[i]
-          #vec_t = torch.ones(shape[0], device=model.device) * t
-
-          for _ in range(corrections_steps(i)):
-            x, x_mean, y_perturbed, y_mean = corrector_conditional_update_fn(x, y, t, model)
-
-          x, x_mean, y_perturbed, y_mean = predictor_conditional_update_fn(x, y, t, model)
+        timesteps = schedules.get_timesteps(c_sde, p_steps, eps, schedule, device=model.device)
+        if warm_start_t0 is None:
+          x = rng.prior_sampling(c_sde, shape, noise).to(model.device)
+        else:
+          timesteps, x = warm_start.warm_start(c_sde, initial_estimate_fn(y, shape), timesteps, warm_start_t0, noise)
+        num_steps = timesteps.size(0)
+        #the number of corrector updates is a function of the diffusion time
+        corrections_steps = schedules.get_corrector_budget(corrector_schedule, timesteps)
+        plan = ConditionalSamplingPlan(sde, model, predictor, corrector, timesteps, shape[0],
+                                       snr=snr, n_steps=c_steps, probability_flow=probability_flow, continuous=continuous,
+                                       predictor_kwargs=predictor_kwargs, inplace=inplace, tiling=tiling, noise=noise,
+                                       compiler=compiler)
+        if getattr(plan.predictor, 'adaptive', False):
+          if checkpoint is not None:
+            raise ValueError('Checkpointing is not supported by the adaptive solver.')
+          x, x_mean, sampling_info = adaptive.solve_reverse_sde(plan, x, eps, y=y, show_evolution=show_evolution)
+          return x_mean if denoise else x, sampling_info
+        #score evaluations: one per predictor update and n_steps per corrector update
+        nfe = num_steps + getattr(plan.corrector, 'n_steps', 0) * sum(corrections_steps)
+
+        start = 0
+        if checkpoint is not None:
+          fingerprint = checkpoint_lib.get_fingerprint(model, predictor=predictor, corrector=corrector, snr=snr, c_steps=c_steps,
+                                                       timesteps=timesteps, corrections_steps=corrections_steps, denoise=denoise,
+                                                       probability_flow=probability_flow, use_path=False, seeds=seeds, y=y)
+          state = checkpoint.load(model.device, num_steps, x.shape, noise, fingerprint)
+          if state is not None and state['done']:
+            return state['samples'], state['sampling_info']
+          if state is not None:
+            x, x_mean, start = state['x'], state['x_mean'], state['step'] + 1
+
+        if recorder is not None:
+          recorder.start(num_steps)
+
+        for i in tqdm(range(start, num_steps)):
+          for _ in range(corrections_steps[i]):
+            x, x_mean, y_perturbed, y_mean = plan.corrector_step(i, x, y)
+
+          x, x_mean, y_perturbed, y_mean = plan.predictor_step(i, x, y)
           
-          if show_evolution:
-            evolution['x'].append(x.cpu())
-            evolution['y'].append(y_perturbed.cpu())
+          if recorder is not None:
+            recorder.record(i, {'x': x, 'y': y_perturbed})
 
-        if show_evolution:
-          #check the effect of denoising
-          #evolution['x'].append(x_mean.cpu())
-          #evolution['y'].append(y_mean.cpu())
+          if checkpoint is not None:
+            checkpoint.step(i, num_steps, x.shape, model.device, noise=noise, x=x, x_mean=x_mean)
 
-          evolution['x'], evolution['y'] = torch.stack(evolution['x']), torch.stack(evolution['y'])
-          sampling_info = {'evolution': evolution}
-          return x_mean if denoise else x, sampling_info
-        else:
-          return x_mean if denoise else x, {}
+        samples, sampling_info = x_mean if denoise else x, {'steps': nfe}
+        if checkpoint is not None:
+          checkpoint.finish(samples, sampling_info, num_steps, x.shape, model.device)
+        if recorder is not None:
+          #check the effect of denoising
+          #recorder.record(num_steps, {'x': x_mean, 'y': y_mean})
+          evolution.add_to_sampling_info(sampling_info, recorder)
+        return samples, sampling_info
           
     return pc_conditional_sampler
-
-def conditional_shared_predictor_update_fn(x, y, t, sde, model, predictor, probability_flow, continuous):
-  """A wrapper that configures and returns the update function of predictors."""
-  score_fn = mutils.get_score_fn(sde, model, conditional=True, train=False, continuous=continuous)
-  score_fn = mutils.get_conditional_score_fn(score_fn, target_domain='x')
-
-  c_sde = sde['x'] if isinstance(sde, dict) else sde
-  if predictor is None:
-    # Corrector-only sampler
-    predictor_obj = NonePredictor(c_sde, score_fn, probability_flow)
-  else:
-    predictor_obj = predictor(c_sde, score_fn, probability_flow)
-
-  return predictor_obj.update_fn(x, y, t)
-
-def conditional_shared_corrector_update_fn(x, y, t, sde, model, corrector, continuous, snr, n_steps):
-  """A wrapper that configures and returns the update function of correctors."""
-  score_fn = mutils.get_score_fn(sde, model, conditional=True, train=False, continuous=continuous)
-  score_fn = mutils.get_conditional_score_fn(score_fn, target_domain='x')
-
-  c_sde = sde['x'] if isinstance(sde, dict) else sde
-  if corrector is None:
-    # Predictor-only sampler
-    corrector_obj = NoneCorrector(c_sde, score_fn, snr, n_steps)
-  else:
-    corrector_obj = corrector(c_sde, score_fn, snr, n_steps)
-  return corrector_obj.update_fn(x, y, t)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import abc
 import torch
 import sde_lib
+from sampling import rng
 
 _CORRECTORS = {}
 
@@ -26,22 +27,57 @@ def register_corrector(cls=None, *, name=None):
 def get_corrector(name):
   return _CORRECTORS[name]
 
+
+def get_snr_groups(snr):
+  """The SNR group of every sample for a per-sample SNR tensor, `None` for a scalar SNR."""
+  if not torch.is_tensor(snr) or snr.dim() == 0:
+    return None
+  return torch.unique(snr, return_inverse=True)[1]
+
+
+def batch_norm_means(grad, noise, snr_groups=None):
+  """Mean norms of the score and the noise over the batch, or over the samples sharing the SNR of
+  every sample, so that a batch of K SNRs takes the same steps as K separate runs."""
+  grad_norm = torch.norm(grad.reshape(grad.shape[0], -1), dim=-1)
+  noise_norm = torch.norm(noise.reshape(noise.shape[0], -1), dim=-1)
+  if snr_groups is None:
+    return grad_norm.mean(), noise_norm.mean()
+  counts = torch.bincount(snr_groups).to(grad_norm.dtype)
+  grad_means = torch.zeros_like(counts).index_add_(0, snr_groups, grad_norm) / counts
+  noise_means = torch.zeros_like(counts).index_add_(0, snr_groups, noise_norm) / counts
+  return grad_means[snr_groups], noise_means[snr_groups]
+
+def inplace_langevin_update(buffers, x, grad, noise, step_size):
+  """Langevin step x_mean = x + step_size * grad, x = x_mean + sqrt(2 * step_size) * noise into the buffers 'x_mean' and 'x'."""
+  expand = (...,) + (None,) * len(x.shape[1:])
+  x_mean = torch.addcmul(x, grad, step_size[expand], out=buffers.get('x_mean', x))
+  return torch.addcmul(x_mean, noise, torch.sqrt(step_size * 2)[expand], out=buffers.get('x', x)), x_mean
+
 class Corrector(abc.ABC):
-  """The abstract class for a corrector algorithm."""
+  """The abstract class for a corrector algorithm.
+  `snr` is a float or a tensor with the SNR of every sample of the batch.
+  """
 
   def __init__(self, sde, score_fn, snr, n_steps):
     super().__init__()
     self.sde = sde
     self.score_fn = score_fn
     self.snr = snr
+    self.snr_groups = get_snr_groups(snr)
     self.n_steps = n_steps
+    # `sampling.plan.StepBuffers` of the in-place mode, set by the sampling plan.
+    self.buffers = None
+    # Per-sample noise streams (`sampling.rng.SampleNoise`), set by the sampling plan. Global RNG if `None`.
+    self.noise = None
 
   @abc.abstractmethod
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     """One update of the corrector.
     Args:
       x: A PyTorch tensor representing the current state
       t: A PyTorch tensor representing the current time step.
+      coeffs: Optional dict with the precomputed coefficients of the current step
+        (one row of `sde.get_step_coefficients`). If `None`, they are looked up from `t`.
     Returns:
       x: A PyTorch tensor of the next state.
       x_mean: A PyTorch tensor. The next state without random noise. Useful for denoising.
@@ -55,23 +91,27 @@ class LangevinCorrector(Corrector):
     if not isinstance(sde, (sde_lib.VPSDE, sde_lib.VESDE, sde_lib.subVPSDE)):
       raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
 
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     sde = self.sde
     score_fn = self.score_fn
     n_steps = self.n_steps
     target_snr = self.snr
-    if isinstance(sde, sde_lib.VPSDE) or isinstance(sde, sde_lib.subVPSDE):
+    if coeffs is not None:
+      alpha = coeffs['alpha']
+    elif isinstance(sde, sde_lib.VPSDE) or isinstance(sde, sde_lib.subVPSDE):
       timestep = (t * (sde.N - 1) / sde.T).long()
-      alpha = sde.alphas.to(t.device)[timestep]
+      alpha = sde.get_buffer('alphas', t.device)[timestep]
     else:
       alpha = torch.ones_like(t)
 
     for i in range(n_steps):
       grad = score_fn(x, t)
-      noise = torch.randn_like(x)
-      grad_norm = torch.norm(grad.reshape(grad.shape[0], -1), dim=-1).mean()
-      noise_norm = torch.norm(noise.reshape(noise.shape[0], -1), dim=-1).mean()
+      noise = rng.randn_like(x, self.noise) if self.buffers is None else self.buffers.randn('noise', x)
+      grad_norm, noise_norm = batch_norm_means(grad, noise, self.snr_groups)
       step_size = (target_snr * noise_norm / grad_norm) ** 2 * 2 * alpha
+      if self.buffers is not None:
+        x, x_mean = inplace_langevin_update(self.buffers, x, grad, noise, step_size)
+        continue
       x_mean = x + step_size[(...,) + (None,) * len(x.shape[1:])] * grad
       x = x_mean + torch.sqrt(step_size * 2)[(...,) + (None,) * len(x.shape[1:])] * noise
 
@@ -85,23 +125,27 @@ class conditionalLangevinCorrector(Corrector):
     if not isinstance(sde, (sde_lib.cVESDE, sde_lib.cVPSDE)):
       raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
 
-  def update_fn(self, x, y, t):
+  def update_fn(self, x, y, t, coeffs=None):
     sde = self.sde
     score_fn = self.score_fn
     n_steps = self.n_steps
     target_snr = self.snr
-    if isinstance(sde, sde_lib.cVPSDE):
+    if coeffs is not None:
+      alpha = coeffs['alpha']
+    elif isinstance(sde, sde_lib.cVPSDE):
       timestep = (t * (sde.N - 1) / sde.T).long()
-      alpha = sde.alphas.to(t.device)[timestep]
+      alpha = sde.get_buffer('alphas', t.device)[timestep]
     else:
       alpha = torch.ones_like(t)
 
     for i in range(n_steps):
       grad = score_fn(x, y, t)
-      noise = torch.randn_like(x)
-      grad_norm = torch.norm(grad.reshape(grad.shape[0], -1), dim=-1).mean()
-      noise_norm = torch.norm(noise.reshape(noise.shape[0], -1), dim=-1).mean()
+      noise = rng.randn_like(x, self.noise) if self.buffers is None else self.buffers.randn('noise', x)
+      grad_norm, noise_norm = batch_norm_means(grad, noise, self.snr_groups)
       step_size = (target_snr * noise_norm / grad_norm) ** 2 * 2 * alpha
+      if self.buffers is not None:
+        x, x_mean = inplace_langevin_update(self.buffers, x, grad, noise, step_size)
+        continue
       x_mean = x + step_size[(...,) + (None,) * len(x.shape[1:])] * grad
       x = x_mean + torch.sqrt(step_size * 2)[(...,) + (None,) * len(x.shape[1:])] * noise
 
@@ -119,22 +163,24 @@ class AnnealedLangevinDynamics(Corrector):
     if not isinstance(sde, (sde_lib.VPSDE, sde_lib.VESDE, sde_lib.subVPSDE)):
       raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
 
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     sde = self.sde
     score_fn = self.score_fn
     n_steps = self.n_steps
     target_snr = self.snr
-    if isinstance(sde, sde_lib.VPSDE) or isinstance(sde, sde_lib.subVPSDE):
+    if coeffs is not None:
+      alpha = coeffs['alpha']
+    elif isinstance(sde, sde_lib.VPSDE) or isinstance(sde, sde_lib.subVPSDE):
       timestep = (t * (sde.N - 1) / sde.T).long()
-      alpha = sde.alphas.to(t.device)[timestep]
+      alpha = sde.get_buffer('alphas', t.device)[timestep]
     else:
       alpha = torch.ones_like(t)
 
-    std = self.sde.marginal_prob(x, t)[1]
+    std = coeffs['std'] if coeffs is not None else self.sde.marginal_prob(x, t)[1]
 
     for i in range(n_steps):
       grad = score_fn(x, t)
-      noise = torch.randn_like(x)
+      noise = rng.randn_like(x, self.noise)
       step_size = (target_snr * std) ** 2 * 2 * alpha
       x_mean = x + step_size[(...,) + (None,) * len(x.shape[1:])] * grad
       x = x_mean + noise * torch.sqrt(step_size * 2)[(...,) + (None,) * len(x.shape[1:])]
@@ -149,7 +195,7 @@ class NoneCorrector(Corrector):
   def __init__(self, sde, score_fn, snr, n_steps):
     pass
 
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     return x, x
 
 #use this none corrector for conditional settings
@@ -160,5 +206,5 @@ class NoneCorrector(Corrector):
   def __init__(self, sde, score_fn, snr, n_steps):
     pass
 
-  def update_fn(self, x, y, t):
+  def update_fn(self, x, y, t, coeffs=None):
     return x, x
\ No newline at end of file
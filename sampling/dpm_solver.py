@@ -0,0 +1,230 @@
+"""Multistep DPM-Solver++ for the probability flow ODE of VE/VP SDEs.
+
+The probability flow ODE of the linear SDEs is semi-linear. Written in the half log-SNR
+lambda = log(mean_coeff / std) and in terms of the data prediction
+x_0 = (x + std^2 * score) / mean_coeff, its linear part is integrated exactly and only the data
+prediction is approximated by a polynomial (Lu et al., "DPM-Solver++", 2022). The multistep
+variant reuses the data predictions of the previous steps for the higher-order terms, so every
+step costs a single score evaluation.
+"""
+import torch
+import numpy as np
+from tqdm import tqdm
+
+import sde_lib
+from models import utils as mutils
+from sampling import schedules
+from sampling import evolution
+from sampling import rng
+
+
+def _check_sde(sde):
+  if not isinstance(sde, (sde_lib.VESDE, sde_lib.cVESDE, sde_lib.VPSDE, sde_lib.cVPSDE)):
+    raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
+
+
+def marginal_lambda(sde, t):
+  """Half log-SNR lambda(t) = log(mean_coeff(t) / std(t)) of the perturbation kernel."""
+  mean_coeff, std = sde.marginal_prob(torch.ones_like(t), t)
+  return torch.log(mean_coeff) - torch.log(std)
+
+
+def inverse_lambda(sde, lambdas):
+  """The time t with half log-SNR `lambdas`. Inverse of `marginal_lambda`."""
+  if isinstance(sde, (sde_lib.VESDE, sde_lib.cVESDE)):
+    return (-lambdas - np.log(sde.sigma_min)) / (np.log(sde.sigma_max) - np.log(sde.sigma_min))
+  elif isinstance(sde, (sde_lib.VPSDE, sde_lib.cVPSDE)):
+    log_mean_coeff = -0.5 * torch.logaddexp(torch.zeros_like(lambdas), -2. * lambdas)
+    delta = sde.beta_1 - sde.beta_0
+    return 2. * (torch.sqrt(0.25 * sde.beta_0 ** 2 - delta * log_mean_coeff) - 0.5 * sde.beta_0) / delta
+  else:
+    raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
+
+
+def get_time_steps(sde, steps, eps, skip_type='logSNR', device='cpu', schedule=None):
+  """The `steps + 1` times of the solver, from `sde.t_start` (the time of the prior) down to `eps`.
+  Args:
+    skip_type: 'logSNR' spaces the times uniformly in lambda, 'time_uniform' uniformly in t.
+    schedule: If given, a schedule of `sampling.schedules` that replaces `skip_type`.
+  """
+  if schedule is not None:
+    return schedules.get_timesteps(sde, steps + 1, eps, schedule, device=device)
+  if skip_type == 'logSNR':
+    t_bounds = torch.tensor([sde.t_start, eps], dtype=torch.float64)
+    lambda_T, lambda_eps = marginal_lambda(sde, t_bounds)
+    lambdas = torch.linspace(lambda_T.item(), lambda_eps.item(), steps + 1, dtype=torch.float64)
+    timesteps = inverse_lambda(sde, lambdas)
+    # Pin the end points against round-off of the inversion.
+    timesteps[0], timesteps[-1] = sde.t_start, eps
+  elif skip_type == 'time_uniform':
+    timesteps = torch.linspace(sde.t_start, eps, steps + 1, dtype=torch.float64)
+  else:
+    raise ValueError(f"Skip type {skip_type} unknown.")
+  return timesteps.to(device=device, dtype=torch.float32)
+
+
+def multistep_dpm_solver_update(x, x0_preds, lambdas, mean_coeff, std, order):
+  """One multistep DPM-Solver++ step.
+  Args:
+    x: The current state at time s_0.
+    x0_preds: The data predictions at s_0, s_1, ... (newest first), at least `order` of them.
+    lambdas: Half log-SNRs at t, s_0, s_1, ... .
+    mean_coeff: Mean coefficient of the perturbation kernel at t and s_0.
+    std: Std of the perturbation kernel at t and s_0.
+    order: 1, 2 or 3.
+  Returns:
+    The state at time t.
+  """
+  h = lambdas[0] - lambdas[1]
+  phi_1 = torch.expm1(-h)
+  x_t = (std[0] / std[1]) * x - mean_coeff[0] * phi_1 * x0_preds[0]
+  if order == 1:
+    return x_t
+
+  r0 = (lambdas[1] - lambdas[2]) / h
+  D1_0 = (x0_preds[0] - x0_preds[1]) / r0
+  if order == 2:
+    return x_t - 0.5 * mean_coeff[0] * phi_1 * D1_0
+
+  r1 = (lambdas[2] - lambdas[3]) / h
+  D1_1 = (x0_preds[1] - x0_preds[2]) / r1
+  D1 = D1_0 + r0 / (r0 + r1) * (D1_0 - D1_1)
+  D2 = (D1_0 - D1_1) / (r0 + r1)
+  phi_2 = phi_1 / h + 1.
+  phi_3 = phi_2 / h - 0.5
+  return x_t + mean_coeff[0] * phi_2 * D1 - mean_coeff[0] * phi_3 * D2
+
+
+def multistep_dpm_solver(data_pred_fn, sde, x, timesteps, order=2, lower_order_final=True,
+                         denoise=False, show_evolution=False, frame_fn=None):
+  """Integrate the probability flow ODE from timesteps[0] to timesteps[-1].
+  Args:
+    data_pred_fn: A function (x, vec_t, i) -> prediction of x_0 at the i-th time of `timesteps`.
+    sde: The `sde_lib.SDE` of x.
+    x: The initial state at timesteps[0].
+    timesteps: A 1-D PyTorch tensor with the times of the solver.
+    order: The order of the multistep solver (1, 2 or 3). The first steps use lower orders.
+    lower_order_final: If `True`, the last steps of short runs (< 15 steps) use lower orders,
+      which is more stable for very few steps.
+    denoise: If `True`, return the data prediction at the final time (one more evaluation).
+    show_evolution: If `True` or an `EvolutionRecorder`, record the state after the steps.
+    frame_fn: Optional function (x, i) -> recorded frame of the state at the i-th time.
+  Returns:
+    The final state, the number of function evaluations and the recorder (or `None`).
+  """
+  if order not in (1, 2, 3):
+    raise ValueError(f"DPM-Solver order {order} not supported.")
+  steps = timesteps.size(0) - 1
+  ones = torch.ones(x.shape[0], device=x.device)
+  mean_coeff, std = sde.marginal_prob(torch.ones_like(timesteps), timesteps)
+  lambdas = torch.log(mean_coeff) - torch.log(std)
+
+  recorder = evolution.get_recorder(show_evolution)
+  if recorder is not None:
+    recorder.start(steps)
+  x0_preds = [data_pred_fn(x, ones * timesteps[0], 0)]
+  nfe = 1
+  for i in tqdm(range(1, steps + 1)):
+    step_order = min(order, i)
+    if lower_order_final and steps < 15:
+      step_order = min(step_order, steps + 1 - i)
+    x = multistep_dpm_solver_update(x, x0_preds, lambdas[[i - k for k in range(step_order + 1)]],
+                                    mean_coeff[[i, i - 1]], std[[i, i - 1]], step_order)
+    if recorder is not None and recorder.should_record(i - 1):
+      recorder.record(i - 1, frame_fn(x, i) if frame_fn is not None else x)
+    if i < steps or denoise:
+      # The data prediction at the new time is cached for the higher-order terms of the next step.
+      x0_preds = [data_pred_fn(x, ones * timesteps[i], i)] + x0_preds[:order - 1]
+      nfe += 1
+
+  if denoise:
+    x = x0_preds[0]
+  return x, nfe, recorder
+
+
+def get_dpm_solver_sampler(sde, shape, steps=20, order=2, skip_type='logSNR',
+                           lower_order_final=True, continuous=False, denoise=False, eps=1e-3, schedule=None):
+  """Create a multistep DPM-Solver++ sampler for the probability flow ODE.
+  Args:
+    sde: An `sde_lib.SDE` object representing the forward SDE (VE or VP).
+    shape: A sequence of integers. The expected shape of a single sample.
+    steps: An integer. The number of solver steps (one score evaluation each).
+    order: An integer. The order of the multistep solver (1, 2 or 3).
+    skip_type: 'logSNR' or 'time_uniform' spacing of the times.
+    schedule: Optional schedule of `sampling.schedules`, used instead of `skip_type`.
+    lower_order_final: Use lower orders for the last steps of short runs.
+    continuous: `True` indicates that the score model was continuously trained.
+    denoise: If `True`, return the data prediction at `eps`.
+    eps: A `float` number. The ODE is integrated to `eps` to avoid numerical issues.
+  Returns:
+    A sampling function that returns samples and the sampling information.
+  """
+  _check_sde(sde)
+
+  def dpm_solver_sampler(model, show_evolution=False, checkpoint=None, seeds=None):
+    if checkpoint is not None:
+      raise ValueError('Checkpointing is not supported by the DPM-Solver sampler.')
+    noise = rng.get_sample_noise(seeds)
+    with torch.no_grad():
+      x = rng.prior_sampling(sde, shape, noise).to(model.device).type(torch.float32)
+      timesteps = get_time_steps(sde, steps, eps, skip_type, device=model.device, schedule=schedule)
+      score_fn = mutils.get_score_fn(sde, model, conditional=False, train=False, continuous=continuous)
+      mean_coeff, std = sde.marginal_prob(torch.ones_like(timesteps), timesteps)
+
+      def data_pred_fn(x, vec_t, i):
+        return (x + std[i] ** 2 * score_fn(x, vec_t)) / mean_coeff[i]
+
+      x, nfe, recorder = multistep_dpm_solver(data_pred_fn, sde, x, timesteps, order,
+                                              lower_order_final, denoise, show_evolution)
+      sampling_info = {'times': timesteps, 'steps': nfe}
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return x, sampling_info
+
+  return dpm_solver_sampler
+
+
+def get_conditional_dpm_solver_sampler(sde, shape, steps=20, order=2, skip_type='logSNR',
+                                       lower_order_final=True, continuous=False, denoise=False, eps=1e-5,
+                                       schedule=None):
+  """Create a multistep DPM-Solver++ sampler for the conditional probability flow ODE.
+  `sde` is either a single conditional SDE (SR3 conditioning) or a dict of SDEs with keys 'x' and
+  'y'. In the latter case the condition follows a single path of its forward diffusion,
+  y_t = mean_coeff_y(t) * y + std_y(t) * z with a fixed z, so that the ODE stays smooth in t.
+  The remaining arguments are the same as in `get_dpm_solver_sampler`.
+  Returns:
+    A conditional sampling function that returns samples and the sampling information.
+  """
+  c_sde = sde['x'] if isinstance(sde, dict) else sde
+  diffuse_y = isinstance(sde, dict) and len(sde.keys()) == 2
+  _check_sde(c_sde)
+
+  def dpm_solver_conditional_sampler(model, y, show_evolution=False, checkpoint=None, seeds=None):
+    if checkpoint is not None:
+      raise ValueError('Checkpointing is not supported by the DPM-Solver sampler.')
+    noise = rng.get_sample_noise(seeds)
+    with torch.no_grad():
+      x = rng.prior_sampling(c_sde, shape, noise).to(model.device)
+      timesteps = get_time_steps(c_sde, steps, eps, skip_type, device=model.device, schedule=schedule)
+      score_fn = mutils.get_score_fn(sde, model, conditional=True, train=False, continuous=continuous)
+      score_fn = mutils.get_conditional_score_fn(score_fn, target_domain='x')
+      mean_coeff, std = c_sde.marginal_prob(torch.ones_like(timesteps), timesteps)
+      if diffuse_y:
+        y_mean_coeff, y_std = sde['y'].marginal_prob(torch.ones_like(timesteps), timesteps)
+        z_y = rng.randn_like(y, noise)
+
+      def condition(i):
+        return y_mean_coeff[i] * y + y_std[i] * z_y if diffuse_y else y
+
+      def data_pred_fn(x, vec_t, i):
+        return (x + std[i] ** 2 * score_fn(x, condition(i), vec_t)) / mean_coeff[i]
+
+      x, nfe, recorder = multistep_dpm_solver(data_pred_fn, c_sde, x, timesteps, order,
+                                              lower_order_final, denoise, show_evolution,
+                                              frame_fn=lambda x, i: {'x': x, 'y': condition(i)})
+      sampling_info = {'times': timesteps, 'steps': nfe}
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return x, sampling_info
+
+  return dpm_solver_conditional_sampler
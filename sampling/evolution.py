@@ -0,0 +1,175 @@
+"""Bounded-memory recording of the sampling trajectory (`show_evolution`).
+
+The samplers accept either a boolean or an `EvolutionRecorder` as `show_evolution`. `True` keeps
+every step in float32, as before. A recorder can keep every `stride`-th step or a fixed number of
+frames, quantise them to float16 or uint8 on the sampling device before the transfer to the host,
+keep only the latest frames in a ring buffer and stream the frames to a file as they are produced.
+"""
+import math
+import pickle
+import torch
+
+_DTYPES = {None: None, 'float32': None, 'float16': torch.float16, 'uint8': torch.uint8}
+
+
+def quantise(x, dtype):
+  """Quantise a batch of states. uint8 frames keep a per-sample offset and scale.
+  Returns:
+    The quantised states and the (offset, scale) of every sample (`None` for float frames).
+  """
+  if dtype is None:
+    return x.float(), None
+  if dtype == torch.float16:
+    return x.half(), None
+  flat = x.reshape(x.shape[0], -1).float()
+  low = flat.min(dim=1).values
+  scale = torch.clamp((flat.max(dim=1).values - low) / 255., min=1e-12)
+  expand = (...,) + (None,) * len(x.shape[1:])
+  q = torch.round((x - low[expand]) / scale[expand]).to(torch.uint8)
+  return q, (low, scale)
+
+
+def dequantise(q, affine):
+  if affine is None:
+    return q.float()
+  low, scale = affine
+  expand = (...,) + (None,) * len(q.shape[1:])
+  return q.float() * scale[expand] + low[expand]
+
+
+class EvolutionRecorder:
+  """Records states of a sampler with a bounded memory footprint."""
+
+  def __init__(self, stride=1, max_frames=None, dtype=None, buffer_size=None, path=None):
+    """Configure the recorder.
+    Args:
+      stride: Record every `stride`-th step. The last step is always recorded.
+      max_frames: If given, the stride is increased so that at most about `max_frames` frames
+        are recorded in a run of known length.
+      dtype: `None`/'float32', 'float16' or 'uint8'. The storage type of the frames.
+      buffer_size: If given, only the latest `buffer_size` frames are kept in memory.
+      path: If given, every recorded frame is appended to this file (see `load_evolution`).
+        Without `buffer_size` the frames are then not kept in memory.
+    """
+    if dtype not in _DTYPES:
+      raise ValueError(f'Evolution dtype {dtype} not supported.')
+    self.base_stride = max(1, int(stride))
+    self.max_frames = max_frames
+    self.dtype = _DTYPES[dtype]
+    self.buffer_size = buffer_size
+    self.path = path
+    self.keep_in_memory = path is None or buffer_size is not None
+    self.start()
+
+  def start(self, num_steps=None):
+    """Reset the recorder for a run of `num_steps` recordable steps (`None` if unknown)."""
+    self.num_steps = num_steps
+    self.stride = self.base_stride
+    if self.max_frames is not None and num_steps is not None:
+      self.stride = max(self.stride, math.ceil(num_steps / self.max_frames))
+    self.frames = []
+    self.steps = []
+    self.count = 0
+    self.close()
+    if self.path is not None:
+      self.file = open(self.path, 'wb')
+
+  def close(self):
+    if getattr(self, 'file', None) is not None:
+      self.file.close()
+    self.file = None
+
+  def should_record(self, i):
+    return i % self.stride == 0 or (self.num_steps is not None and i == self.num_steps - 1)
+
+  def record(self, i, state):
+    """Record the state (a tensor or a dict of tensors) of the i-th step if it is due."""
+    if not self.should_record(i):
+      return
+    if isinstance(state, dict):
+      frame = {key: self._quantise_to_cpu(value) for key, value in state.items()}
+    else:
+      frame = self._quantise_to_cpu(state)
+
+    if self.file is not None:
+      pickle.dump((i, frame), self.file)
+    if self.keep_in_memory:
+      if self.buffer_size is not None and len(self.frames) == self.buffer_size:
+        self.frames[self.count % self.buffer_size] = frame
+        self.steps[self.count % self.buffer_size] = i
+      else:
+        self.frames.append(frame)
+        self.steps.append(i)
+    self.count += 1
+
+  def _quantise_to_cpu(self, x):
+    q, affine = quantise(x.detach(), self.dtype)
+    if affine is not None:
+      affine = tuple(a.cpu() for a in affine)
+    q = q.cpu()
+    #the in-place samplers overwrite their state buffers on every step, so a frame must not share them
+    if q.data_ptr() == x.data_ptr():
+      q = q.clone()
+    return q, affine
+
+  def get_steps(self):
+    """The steps of the frames held in memory, in chronological order."""
+    return self._chronological(self.steps)
+
+  def get(self):
+    """The recorded frames held in memory as a float32 tensor (or dict of tensors) of shape
+    (frames, batch, ...), in chronological order. `None` if the frames were only streamed."""
+    self.close()
+    if not self.keep_in_memory or not self.frames:
+      return None
+    return stack_frames(self._chronological(self.frames))
+
+  def _chronological(self, items):
+    if self.buffer_size is not None and self.count > self.buffer_size:
+      start = self.count % self.buffer_size
+      return items[start:] + items[:start]
+    return list(items)
+
+
+def stack_frames(frames):
+  if isinstance(frames[0], dict):
+    return {key: torch.stack([dequantise(*frame[key]) for frame in frames]) for key in frames[0]}
+  return torch.stack([dequantise(*frame) for frame in frames])
+
+
+def load_evolution(path):
+  """Load the frames streamed by an `EvolutionRecorder`. Returns the stacked frames and their steps."""
+  steps, frames = [], []
+  with open(path, 'rb') as f:
+    while True:
+      try:
+        i, frame = pickle.load(f)
+      except EOFError:
+        break
+      steps.append(i)
+      frames.append(frame)
+  return stack_frames(frames), steps
+
+
+def get_recorder(show_evolution):
+  """The recorder of a sampler call. `show_evolution` is a boolean or an `EvolutionRecorder`."""
+  if isinstance(show_evolution, EvolutionRecorder):
+    return show_evolution
+  return EvolutionRecorder() if show_evolution else None
+
+
+def get_evolution_recorder(config):
+  """The recorder of the visualization callbacks, configured by `config.sampling`: evolution_stride,
+  evolution_max_frames (default 200), evolution_dtype, evolution_buffer_size and evolution_file."""
+  return EvolutionRecorder(stride=config.sampling.get('evolution_stride', 1),
+                           max_frames=config.sampling.get('evolution_max_frames', 200),
+                           dtype=config.sampling.get('evolution_dtype', None),
+                           buffer_size=config.sampling.get('evolution_buffer_size', None),
+                           path=config.sampling.get('evolution_file', None))
+
+
+def add_to_sampling_info(sampling_info, recorder):
+  """Add the frames held by `recorder` and their steps to the sampling information."""
+  sampling_info['evolution'] = recorder.get()
+  sampling_info['evolution_steps'] = recorder.get_steps()
+  return sampling_info
@@ -0,0 +1,288 @@
+"""Torch-native adaptive ODE solvers.
+
+The probability flow samplers used to hand the whole batch to `scipy.integrate.solve_ivp`,
+which copies the state to the host (as float64 numpy) on every function evaluation.
+The solvers in this module keep the state on the device of `y0` and only synchronise
+a scalar error norm per step to decide whether the step is accepted.
+"""
+import collections
+
+import numpy as np
+import torch
+
+ODESolution = collections.namedtuple('ODESolution', ['t', 'y', 'nfev', 'status', 'success'])
+
+# Dormand-Prince 5(4) tableau. Same coefficients as `scipy.integrate.RK45`.
+_RK45_C = [0., 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.]
+_RK45_A = [[],
+           [1 / 5],
+           [3 / 40, 9 / 40],
+           [44 / 45, -56 / 15, 32 / 9],
+           [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+           [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]]
+_RK45_B = [35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]
+# Difference between the 5th order solution and the embedded 4th order solution (including the FSAL stage).
+_RK45_E = [-71 / 57600, 0., 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40]
+_RK45_ERROR_ESTIMATOR_ORDER = 4
+
+_SAFETY = 0.9
+_MIN_FACTOR = 0.2
+_MAX_FACTOR = 10.
+
+
+def rms_norm(x):
+  """Root mean square norm used for the error control (same as scipy)."""
+  return torch.sqrt(torch.mean(x ** 2))
+
+
+def select_initial_step(fun, t0, y0, f0, direction, order, rtol, atol):
+  """Empirically select a good initial step (Hairer, Norsett & Wanner, Sec. II.4).
+  Args:
+    fun: The right hand side of the ODE, `fun(t, y)`.
+    t0: A `float`. Initial time.
+    y0: A PyTorch tensor. Initial state.
+    f0: A PyTorch tensor. `fun(t0, y0)`.
+    direction: +1 or -1, the direction of integration.
+    order: The order of the error estimator.
+    rtol: Relative tolerance.
+    atol: Absolute tolerance.
+  Returns:
+    The absolute value of the suggested initial step as a `float`.
+  """
+  scale = atol + torch.abs(y0) * rtol
+  d0 = rms_norm(y0 / scale).item()
+  d1 = rms_norm(f0 / scale).item()
+  if d0 < 1e-5 or d1 < 1e-5:
+    h0 = 1e-6
+  else:
+    h0 = 0.01 * d0 / d1
+
+  y1 = y0 + h0 * direction * f0
+  f1 = fun(t0 + h0 * direction, y1)
+  d2 = rms_norm((f1 - f0) / scale).item() / h0
+
+  if d1 <= 1e-15 and d2 <= 1e-15:
+    h1 = max(1e-6, h0 * 1e-3)
+  else:
+    h1 = (0.01 / max(d1, d2)) ** (1 / (order + 1))
+
+  return min(100 * h0, h1)
+
+
+def rk45_step(fun, t, y, f, h, direction):
+  """One Dormand-Prince step.
+  Args:
+    fun: The right hand side of the ODE, `fun(t, y)`.
+    t: A `float`. Current time.
+    y: A PyTorch tensor. Current state.
+    f: A PyTorch tensor. `fun(t, y)`, reused from the previous step (FSAL).
+    h: A `float`. Absolute step size.
+    direction: +1 or -1, the direction of integration.
+  Returns:
+    y_new, f_new, error estimate (a tensor with the shape of `y`).
+  """
+  dt = h * direction
+  K = [f]
+  for s in range(1, len(_RK45_C)):
+    dy = sum(a * k for a, k in zip(_RK45_A[s], K))
+    K.append(fun(t + _RK45_C[s] * dt, y + dt * dy))
+
+  y_new = y + dt * sum(b * k for b, k in zip(_RK45_B, K) if b != 0.)
+  f_new = fun(t + dt, y_new)
+  K.append(f_new)
+  error = dt * sum(e * k for e, k in zip(_RK45_E, K) if e != 0.)
+  return y_new, f_new, error
+
+
+def solve_ivp(fun, t_span, y0, rtol=1e-5, atol=1e-5, method='RK45', first_step=None, max_step=np.inf):
+  """Solve an initial value problem with an adaptive Runge-Kutta method on the device of `y0`.
+  Mirrors the step size control of `scipy.integrate.solve_ivp` but treats `y0` as a single system.
+  Args:
+    fun: The right hand side of the ODE, `fun(t, y)` where `t` is a `float` and `y` a PyTorch tensor.
+    t_span: A tuple `(t0, t1)` of floats. Integration interval.
+    y0: A PyTorch tensor. Initial state (any shape).
+    rtol: A `float` number. The relative tolerance level.
+    atol: A `float` number. The absolute tolerance level.
+    method: A `str`. Only 'RK45' (Dormand-Prince) is supported.
+    first_step: Optional initial step size. Selected automatically if `None`.
+    max_step: Maximum allowed step size.
+  Returns:
+    An `ODESolution` with the final time `t`, final state `y` and the number of function evaluations `nfev`.
+  """
+  if method != 'RK45':
+    raise NotImplementedError(f'Torch ODE solver {method} not implemented. Available: RK45.')
+
+  t0, t1 = float(t_span[0]), float(t_span[1])
+  direction = np.sign(t1 - t0) if t1 != t0 else 1.
+  error_exponent = -1. / (_RK45_ERROR_ESTIMATOR_ORDER + 1)
+
+  t, y = t0, y0
+  f = fun(t, y)
+  nfev = 1
+
+  if first_step is None:
+    h = select_initial_step(fun, t, y, f, direction, _RK45_ERROR_ESTIMATOR_ORDER, rtol, atol)
+    nfev += 1
+  else:
+    h = first_step
+  h = min(h, max_step)
+
+  status = 0
+  while status == 0:
+    min_step = 10 * np.abs(np.nextafter(t, direction * np.inf) - t)
+    if h < min_step:
+      h = min_step
+
+    step_accepted = False
+    step_rejected = False
+    while not step_accepted:
+      if h < min_step:
+        status = -1
+        break
+
+      t_new = t + h * direction
+      if direction * (t_new - t1) > 0:
+        t_new = t1
+      h_step = np.abs(t_new - t)
+
+      y_new, f_new, error = rk45_step(fun, t, y, f, h_step, direction)
+      nfev += len(_RK45_C)
+
+      scale = atol + torch.maximum(torch.abs(y), torch.abs(y_new)) * rtol
+      error_norm = rms_norm(error / scale).item()
+
+      if error_norm < 1:
+        if error_norm == 0:
+          factor = _MAX_FACTOR
+        else:
+          factor = min(_MAX_FACTOR, _SAFETY * error_norm ** error_exponent)
+        if step_rejected:
+          factor = min(1., factor)
+        h = min(h_step * factor, max_step)
+        step_accepted = True
+      else:
+        h = h_step * max(_MIN_FACTOR, _SAFETY * error_norm ** error_exponent)
+        step_rejected = True
+
+    if status == -1:
+      break
+
+    t, y, f = t_new, y_new, f_new
+    if direction * (t - t1) >= 0:
+      status = 1
+
+  return ODESolution(t=t, y=y, nfev=nfev, status=status, success=status >= 0)
+
+
+def rms_norm_per_sample(x):
+  """Root mean square norm over all but the batch dimension."""
+  return torch.sqrt(torch.mean(x.reshape(x.shape[0], -1) ** 2, dim=-1))
+
+
+def _batch_view(v, x):
+  """Reshape a per-sample vector `v` so that it broadcasts against `x`."""
+  return v[(...,) + (None,) * len(x.shape[1:])]
+
+
+def select_initial_step_per_sample(fun, t0, y0, f0, index, direction, order, rtol, atol):
+  """Per-sample version of `select_initial_step`. `t0` is a vector with one time per sample."""
+  scale = atol + torch.abs(y0) * rtol
+  d0 = rms_norm_per_sample(y0 / scale)
+  d1 = rms_norm_per_sample(f0 / scale)
+  h0 = torch.where((d0 < 1e-5) | (d1 < 1e-5), torch.full_like(d0, 1e-6), 0.01 * d0 / d1)
+
+  y1 = y0 + _batch_view(h0 * direction, y0) * f0
+  f1 = fun((t0 + h0 * direction).type_as(y0), y1, index)
+  d2 = rms_norm_per_sample((f1 - f0) / scale) / h0
+
+  small = (d1 <= 1e-15) & (d2 <= 1e-15)
+  h1 = torch.where(small, torch.clamp(h0 * 1e-3, min=1e-6),
+                   (0.01 / torch.maximum(d1, d2)) ** (1 / (order + 1)))
+  return torch.minimum(100 * h0, h1).double()
+
+
+def solve_ivp_per_sample(fun, t_span, y0, rtol=1e-5, atol=1e-5, method='RK45', max_step=np.inf):
+  """Solve a batch of independent initial value problems, each with its own step size control.
+  Every sample keeps its own time, step size and error norm, so a single stiff sample no longer
+  forces small steps on the whole batch. Samples that reached the end of the interval are removed
+  from the batch handed to `fun`, so they cost no further function evaluations.
+  Args:
+    fun: The right hand side, `fun(t, y, index)`. `t` is a vector with one time per row of `y`
+      and `index` holds the positions of these rows in the full batch (useful to slice any
+      per-sample auxiliary tensors).
+    t_span: A tuple `(t0, t1)` of floats. Integration interval shared by all samples.
+    y0: A PyTorch tensor of shape [batch size, ...]. Initial states.
+    rtol: A `float` number. The relative tolerance level.
+    atol: A `float` number. The absolute tolerance level.
+    method: A `str`. Only 'RK45' (Dormand-Prince) is supported.
+    max_step: Maximum allowed step size.
+  Returns:
+    An `ODESolution` whose `t`, `nfev` and `status` are per-sample tensors.
+  """
+  if method != 'RK45':
+    raise NotImplementedError(f'Torch ODE solver {method} not implemented. Available: RK45.')
+
+  device = y0.device
+  batch_size = y0.shape[0]
+  t0, t1 = float(t_span[0]), float(t_span[1])
+  direction = float(np.sign(t1 - t0)) if t1 != t0 else 1.
+  error_exponent = -1. / (_RK45_ERROR_ESTIMATOR_ORDER + 1)
+
+  index = torch.arange(batch_size, device=device)
+  t = torch.full((batch_size,), t0, dtype=torch.float64, device=device)
+  y = y0.clone()
+  f = fun(t.type_as(y0), y, index)
+  h = select_initial_step_per_sample(fun, t, y, f, index, direction, _RK45_ERROR_ESTIMATOR_ORDER, rtol, atol)
+  h = torch.clamp(h, max=max_step)
+  nfev = torch.full((batch_size,), 2, dtype=torch.long, device=device)
+  status = torch.zeros(batch_size, dtype=torch.long, device=device)
+  rejected = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+  while True:
+    active = torch.nonzero(status == 0, as_tuple=False).squeeze(-1)
+    if active.numel() == 0:
+      break
+
+    t_a, y_a, f_a, h_a = t[active], y[active], f[active], h[active]
+    min_step = 10 * torch.abs(torch.nextafter(t_a, torch.full_like(t_a, direction * np.inf)) - t_a)
+    h_a = torch.maximum(h_a, min_step)
+
+    # Do not step past the end of the interval.
+    h_step = torch.minimum(h_a, torch.abs(t1 - t_a))
+    dt = h_step * direction
+    dt_x = _batch_view(dt, y_a).type_as(y_a)
+
+    K = [f_a]
+    for s in range(1, len(_RK45_C)):
+      dy = sum(a * k for a, k in zip(_RK45_A[s], K))
+      K.append(fun((t_a + _RK45_C[s] * dt).type_as(y_a), y_a + dt_x * dy, active))
+    y_new = y_a + dt_x * sum(b * k for b, k in zip(_RK45_B, K) if b != 0.)
+    t_new = torch.where(h_step >= torch.abs(t1 - t_a), torch.full_like(t_a, t1), t_a + dt)
+    f_new = fun(t_new.type_as(y_a), y_new, active)
+    K.append(f_new)
+    error = dt_x * sum(e * k for e, k in zip(_RK45_E, K) if e != 0.)
+    nfev[active] += len(_RK45_C)
+
+    scale = atol + torch.maximum(torch.abs(y_a), torch.abs(y_new)) * rtol
+    error_norm = rms_norm_per_sample(error / scale).double()
+    accepted = error_norm < 1
+
+    factor = torch.where(error_norm == 0, torch.full_like(error_norm, _MAX_FACTOR),
+                         torch.clamp(_SAFETY * error_norm ** error_exponent, max=_MAX_FACTOR))
+    factor = torch.where(rejected[active], torch.clamp(factor, max=1.), factor)
+    h_accepted = torch.clamp(h_step * factor, max=max_step)
+    h_rejected = h_step * torch.clamp(_SAFETY * error_norm ** error_exponent, min=_MIN_FACTOR)
+
+    acc = active[accepted]
+    t[acc] = t_new[accepted]
+    y[acc] = y_new[accepted]
+    f[acc] = f_new[accepted]
+    h[active] = torch.where(accepted, h_accepted, h_rejected)
+    rejected[active] = ~accepted
+
+    finished = accepted & (direction * (t_new - t1) >= 0)
+    failed = ~accepted & (h_rejected < min_step)
+    status[active[finished]] = 1
+    status[active[failed]] = -1
+
+  return ODESolution(t=t, y=y, nfev=nfev, status=status, success=bool(torch.all(status >= 0)))
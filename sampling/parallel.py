@@ -0,0 +1,176 @@
+"""Parallel-in-time sampling by Picard iterations (ParaDiGMS, Shih et al., 2023).
+
+The Euler-Maruyama discretization of the reverse SDE (or of the probability flow ODE) on the time
+grid is x_{k+1} = x_k + d_k(x_k) + n_k, with the drift increment d_k and the noise increment n_k,
+which is drawn once per step. Instead of taking the steps one after the other, the sampler keeps a
+window of `window` steps and refines all of them at once with the fixed-point iteration
+x_{j+1} <- x_a + sum_{a <= k <= j} d_k(x_k) + n_k. The score evaluations of the window are batched
+into a single forward pass. The steps whose update is below the tolerance (relative to the
+variance of the step noise) are accepted and the window slides forward.
+
+The first step of the window is exact after every iteration, so the sampler never needs more
+iterations than steps. It trades more score evaluations for fewer sequential model calls.
+"""
+import torch
+from tqdm import tqdm
+
+from sampling.plan import SamplingPlan, ConditionalSamplingPlan
+from sampling import schedules
+from sampling import evolution
+from sampling import rng
+
+
+def picard_solve(plan, x, window, tolerance, probability_flow=False, y=None, recorder=None):
+  """Solve the Euler-Maruyama discretization on the grid of `plan` by sliding-window Picard iterations.
+  Args:
+    plan: A `SamplingPlan` or `ConditionalSamplingPlan`. Its score function and step coefficients are used.
+    x: The initial state at the first time of the grid.
+    window: The number of steps refined in parallel.
+    tolerance: A step is accepted when the mean squared change of its state, for every sample, is
+      below tolerance^2 times the variance of the noise of the step.
+    probability_flow: If `True`, solve the probability flow ODE (no step noise).
+    y: The condition of a conditional plan. It is perturbed once per step if the plan diffuses it.
+    recorder: An optional `sampling.evolution.EvolutionRecorder` of the accepted states.
+  Returns:
+    x, x_mean (the last state without the last noise), the number of score evaluations per sample
+    and the number of (sequential) iterations.
+  """
+  num_steps, batch_size = plan.num_steps, x.shape[0]
+  conditional = isinstance(plan, ConditionalSamplingPlan)
+  expand = (...,) + (None,) * len(x.shape)
+  coeffs = plan.coefficients
+  weight = 0.5 if probability_flow else 1.
+  dt = coeffs['dt']
+  # x_{k+1} = (1 - dt drift_coeff) x_k + dt weight diffusion^2 score(x_k) + noise_std z_k
+  state_coeff = 1. - dt * coeffs['drift_coeff']
+  score_coeff = weight * dt * coeffs['diffusion'] ** 2
+  noise_std = torch.zeros_like(dt) if probability_flow else coeffs['diffusion'] * torch.sqrt(dt)
+  threshold = tolerance ** 2 * coeffs['diffusion'] ** 2 * dt
+
+  # the noise (and the perturbed condition) of every step, drawn when the step enters the window
+  noise, conditions = {}, {}
+  states = x.unsqueeze(0).repeat((window + 1,) + (1,) * len(x.shape))
+  start, nfe, iterations = 0, 0, 0
+
+  with tqdm(total=num_steps) as progress:
+    while start < num_steps:
+      size = min(window, num_steps - start)
+      steps = range(start, start + size)
+      for k in steps:
+        if k not in noise:
+          noise[k] = plan.randn_like(x) * noise_std[k]
+          if conditional:
+            conditions[k] = plan.perturb_y(k, y)[0] if plan.diffuse_y else y
+
+      # one forward pass for the score of every step of the window
+      x_in = states[:size].reshape((size * batch_size,) + tuple(x.shape[1:]))
+      t_in = plan.timesteps[start:start + size].repeat_interleave(batch_size)
+      if conditional:
+        y_in = torch.cat([conditions[k] for k in steps], dim=0)
+        score = plan.score_fn(x_in, y_in, t_in)
+      else:
+        score = plan.score_fn(x_in, t_in)
+      score = score.reshape((size,) + tuple(x.shape))
+      nfe += size
+      iterations += 1
+
+      index = slice(start, start + size)
+      drifts = (state_coeff[index][expand] - 1.) * states[:size] + score_coeff[index][expand] * score
+      increments = drifts + torch.stack([noise[k] for k in steps])
+      new_states = states[0].unsqueeze(0) + torch.cumsum(increments, dim=0)
+      error = torch.mean(((new_states - states[1:size + 1]) ** 2).reshape(size, batch_size, -1), dim=-1).max(dim=1).values
+      states[1:size + 1] = new_states
+
+      # the first step of the window is exact, the following ones until the first one above the tolerance are accepted
+      converged = (error <= threshold[index]).long()
+      stride = max(1, int(torch.cumprod(converged, dim=0).sum()))
+
+      if start + stride >= num_steps:
+        x_mean = new_states[-1] - noise[num_steps - 1]
+      if recorder is not None:
+        for k in range(stride):
+          recorder.record(start + k, states[k + 1])
+      for k in range(start, start + stride):
+        noise.pop(k)
+        conditions.pop(k, None)
+
+      # slide the window, the new steps start from the last state
+      states = torch.cat([states[stride:], states[-1:].repeat((stride,) + (1,) * len(x.shape))], dim=0)
+      start += stride
+      progress.update(stride)
+
+  return states[0], x_mean, nfe, iterations
+
+
+def get_picard_sampler(sde, shape, p_steps, window=16, tolerance=0.1,
+                       probability_flow=False, continuous=False, denoise=True, eps=1e-3, schedule=None):
+  """Create a parallel-in-time sampler of the unconditional score model.
+  Args:
+    sde: An `sde_lib.SDE` object representing the forward SDE.
+    shape: A sequence of integers. The expected shape of a batch of samples.
+    p_steps: The number of times of the grid.
+    window: The number of steps refined in parallel. The model sees batches of `window * shape[0]` samples.
+    tolerance: The tolerance of the Picard iterations, relative to the std of the step noise.
+      0 reproduces the sequential Euler-Maruyama sampler with the same noise.
+    probability_flow: If `True`, solve the probability flow ODE.
+    continuous: `True` indicates that the score model was continuously trained.
+    denoise: If `True`, return the last state without the last noise.
+    eps: The last time of the grid.
+    schedule: The time schedule (see `sampling.schedules.get_timesteps`). Uniform if `None`.
+  Returns:
+    A sampling function that returns samples and the sampling information (score evaluations per
+    sample in 'steps' and sequential model calls in 'iterations').
+  """
+  def picard_sampler(model, show_evolution=False, checkpoint=None, seeds=None):
+    if checkpoint is not None:
+      raise ValueError('Checkpointing is not supported by the Picard sampler.')
+    recorder = evolution.get_recorder(show_evolution)
+    noise = rng.get_sample_noise(seeds)
+
+    with torch.no_grad():
+      x = rng.prior_sampling(sde, shape, noise).to(model.device).type(torch.float32)
+      timesteps = schedules.get_timesteps(sde, p_steps, eps, schedule, device=model.device)
+      plan = SamplingPlan(sde, model, None, None, timesteps, shape[0],
+                          snr=0., probability_flow=probability_flow, continuous=continuous, noise=noise)
+      if recorder is not None:
+        recorder.start(plan.num_steps)
+      x, x_mean, nfe, iterations = picard_solve(plan, x, window, tolerance, probability_flow, recorder=recorder)
+
+      sampling_info = {'times': timesteps, 'steps': nfe, 'iterations': iterations}
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return x_mean if denoise else x, sampling_info
+
+  return picard_sampler
+
+
+def get_conditional_picard_sampler(sde, shape, p_steps, window=16, tolerance=0.1,
+                                   probability_flow=False, continuous=False, denoise=True, eps=1e-5, schedule=None,
+                                   tiling=None):
+  """Create a parallel-in-time sampler of the conditional score model. `sde` is a single SDE (SR3
+  conditioning) or a dict of SDEs with keys 'x' and 'y'. The arguments are those of `get_picard_sampler`
+  and the optional `tiling` of the score (see `sampling.tiling.get_tiling_fn`).
+  """
+  def picard_conditional_sampler(model, y, show_evolution=False, checkpoint=None, seeds=None):
+    if checkpoint is not None:
+      raise ValueError('Checkpointing is not supported by the Picard sampler.')
+    c_sde = sde['x'] if isinstance(sde, dict) else sde
+    recorder = evolution.get_recorder(show_evolution)
+    noise = rng.get_sample_noise(seeds)
+
+    with torch.no_grad():
+      x = rng.prior_sampling(c_sde, shape, noise).to(model.device)
+      timesteps = schedules.get_timesteps(c_sde, p_steps, eps, schedule, device=model.device)
+      plan = ConditionalSamplingPlan(sde, model, None, None, timesteps, shape[0],
+                                     snr=0., probability_flow=probability_flow, continuous=continuous, tiling=tiling,
+                                     noise=noise)
+      if recorder is not None:
+        recorder.start(plan.num_steps)
+      x, x_mean, nfe, iterations = picard_solve(plan, x, window, tolerance, probability_flow, y=y, recorder=recorder)
+
+      sampling_info = {'steps': nfe, 'iterations': iterations}
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return x_mean if denoise else x, sampling_info
+
+  return picard_conditional_sampler
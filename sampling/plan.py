@@ -0,0 +1,222 @@
+"""Sampling plans: the per-trajectory state of a predictor-corrector sampler.
+
+The update functions in `sampling.unconditional` and `sampling.conditional` used to rebuild the
+score function, the predictor/corrector objects and the reverse SDE on every step. A plan builds
+them once per (sde, model, predictor, corrector, time grid), moves the discrete schedules of the
+SDE to the sampling device and precomputes the per-step coefficients of the time grid
+(`sde.get_step_coefficients`), so that the sampling loop only has to call `step(i, ...)`.
+
+With `inplace=True` the plan also owns the state and noise tensors of the predictor and the
+corrector (`StepBuffers`). The Euler-Maruyama, reverse diffusion and Langevin updates then write
+into them instead of allocating new full-size tensors on every step. The returned `x` and `x_mean`
+are these buffers, so they are overwritten by the next step.
+
+With `noise` (a `sampling.rng.SampleNoise`) all the noise of the steps comes from per-sample streams
+and the Langevin correctors use the norms of every sample instead of the batch means, so that the
+trajectory of a sample does not depend on the rest of the batch.
+
+With `compiler` (a `sampling.compilation.StepCompiler`) the update functions of the predictor and
+the corrector are compiled.
+"""
+import torch
+
+from models import utils as mutils
+from sampling import rng
+from sampling.predictors import NonePredictor
+from sampling.correctors import NoneCorrector
+
+
+class StepBuffers:
+  """Preallocated full-size tensors, reused across the steps of a sampler."""
+
+  def __init__(self):
+    self.tensors = {}
+    # Per-sample noise streams (`sampling.rng.SampleNoise`), set by the sampling plan.
+    self.noise = None
+
+  def get(self, name, like):
+    """The buffer `name`, (re)allocated if it does not match the shape, dtype or device of `like`."""
+    buffer = self.tensors.get(name)
+    if buffer is None or buffer.shape != like.shape or buffer.dtype != like.dtype or buffer.device != like.device:
+      buffer = torch.empty_like(like, memory_format=torch.contiguous_format)
+      self.tensors[name] = buffer
+    return buffer
+
+  def randn(self, name, like):
+    """Standard normal noise in the buffer `name`. Draws the same numbers as `torch.randn_like(like)`
+    (or as the per-sample streams of `noise`)."""
+    buffer = self.get(name, like)
+    if self.noise is not None:
+      return self.noise.randn_like(like, out=buffer)
+    return torch.randn(buffer.shape, out=buffer)
+
+
+class SamplingPlan:
+  """Prepared predictor and corrector for unconditional sampling on a fixed time grid."""
+
+  def __init__(self, sde, model, predictor, corrector, timesteps, batch_size,
+               snr, n_steps=1, probability_flow=False, continuous=False, predictor_kwargs=None,
+               inplace=False, noise=None, compiler=None):
+    """Build the plan.
+    Args:
+      sde: An `sde_lib.SDE` object representing the forward SDE.
+      model: A score model.
+      predictor: A subclass of `sampling.Predictor` or `None` for a corrector-only sampler.
+      corrector: A subclass of `sampling.Corrector` or `None` for a predictor-only sampler.
+      timesteps: A PyTorch tensor with the time grid, on the device used for sampling.
+      batch_size: The number of samples in the batch.
+      snr: The signal-to-noise ratio for configuring correctors. A float or a tensor with the SNR
+        of every sample (an SNR sweep in a single batch).
+      n_steps: The number of corrector steps per corrector update.
+      probability_flow: If `True`, the predictor solves the probability flow ODE.
+      continuous: `True` indicates that the score model was continuously trained.
+      predictor_kwargs: Optional dict of extra arguments of the predictor (e.g. the tolerances
+        of the adaptive predictor).
+      inplace: If `True`, the predictor and the corrector update preallocated buffers in place.
+      noise: Optional `sampling.rng.SampleNoise` with one noise stream per sample.
+      compiler: Optional `sampling.compilation.StepCompiler` compiling the predictor and corrector updates.
+    """
+    self.sde = sde
+    self.model = model
+    self.timesteps = timesteps
+    self.num_steps = timesteps.size(0)
+    # One row of per-sample times for every step of the grid.
+    self.vec_t = timesteps[:, None].repeat(1, batch_size)
+
+    # Move the discrete schedules once, then tabulate the coefficients of every step of the grid.
+    self.step_sde.to(timesteps.device)
+    self.coefficients = self.step_sde.get_step_coefficients(timesteps)
+    self.step_coeffs = [{key: value[i] for key, value in self.coefficients.items()}
+                        for i in range(self.num_steps)]
+    # Mean coefficient and std of the perturbation kernel p(x_t|x_0) on the grid.
+    self.mean_coeff, self.std = self.coefficients['mean_coeff'], self.coefficients['std']
+
+    if torch.is_tensor(snr):
+      snr = snr.to(timesteps.device)
+    self.score_fn = self.get_score_fn(sde, model, continuous)
+    self.predictor = self.build_predictor(predictor, probability_flow, predictor_kwargs or {})
+    self.corrector = self.build_corrector(corrector, snr, n_steps)
+
+    # Shared by the predictor and the corrector: the output of one is the input of the other.
+    self.buffers = StepBuffers() if inplace else None
+    self.predictor.buffers = self.buffers
+    self.corrector.buffers = self.buffers
+
+    self.noise = noise
+    if noise is not None:
+      self.predictor.noise = self.corrector.noise = noise
+      if self.buffers is not None:
+        self.buffers.noise = noise
+      if hasattr(self.corrector, 'snr_groups'):
+        # every sample is its own group of the step size norms
+        self.corrector.snr_groups = torch.arange(batch_size, device=timesteps.device)
+
+    if compiler is not None:
+      compiler.compile_plan(self)
+
+  @property
+  def step_sde(self):
+    """The SDE the predictor and corrector operate on."""
+    return self.sde
+
+  def get_score_fn(self, sde, model, continuous):
+    return mutils.get_score_fn(sde, model, conditional=False, train=False, continuous=continuous)
+
+  def build_predictor(self, predictor, probability_flow, predictor_kwargs):
+    if predictor is None:
+      # Corrector-only sampler
+      return NonePredictor(self.step_sde, self.score_fn, probability_flow)
+    return predictor(self.step_sde, self.score_fn, probability_flow, **predictor_kwargs)
+
+  def build_corrector(self, corrector, snr, n_steps):
+    if corrector is None:
+      # Predictor-only sampler
+      return NoneCorrector(self.step_sde, self.score_fn, snr, n_steps)
+    return corrector(self.step_sde, self.score_fn, snr, n_steps)
+
+  def randn_like(self, x):
+    """Noise from the streams of the plan (or the global RNG)."""
+    return rng.randn_like(x, self.noise)
+
+  def predictor_step(self, i, x):
+    return self.predictor.update_fn(x, self.vec_t[i], coeffs=self.step_coeffs[i])
+
+  def corrector_step(self, i, x):
+    return self.corrector.update_fn(x, self.vec_t[i], coeffs=self.step_coeffs[i])
+
+  def step(self, i, x):
+    """One corrector update followed by one predictor update at the i-th time of the grid."""
+    x, x_mean = self.corrector_step(i, x)
+    return self.predictor_step(i, x)
+
+
+class ConditionalSamplingPlan(SamplingPlan):
+  """Prepared predictor and corrector for conditional sampling on a fixed time grid.
+  `sde` is either a single SDE (SR3 conditioning) or a dict of SDEs with keys 'x' and 'y'
+  whose 'y' SDE diffuses the condition. With `tiling` (see `sampling.tiling.get_tiling_fn`) the
+  score is evaluated on overlapping tiles of x and y.
+  """
+
+  def __init__(self, sde, model, predictor, corrector, timesteps, batch_size,
+               snr, n_steps=1, probability_flow=False, continuous=False, predictor_kwargs=None,
+               inplace=False, tiling=None, noise=None, compiler=None):
+    self.tiling = tiling
+    super().__init__(sde, model, predictor, corrector, timesteps, batch_size,
+                     snr, n_steps, probability_flow, continuous, predictor_kwargs, inplace, noise, compiler)
+    self.diffuse_y = isinstance(sde, dict) and len(sde.keys()) == 2
+    if self.diffuse_y:
+      sde['y'].to(timesteps.device)
+      # Mean coefficient and std of the perturbation kernel p(y_t|y_0) on the grid.
+      self.y_mean_coeff, self.y_std = sde['y'].marginal_prob(torch.ones_like(timesteps), timesteps)
+
+  @property
+  def step_sde(self):
+    return self.sde['x'] if isinstance(self.sde, dict) else self.sde
+
+  def get_score_fn(self, sde, model, continuous):
+    score_fn = mutils.get_score_fn(sde, model, conditional=True, train=False, continuous=continuous)
+    score_fn = mutils.get_conditional_score_fn(score_fn, target_domain='x')
+    if self.tiling is not None:
+      score_fn = self.tiling(score_fn)
+    return score_fn
+
+  def perturb_y(self, i, y):
+    """Sample y_t from the perturbation kernel p(y_t|y_0) at the i-th time of the grid."""
+    y_mean = self.y_mean_coeff[i] * y
+    y_perturbed = y_mean + self.randn_like(y) * self.y_std[i]
+    return y_perturbed, y_mean
+
+  def predictor_step(self, i, x, y):
+    """Predictor update with a freshly perturbed condition. Returns x, x_mean, y_t, E[y_t]."""
+    if self.diffuse_y:
+      y_perturbed, y_mean = self.perturb_y(i, y)
+    else:
+      y_perturbed, y_mean = y, y
+    x, x_mean = self.predictor.update_fn(x, y_perturbed, self.vec_t[i], coeffs=self.step_coeffs[i])
+    return x, x_mean, y_perturbed, y_mean
+
+  def corrector_step(self, i, x, y):
+    """Corrector update with a freshly perturbed condition. Returns x, x_mean, y_t, E[y_t]."""
+    if self.diffuse_y:
+      y_perturbed, y_mean = self.perturb_y(i, y)
+    else:
+      y_perturbed, y_mean = y, y
+    x, x_mean = self.corrector.update_fn(x, y_perturbed, self.vec_t[i], coeffs=self.step_coeffs[i])
+    return x, x_mean, y_perturbed, y_mean
+
+  def path_predictor_step(self, i, x, y, y_tplustau, tau):
+    """Predictor update where y_t is sampled from p(y_t|y_{t+tau}, y_0) to follow a single path of
+    the forward diffusion of the condition. Returns x, x_mean, y_t."""
+    vec_t = self.vec_t[i]
+    y_t_mean, y_t_std = self.sde['y'].compute_backward_kernel(y, y_tplustau, vec_t, torch.ones_like(vec_t) * tau)
+    y_t_perturbed = y_t_mean + self.randn_like(y) * y_t_std[(...,) + (None,) * len(y.shape[1:])]
+    x, x_mean = self.predictor.update_fn(x, y_t_perturbed, vec_t, coeffs=self.step_coeffs[i])
+    return x, x_mean, y_t_perturbed
+
+  def path_corrector_step(self, i, x, y_t):
+    """Corrector update on the path sample y_t, which is not resampled."""
+    return self.corrector.update_fn(x, y_t, self.vec_t[i], coeffs=self.step_coeffs[i])
+
+  def step(self, i, x, y):
+    x, x_mean, _, _ = self.corrector_step(i, x, y)
+    return self.predictor_step(i, x, y)
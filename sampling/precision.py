@@ -0,0 +1,63 @@
+"""Reduced-precision inference policy of the score network (`config.sampling.precision`).
+
+With 'bfloat16' (or 'float16') the forward pass of the score network runs under `torch.autocast`,
+so that the convolutions and matmuls use the reduced-precision kernels of the device, and its output
+is cast back to the dtype of the input. Only the network is affected: the state of the samplers,
+the SDE coefficients and the accumulations of the updates stay in float32. `precision_drift.py`
+measures the drift of the samples against float32 on a fixed set of seeds.
+"""
+import functools
+import torch
+
+_DTYPES = {None: None, 'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def get_dtype(precision):
+  if precision not in _DTYPES:
+    raise ValueError(f'Unknown precision {precision}, expected one of {[p for p in _DTYPES if p is not None]}.')
+  return _DTYPES[precision]
+
+
+def _cast(output, dtype):
+  if isinstance(output, dict):
+    return {key: value.to(dtype) for key, value in output.items()}
+  return output.to(dtype)
+
+
+class AutocastScoreModel(torch.nn.Module):
+  """A score model whose forward pass runs under autocast. The other attributes are those of the wrapped model."""
+
+  def __init__(self, model, dtype):
+    super().__init__()
+    self.model = model
+    self.dtype = dtype
+
+  def __getattr__(self, name):
+    try:
+      return super().__getattr__(name)
+    except AttributeError:
+      return getattr(self._modules['model'], name)
+
+  def forward(self, x, labels):
+    inputs = next(iter(x.values())) if isinstance(x, dict) else x
+    with torch.autocast(device_type=inputs.device.type, dtype=self.dtype):
+      output = self.model(x, labels)
+    return _cast(output, inputs.dtype)
+
+
+def with_precision(sampling_fn, precision):
+  """The sampling function `sampling_fn(model, ...)` with the score network `model` evaluated in
+  `precision` ('float32', 'bfloat16' or 'float16')."""
+  dtype = get_dtype(precision)
+  if dtype is None:
+    return sampling_fn
+  wrappers = {}
+
+  @functools.wraps(sampling_fn)
+  def reduced_precision_sampling_fn(model, *args, **kwargs):
+    #one wrapper per model, so that compiled samplers do not see a new module in every call
+    if id(model) not in wrappers or wrappers[id(model)].model is not model:
+      wrappers[id(model)] = AutocastScoreModel(model, dtype)
+    return sampling_fn(wrappers[id(model)], *args, **kwargs)
+
+  return reduced_precision_sampling_fn
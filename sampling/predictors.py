@@ -1,6 +1,7 @@
 import abc
 import torch
 import sde_lib
+from sampling import rng
 import numpy as np
 
 _PREDICTORS = {}
@@ -27,6 +28,26 @@ def register_predictor(cls=None, *, name=None):
 def get_predictor(name):
   return _PREDICTORS[name]
 
+
+def inplace_euler_maruyama_update(buffers, x, score, noise, coeffs, probability_flow):
+  """Euler-Maruyama step of the reverse SDE/ODE into the buffers 'x_mean' and 'x'.
+  The drift of the reverse SDE is drift_coeff * x - diffusion^2 * score (halved for the ODE)."""
+  dt = coeffs['dt']
+  x_mean = torch.mul(x, 1. - dt * coeffs['drift_coeff'], out=buffers.get('x_mean', x))
+  x_mean.addcmul_(score, (0.5 if probability_flow else 1.) * dt * coeffs['diffusion'] ** 2)
+  if probability_flow:
+    return x_mean, x_mean
+  return torch.addcmul(x_mean, noise, coeffs['diffusion'] * torch.sqrt(dt), out=buffers.get('x', x)), x_mean
+
+
+def inplace_reverse_diffusion_update(buffers, x, score, noise, coeffs, probability_flow):
+  """Reverse diffusion step x_mean = x - f + G^2 * score (G^2/2 for the ODE) into the buffers 'x_mean' and 'x'."""
+  x_mean = torch.mul(x, 1. - coeffs['f_coeff'], out=buffers.get('x_mean', x))
+  x_mean.addcmul_(score, (0.5 if probability_flow else 1.) * coeffs['G'] ** 2)
+  if probability_flow:
+    return x_mean, x_mean
+  return torch.addcmul(x_mean, noise, coeffs['G'], out=buffers.get('x', x)), x_mean
+
 class Predictor(abc.ABC):
   """The abstract class for a predictor algorithm."""
 
@@ -36,13 +57,19 @@ class Predictor(abc.ABC):
     # Compute the reverse SDE/ODE
     self.rsde = sde.reverse(score_fn, probability_flow)
     self.score_fn = score_fn
+    # `sampling.plan.StepBuffers` of the in-place mode, set by the sampling plan.
+    self.buffers = None
+    # Per-sample noise streams (`sampling.rng.SampleNoise`), set by the sampling plan. Global RNG if `None`.
+    self.noise = None
 
   @abc.abstractmethod
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     """One update of the predictor.
     Args:
       x: A PyTorch tensor representing the current state
       t: A Pytorch tensor representing the current time step.
+      coeffs: Optional dict with the precomputed coefficients of the current step
+        (one row of `sde.get_step_coefficients`). If `None`, they are looked up from `t`.
     Returns:
       x: A PyTorch tensor of the next state.
       x_mean: A PyTorch tensor. The next state without random noise. Useful for denoising.
@@ -54,12 +81,16 @@ class EulerMaruyamaPredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     super().__init__(sde, score_fn, probability_flow)
 
-  def update_fn(self, x, t):
-    dt = -1. / self.rsde.N
-    z = torch.randn_like(x)
+  def update_fn(self, x, t, coeffs=None):
+    if self.buffers is not None and coeffs is not None:
+      noise = self.buffers.randn('noise', x)
+      return inplace_euler_maruyama_update(self.buffers, x, self.score_fn(x, t), noise, coeffs, self.rsde.probability_flow)
+    # The step size of the time grid, 1/N if the grid is unknown.
+    dt = -coeffs['dt'] if coeffs is not None else -1. / self.rsde.N
+    z = rng.randn_like(x, self.noise)
     drift, diffusion = self.rsde.sde(x, t)
     x_mean = x + drift * dt
-    x = x_mean + diffusion[(...,) + (None,) * len(x.shape[1:])] * np.sqrt(-dt) * z
+    x = x_mean + diffusion[(...,) + (None,) * len(x.shape[1:])] * (-dt) ** 0.5 * z
     return x, x_mean
 
 @register_predictor(name='conditional_euler_maruyama')
@@ -67,12 +98,16 @@ class conditionalEulerMaruyamaPredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     super().__init__(sde, score_fn, probability_flow)
 
-  def update_fn(self, x, y, t):
-    dt = -1. / self.rsde.N
-    z = torch.randn_like(x)
+  def update_fn(self, x, y, t, coeffs=None):
+    if self.buffers is not None and coeffs is not None:
+      noise = self.buffers.randn('noise', x)
+      return inplace_euler_maruyama_update(self.buffers, x, self.score_fn(x, y, t), noise, coeffs, self.rsde.probability_flow)
+    # The step size of the time grid, 1/N if the grid is unknown.
+    dt = -coeffs['dt'] if coeffs is not None else -1. / self.rsde.N
+    z = rng.randn_like(x, self.noise)
     drift, diffusion = self.rsde.sde(x, y, t)
     x_mean = x + drift * dt
-    x = x_mean + diffusion[(...,) + (None,) * len(x.shape[1:])] * np.sqrt(-dt) * z
+    x = x_mean + diffusion[(...,) + (None,) * len(x.shape[1:])] * (-dt) ** 0.5 * z
     return x, x_mean
 
 
@@ -81,9 +116,13 @@ class ReverseDiffusionPredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     super().__init__(sde, score_fn, probability_flow)
 
-  def update_fn(self, x, t):
-    f, G = self.rsde.discretize(x, t)
-    z = torch.randn_like(x)
+  def update_fn(self, x, t, coeffs=None):
+    if self.buffers is not None and coeffs is not None:
+      score = self.score_fn(x, t)
+      noise = self.buffers.randn('noise', x)
+      return inplace_reverse_diffusion_update(self.buffers, x, score, noise, coeffs, self.rsde.probability_flow)
+    f, G = self.rsde.discretize(x, t, coeffs)
+    z = rng.randn_like(x, self.noise)
     x_mean = x - f
     x = x_mean + G[(...,) + (None,) * len(x.shape[1:])] * z
     return x, x_mean
@@ -94,9 +133,13 @@ class conditionalReverseDiffusionPredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     super().__init__(sde, score_fn, probability_flow)
 
-  def update_fn(self, x, y, t):
-    f, G = self.rsde.discretize(x, y, t)
-    z = torch.randn_like(x)
+  def update_fn(self, x, y, t, coeffs=None):
+    if self.buffers is not None and coeffs is not None:
+      score = self.score_fn(x, y, t)
+      noise = self.buffers.randn('noise', x)
+      return inplace_reverse_diffusion_update(self.buffers, x, score, noise, coeffs, self.rsde.probability_flow)
+    f, G = self.rsde.discretize(x, y, t, coeffs)
+    z = rng.randn_like(x, self.noise)
     x_mean = x - f
     x = x_mean + G[(...,) + (None,) * len(x.shape[1:])] * z
     return x, x_mean
@@ -112,33 +155,39 @@ class AncestralSamplingPredictor(Predictor):
       raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
     assert not probability_flow, "Probability flow not supported by ancestral sampling"
 
-  def vesde_update_fn(self, x, t):
-    sde = self.sde
-    timestep = (t * (sde.N - 1) / sde.T).long()
-    sigma = sde.discrete_sigmas[timestep]
-    adjacent_sigma = torch.where(timestep == 0, torch.zeros_like(t), sde.discrete_sigmas.to(t.device)[timestep - 1])
+  def vesde_update_fn(self, x, t, coeffs=None):
+    if coeffs is not None:
+      sigma, adjacent_sigma = coeffs['sigma'], coeffs['adjacent_sigma']
+    else:
+      sde = self.sde
+      timestep = (t * (sde.N - 1) / sde.T).long()
+      sigma = sde.get_buffer('discrete_sigmas', t.device)[timestep]
+      adjacent_sigma = sde.get_buffer('adjacent_discrete_sigmas', t.device)[timestep]
     score = self.score_fn(x, t)
     x_mean = x + score * (sigma ** 2 - adjacent_sigma ** 2)[(...,) + (None,) * len(x.shape[1:])]
     std = torch.sqrt((adjacent_sigma ** 2 * (sigma ** 2 - adjacent_sigma ** 2)) / (sigma ** 2))
-    noise = torch.randn_like(x)
+    noise = rng.randn_like(x, self.noise)
     x = x_mean + std[(...,) + (None,) * len(x.shape[1:])] * noise
     return x, x_mean
 
-  def vpsde_update_fn(self, x, t):
-    sde = self.sde
-    timestep = (t * (sde.N - 1) / sde.T).long()
-    beta = sde.discrete_betas.to(t.device)[timestep]
+  def vpsde_update_fn(self, x, t, coeffs=None):
+    if coeffs is not None:
+      beta = coeffs['beta']
+    else:
+      sde = self.sde
+      timestep = (t * (sde.N - 1) / sde.T).long()
+      beta = sde.get_buffer('discrete_betas', t.device)[timestep]
     score = self.score_fn(x, t)
     x_mean = (x + beta[(...,) + (None,) * len(x.shape[1:])] * score) / torch.sqrt(1. - beta)[(...,) + (None,) * len(x.shape[1:])]
-    noise = torch.randn_like(x)
+    noise = rng.randn_like(x, self.noise)
     x = x_mean + torch.sqrt(beta)[(...,) + (None,) * len(x.shape[1:])] * noise
     return x, x_mean
 
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     if isinstance(self.sde, sde_lib.VESDE):
-      return self.vesde_update_fn(x, t)
+      return self.vesde_update_fn(x, t, coeffs)
     elif isinstance(self.sde, sde_lib.VPSDE):
-      return self.vpsde_update_fn(x, t)
+      return self.vpsde_update_fn(x, t, coeffs)
 
 @register_predictor(name='conditional_ancestral_sampling')
 class conditionalAncestralSamplingPredictor(Predictor):
@@ -150,33 +199,149 @@ class conditionalAncestralSamplingPredictor(Predictor):
       raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
     assert not probability_flow, "Probability flow not supported by ancestral sampling"
 
-  def vesde_update_fn(self, x, y, t):
-    sde = self.sde
-    timestep = (t * (sde.N - 1) / sde.T).long()
-    sigma = sde.discrete_sigmas[timestep]
-    adjacent_sigma = torch.where(timestep == 0, torch.zeros_like(t), sde.discrete_sigmas.to(t.device)[timestep - 1])
+  def vesde_update_fn(self, x, y, t, coeffs=None):
+    if coeffs is not None:
+      sigma, adjacent_sigma = coeffs['sigma'], coeffs['adjacent_sigma']
+    else:
+      sde = self.sde
+      timestep = (t * (sde.N - 1) / sde.T).long()
+      sigma = sde.get_buffer('discrete_sigmas', t.device)[timestep]
+      adjacent_sigma = sde.get_buffer('adjacent_discrete_sigmas', t.device)[timestep]
     score = self.score_fn(x, y, t)
     x_mean = x + score * (sigma ** 2 - adjacent_sigma ** 2)[(...,) + (None,) * len(x.shape[1:])]
     std = torch.sqrt((adjacent_sigma ** 2 * (sigma ** 2 - adjacent_sigma ** 2)) / (sigma ** 2))
-    noise = torch.randn_like(x)
+    noise = rng.randn_like(x, self.noise)
     x = x_mean + std[(...,) + (None,) * len(x.shape[1:])] * noise
     return x, x_mean
 
-  def vpsde_update_fn(self, x, y, t):
-    sde = self.sde
-    timestep = (t * (sde.N - 1) / sde.T).long()
-    beta = sde.discrete_betas.to(t.device)[timestep]
+  def vpsde_update_fn(self, x, y, t, coeffs=None):
+    if coeffs is not None:
+      beta = coeffs['beta']
+    else:
+      sde = self.sde
+      timestep = (t * (sde.N - 1) / sde.T).long()
+      beta = sde.get_buffer('discrete_betas', t.device)[timestep]
     score = self.score_fn(x, y, t)
     x_mean = (x + beta[(...,) + (None,) * len(x.shape[1:])] * score) / torch.sqrt(1. - beta)[(...,) + (None,) * len(x.shape[1:])]
-    noise = torch.randn_like(x)
+    noise = rng.randn_like(x, self.noise)
     x = x_mean + torch.sqrt(beta)[(...,) + (None,) * len(x.shape[1:])] * noise
     return x, x_mean
 
-  def update_fn(self, x, t):
-    if isinstance(self.sde, sde_lib.VESDE):
-      return self.vesde_update_fn(x, t)
-    elif isinstance(self.sde, sde_lib.VPSDE):
-      return self.vpsde_update_fn(x, t)
+  def update_fn(self, x, y, t, coeffs=None):
+    if isinstance(self.sde, sde_lib.cVESDE):
+      return self.vesde_update_fn(x, y, t, coeffs)
+    elif isinstance(self.sde, sde_lib.cVPSDE):
+      return self.vpsde_update_fn(x, y, t, coeffs)
+
+
+@register_predictor(name='ddim')
+class DDIMPredictor(Predictor):
+  """The deterministic DDIM predictor (eta = 0). Currently only supports VE/VP SDEs.
+
+  The score gives the noise and data estimates eps = -std(t) * score and
+  x_0 = (x + std(t)^2 * score) / mean_coeff(t), which are recombined at the next time of the grid:
+  x_next = mean_coeff(t_next) * x_0 + std(t_next) * eps. It needs the grid coefficients from
+  `sde.get_step_coefficients`, which the sampling plans pass in `coeffs`. The last step returns the
+  data estimate, so it gives usable samples with 25-100 predictor steps (`p_steps`).
+  """
+
+  def __init__(self, sde, score_fn, probability_flow=False):
+    super().__init__(sde, score_fn, probability_flow)
+    if not isinstance(sde, (sde_lib.VPSDE, sde_lib.VESDE, sde_lib.cVPSDE, sde_lib.cVESDE)):
+      raise NotImplementedError(f"SDE class {sde.__class__.__name__} not yet supported.")
+
+  def ddim_step(self, x, score, coeffs):
+    if coeffs is None:
+      raise ValueError('The DDIM predictor needs the coefficients of the time grid.')
+    expand = (...,) + (None,) * len(x.shape[1:])
+    mean_coeff, std = coeffs['mean_coeff'][expand], coeffs['std'][expand]
+    eps = -std * score
+    x0 = (x - std * eps) / mean_coeff
+    x_mean = coeffs['next_mean_coeff'][expand] * x0 + coeffs['next_std'][expand] * eps
+    return x_mean, x_mean
+
+  def update_fn(self, x, t, coeffs=None):
+    return self.ddim_step(x, self.score_fn(x, t), coeffs)
+
+
+@register_predictor(name='conditional_ddim')
+class conditionalDDIMPredictor(DDIMPredictor):
+  def update_fn(self, x, y, t, coeffs=None):
+    return self.ddim_step(x, self.score_fn(x, y, t), coeffs)
+
+
+@register_predictor(name='adaptive')
+class AdaptivePredictor(Predictor):
+  """Adaptive step-size solver of the reverse SDE ("Gotta Go Fast", Jolicoeur-Martineau et al., 2021).
+
+  Each proposal takes an Euler-Maruyama step x' and an improved Euler step x'' with the same noise.
+  Their difference, scaled by the mixed tolerance max(abstol, reltol * max(|x'|, |x'_prev|)), is
+  the error estimate E of every sample. The step is accepted if E <= 1 and the next step size is
+  safety * h * E^(-exponent). The sampling loop is `sampling.adaptive.solve_reverse_sde`.
+  """
+  adaptive = True
+
+  def __init__(self, sde, score_fn, probability_flow=False, abstol=0.0078, reltol=0.05,
+               safety=0.9, exponent=0.9, h_init=0.01):
+    super().__init__(sde, score_fn, probability_flow)
+    assert not probability_flow, "Probability flow not supported by the adaptive predictor"
+    self.abstol = abstol
+    self.reltol = reltol
+    self.safety = safety
+    self.exponent = exponent
+    self.h_init = h_init
+
+  def reverse_sde(self, x, t, condition):
+    """Drift of the reverse SDE in reverse time and its diffusion."""
+    drift, diffusion = self.rsde.sde(x, t)
+    return -drift, diffusion
+
+  def propose(self, x, t, h, x_prev, condition=None):
+    """One proposal of the adaptive solver from t to t - h.
+    Args:
+      x: The current states.
+      t: A PyTorch tensor with the current time of every sample.
+      h: A PyTorch tensor with the step size of every sample.
+      x_prev: The Euler-Maruyama proposals x' of the last accepted steps.
+      condition: The condition of the conditional predictor; a function of the time.
+    Returns:
+      x' (the low-order proposal), x'' (the high-order proposal), x'' without the noise
+      and the scaled error of every sample.
+    """
+    expand = (...,) + (None,) * len(x.shape[1:])
+    sqrt_h = torch.sqrt(h)[expand]
+    z = rng.randn_like(x, self.noise)
+    drift, diffusion = self.reverse_sde(x, t, condition)
+    x_low_mean = x + h[expand] * drift
+    x_low = x_low_mean + diffusion[expand] * sqrt_h * z
+    drift_next, diffusion_next = self.reverse_sde(x_low, t - h, condition)
+    x_high_mean = x + 0.5 * h[expand] * (drift + drift_next)
+    x_high = x_high_mean + 0.5 * (diffusion + diffusion_next)[expand] * sqrt_h * z
+
+    delta = torch.maximum(torch.full_like(x, self.abstol), self.reltol * torch.maximum(x_low.abs(), x_prev.abs()))
+    error = torch.sqrt(torch.mean(((x_low - x_high) / delta).reshape(x.shape[0], -1) ** 2, dim=-1))
+    return x_low, x_high, x_high_mean, error
+
+  def next_step_size(self, h, error):
+    return self.safety * h * error.clamp(min=1e-10) ** (-self.exponent)
+
+  def update_fn(self, x, t, coeffs=None):
+    """Improved Euler step of the size of the time grid (1/N if the grid is unknown)."""
+    h = torch.ones_like(t) * (coeffs['dt'] if coeffs is not None else 1. / self.rsde.N)
+    _, x, x_mean, _ = self.propose(x, t, h, x)
+    return x, x_mean
+
+
+@register_predictor(name='conditional_adaptive')
+class conditionalAdaptivePredictor(AdaptivePredictor):
+  def reverse_sde(self, x, t, condition):
+    drift, diffusion = self.rsde.sde(x, condition(t), t)
+    return -drift, diffusion
+
+  def update_fn(self, x, y, t, coeffs=None):
+    h = torch.ones_like(t) * (coeffs['dt'] if coeffs is not None else 1. / self.rsde.N)
+    _, x, x_mean, _ = self.propose(x, t, h, x, lambda t: y)
+    return x, x_mean
 
 
 @register_predictor(name='none')
@@ -186,7 +351,7 @@ class NonePredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     pass
 
-  def update_fn(self, x, t):
+  def update_fn(self, x, t, coeffs=None):
     return x, x
 
 @register_predictor(name='conditional_none')
@@ -196,5 +361,5 @@ class NonePredictor(Predictor):
   def __init__(self, sde, score_fn, probability_flow=False):
     pass
 
-  def update_fn(self, x, y, t):
+  def update_fn(self, x, y, t, coeffs=None):
     return x, x
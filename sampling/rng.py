@@ -0,0 +1,100 @@
+"""Per-sample, counter-based noise streams for reproducible sampling.
+
+The samplers draw their noise from the global RNG by default, so a sample depends on the other
+samples of its batch and on the order of the batches. With a `SampleNoise` every sample has its own
+seed and the k-th draw of the sampler for that sample uses a generator seeded with a hash of
+(seed, k). The trajectory of a sample then only depends on its seed, whatever the batch size, the
+batch composition or the number of processes that share the test set.
+
+This costs a Python loop over the batch on every draw: one reseed of the generator and one
+`torch.randn` call per sample and per step, instead of a single `torch.randn_like` of the batch. With
+large batches of small samples, or on a GPU where every call is a kernel launch, the noise can take a
+noticeable share of the step. The draws are written into one preallocated tensor (or into the
+`out` buffer of the in-place mode), so the loop does not allocate per sample.
+"""
+import torch
+
+_MASK = (1 << 64) - 1
+#the draw counter of the prior sample, kept apart from the counters of the steps
+_PRIOR_KEY = _MASK
+
+
+def _eager(fn):
+  """Keep `fn` out of `torch.compile` graphs, which would specialize on the seeds."""
+  compiler = getattr(torch, 'compiler', None)
+  return compiler.disable(fn) if hasattr(compiler, 'disable') else fn
+
+
+def _splitmix64(z):
+  z = (z + 0x9E3779B97F4A7C15) & _MASK
+  z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+  z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+  return z ^ (z >> 31)
+
+
+def mix_seed(*keys):
+  """A 63-bit seed that hashes the integer keys (e.g. a base seed, a sample index and a draw)."""
+  h = 0
+  for key in keys:
+    h = _splitmix64(h ^ (int(key) & _MASK))
+  return h >> 1
+
+
+def sample_seeds(base_seed, indices, *keys):
+  """The seeds of the samples with the given (dataset) indices, e.g. `sample_seeds(config.seed, indices, snr_key, draw)`."""
+  return [mix_seed(base_seed, index, *keys) for index in indices]
+
+
+class SampleNoise:
+  """Standard normal noise drawn from one stream per sample."""
+
+  def __init__(self, seeds):
+    self.seeds = [int(seed) for seed in seeds]
+    self.counter = 0
+    self.generators = {}
+
+  def generator(self, device):
+    device = torch.device(device)
+    if device not in self.generators:
+      self.generators[device] = torch.Generator(device=device)
+    return self.generators[device]
+
+  @_eager
+  def randn_like(self, x, out=None):
+    """The next draw of every stream, in a tensor like `x` whose first dimension indexes the samples.
+    With `out` (a contiguous tensor like `x`) the draws are written into it sample by sample."""
+    if x.shape[0] != len(self.seeds):
+      raise ValueError(f'Got a batch of {x.shape[0]} samples for {len(self.seeds)} seeds.')
+    noise = torch.empty_like(x, memory_format=torch.contiguous_format) if out is None else out
+    generator = self.generator(x.device)
+    for b, seed in enumerate(self.seeds):
+      generator.manual_seed(mix_seed(seed, self.counter))
+      torch.randn(x.shape[1:], generator=generator, out=noise[b])
+    self.counter += 1
+    return noise
+
+  def prior_sampling(self, sde, shape):
+    """`sde.prior_sampling(shape)` with the prior sample of every stream. The priors draw from the
+    global cpu RNG, which is seeded per sample and restored afterwards."""
+    samples = None
+    for b, seed in enumerate(self.seeds):
+      with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(mix_seed(seed, _PRIOR_KEY))
+        sample = sde.prior_sampling([1] + list(shape[1:]))
+      if samples is None:
+        samples = sample.new_empty([len(self.seeds)] + list(sample.shape[1:]))
+      samples[b] = sample[0]
+    return samples
+
+
+def get_sample_noise(seeds):
+  """A `SampleNoise` for the seeds, or `None` (the global RNG) if `seeds` is `None`."""
+  return None if seeds is None else SampleNoise(seeds)
+
+
+def randn_like(x, noise=None):
+  return torch.randn_like(x) if noise is None else noise.randn_like(x)
+
+
+def prior_sampling(sde, shape, noise=None):
+  return sde.prior_sampling(shape) if noise is None else noise.prior_sampling(sde, shape)
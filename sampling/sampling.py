@@ -26,6 +26,7 @@ from models.utils import from_flattened_numpy, to_flattened_numpy, get_score_fn
 from scipy import integrate
 import sde_lib
 from models import utils as mutils
+from sampling import ode_solvers
 
 _CORRECTORS = {}
 _PREDICTORS = {}
@@ -98,7 +99,9 @@ def get_sampling_fn(config, sde, shape, inverse_scaler, eps):
                                   inverse_scaler=inverse_scaler,
                                   denoise=config.sampling.noise_removal,
                                   eps=eps,
-                                  device=config.device)
+                                  device=config.device,
+                                  solver=config.sampling.get('ode_solver', 'torch'),
+                                  step_control=config.sampling.get('ode_step_control', 'batch'))
   # Predictor-Corrector sampling. Predictor-only and Corrector-only samplers are special cases.
   elif sampler_name.lower() == 'pc':
     predictor = get_predictor(config.sampling.predictor.lower())
@@ -416,7 +419,7 @@ def get_pc_sampler(sde, shape, predictor, corrector, snr,
 
 
 def get_ode_sampler(sde, shape, denoise=False, rtol=1e-5, atol=1e-5,
-                    method='RK45', eps=1e-3, device='cuda'):
+                    method='RK45', eps=1e-3, device='cuda', solver='torch', step_control='batch'):
   """Probability flow ODE sampler with the black-box ODE solver.
   Args:
     sde: An `sde_lib.SDE` object that represents the forward SDE.
@@ -428,6 +431,10 @@ def get_ode_sampler(sde, shape, denoise=False, rtol=1e-5, atol=1e-5,
     method: A `str`. The algorithm used for the black-box ODE solver.
       See the documentation of `scipy.integrate.solve_ivp`.
     eps: A `float` number. The reverse-time SDE/ODE will be integrated to `eps` for numerical stability.
+    solver: 'torch' keeps the state on the device and uses `sampling.ode_solvers.solve_ivp`.
+      'scipy' uses the black-box solver of `scipy.integrate.solve_ivp` on the host.
+    step_control: 'batch' treats the whole batch as one ODE system. 'per_sample' gives every sample
+      its own step size and error norm (torch solver only). The NFE is then reported per sample.
     device: PyTorch device.
   Returns:
     A sampling function that returns samples and the number of function evaluations during sampling.
@@ -463,17 +470,39 @@ def get_ode_sampler(sde, shape, denoise=False, rtol=1e-5, atol=1e-5,
       else:
         x = z
 
-      def ode_func(t, x):
-        x = from_flattened_numpy(x, shape).to(device).type(torch.float32)
-        vec_t = torch.ones(shape[0], device=x.device) * t
-        drift = drift_fn(model, x, vec_t)
-        return to_flattened_numpy(drift)
-
-      # Black-box ODE solver for the probability flow ODE
-      solution = integrate.solve_ivp(ode_func, (sde.T, eps), to_flattened_numpy(x),
-                                     rtol=rtol, atol=atol, method=method)
-      nfe = solution.nfev
-      x = torch.tensor(solution.y[:, -1]).reshape(shape).to(device).type(torch.float32)
+      if solver == 'torch' and step_control == 'per_sample':
+        def ode_func(vec_t, x, index):
+          return drift_fn(model, x, vec_t)
+
+        # Adaptive RK45 with one step size per sample. Converged samples drop out of the batch.
+        solution = ode_solvers.solve_ivp_per_sample(ode_func, (sde.T, eps), x.type(torch.float32),
+                                                    rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = solution.y
+      elif solver == 'torch':
+        def ode_func(t, x):
+          vec_t = torch.ones(shape[0], device=x.device) * t
+          return drift_fn(model, x, vec_t)
+
+        # Adaptive RK45 on the device of the state
+        solution = ode_solvers.solve_ivp(ode_func, (sde.T, eps), x.type(torch.float32),
+                                         rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = solution.y
+      elif solver == 'scipy':
+        def ode_func(t, x):
+          x = from_flattened_numpy(x, shape).to(device).type(torch.float32)
+          vec_t = torch.ones(shape[0], device=x.device) * t
+          drift = drift_fn(model, x, vec_t)
+          return to_flattened_numpy(drift)
+
+        # Black-box ODE solver for the probability flow ODE
+        solution = integrate.solve_ivp(ode_func, (sde.T, eps), to_flattened_numpy(x),
+                                       rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = torch.tensor(solution.y[:, -1]).reshape(shape).to(device).type(torch.float32)
+      else:
+        raise NotImplementedError(f"ODE solver {solver} unknown.")
 
       # Denoising is equivalent to running one predictor step without adding noise
       if denoise:
@@ -0,0 +1,202 @@
+"""Time-discretization schedules of the samplers.
+
+A schedule maps (sde, num_steps, eps, device) to a decreasing 1-D tensor of times from `sde.T`
+to `eps`. Schedules defined on the noise level are mapped back to times by inverting the std of
+the perturbation kernel numerically, so they work for every SDE. If the prior of the SDE is at
+`sde.t_start < sde.T` (a fitted Gaussian prior), the grid starts at `t_start` and keeps the times
+of the schedule below it.
+
+The corrector schedules at the end of the file set the number of corrector updates per time.
+"""
+import functools
+import numpy as np
+import torch
+
+_SCHEDULES = {}
+
+
+def register_schedule(func=None, *, name=None):
+  """A decorator for registering schedule functions."""
+
+  def _register(func):
+    if name is None:
+      local_name = func.__name__
+    else:
+      local_name = name
+    if local_name in _SCHEDULES:
+      raise ValueError(f'Already registered schedule with name: {local_name}')
+    _SCHEDULES[local_name] = func
+    return func
+
+  if func is None:
+    return _register
+  else:
+    return _register(func)
+
+
+def get_schedule(name):
+  return _SCHEDULES[name]
+
+
+def get_schedule_fn(config, schedule='default'):
+  """The schedule selected by `schedule` or `config.sampling.schedule` (default 'uniform'),
+  with its options (`config.sampling.schedule_rho`, `config.sampling.schedule_file`) bound."""
+  if schedule == 'default':
+    schedule = config.sampling.get('schedule', 'uniform')
+  if callable(schedule):
+    return schedule
+  return functools.partial(get_schedule(schedule.lower()),
+                           rho=config.sampling.get('schedule_rho', 7.),
+                           path=config.sampling.get('schedule_file', None))
+
+
+def get_timesteps(sde, num_steps, eps, schedule=None, device='cpu'):
+  """The sampling times.
+  Args:
+    sde: An `sde_lib.SDE` object.
+    num_steps: The number of times.
+    eps: The last time.
+    schedule: `None` (uniform), the name of a registered schedule or a schedule function.
+    device: The device of the returned times.
+  Returns:
+    A decreasing float32 tensor of times. Its length can differ from `num_steps` for the
+    'file' schedule and for SDEs whose prior is at `t_start < T`.
+  """
+  if schedule is None:
+    schedule = 'uniform'
+  if isinstance(schedule, str):
+    schedule = get_schedule(schedule.lower())
+  timesteps = schedule(sde, num_steps, eps, device=device).to(device=device, dtype=torch.float32)
+  if sde.t_start < sde.T:
+    timesteps = start_at(timesteps, sde.t_start)
+  return timesteps
+
+
+def start_at(timesteps, t_start):
+  """The times of the grid below `t_start`, preceded by `t_start`."""
+  return torch.cat([timesteps.new_tensor([t_start]), timesteps[timesteps < t_start]])
+
+
+def std_to_time(sde, stds, eps, resolution=10000):
+  """Invert the std of the perturbation kernel of `sde` on [eps, T] by linear interpolation."""
+  grid = torch.linspace(eps, sde.T, resolution, dtype=torch.float64)
+  grid_stds = sde.marginal_prob(torch.ones_like(grid), grid)[1]
+  times = np.interp(stds.numpy(), grid_stds.numpy(), grid.numpy())
+  return torch.from_numpy(times)
+
+
+def _std_bounds(sde, eps):
+  t = torch.tensor([sde.T, eps], dtype=torch.float64)
+  std_max, std_min = sde.marginal_prob(torch.ones_like(t), t)[1]
+  return std_max.item(), std_min.item()
+
+
+def _pin_end_points(sde, timesteps, eps):
+  # Round-off of the inversion must not move the first and last times.
+  timesteps[0], timesteps[-1] = sde.T, eps
+  return timesteps
+
+
+@register_schedule(name='uniform')
+def uniform(sde, num_steps, eps, device='cpu', **kwargs):
+  """Uniformly spaced times (the grid of the original samplers)."""
+  return torch.linspace(sde.T, eps, num_steps, device=device)
+
+
+@register_schedule(name='quadratic')
+def quadratic(sde, num_steps, eps, device='cpu', **kwargs):
+  """Times quadratically spaced, i.e. denser close to `eps`."""
+  u = torch.linspace(1., 0., num_steps, dtype=torch.float64)
+  return eps + (sde.T - eps) * u ** 2
+
+
+@register_schedule(name='log_sigma')
+def log_sigma(sde, num_steps, eps, device='cpu', **kwargs):
+  """Times whose noise levels (std of the perturbation kernel) are uniformly spaced in log scale."""
+  std_max, std_min = _std_bounds(sde, eps)
+  stds = torch.exp(torch.linspace(np.log(std_max), np.log(std_min), num_steps, dtype=torch.float64))
+  return _pin_end_points(sde, std_to_time(sde, stds, eps), eps)
+
+
+@register_schedule(name='karras')
+def karras(sde, num_steps, eps, device='cpu', rho=7., **kwargs):
+  """The noise levels of Karras et al. (2022): uniformly spaced in std^(1/rho)."""
+  std_max, std_min = _std_bounds(sde, eps)
+  u = torch.linspace(0., 1., num_steps, dtype=torch.float64)
+  stds = (std_max ** (1 / rho) + u * (std_min ** (1 / rho) - std_max ** (1 / rho))) ** rho
+  return _pin_end_points(sde, std_to_time(sde, stds, eps), eps)
+
+
+@register_schedule(name='file')
+def from_file(sde, num_steps, eps, device='cpu', path=None, **kwargs):
+  """Times loaded from a .npy or text file (`config.sampling.schedule_file`). `num_steps` is ignored."""
+  if path is None:
+    raise ValueError('The file schedule needs config.sampling.schedule_file.')
+  times = np.load(path) if path.endswith('.npy') else np.loadtxt(path)
+  times = torch.from_numpy(np.asarray(times, dtype=np.float64).reshape(-1))
+  if times.numel() < 2 or not bool(torch.all(times[1:] < times[:-1])):
+    raise ValueError(f'The schedule in {path} must contain at least two strictly decreasing times.')
+  return times
+
+
+# Corrector schedules: the number of corrector updates before the predictor update at the i-th
+# time t of the grid. Most corrector steps at high noise levels are wasted, so the budget can be
+# concentrated on the low noise levels.
+
+def constant_corrector_schedule(steps=1):
+  """The same number of corrector updates at every time (the original samplers use 1)."""
+  return lambda i, t: steps
+
+
+def piecewise_corrector_schedule(boundaries, values):
+  """values[k] corrector updates for boundaries[k-1] <= t < boundaries[k].
+  Args:
+    boundaries: Increasing times.
+    values: Number of corrector updates, one more than `boundaries`.
+  """
+  if len(values) != len(boundaries) + 1:
+    raise ValueError('A piecewise corrector schedule needs one more value than boundaries.')
+  boundaries = np.asarray(boundaries, dtype=np.float64)
+  return lambda i, t: int(values[np.searchsorted(boundaries, t, side='right')])
+
+
+def below_corrector_schedule(t_star, steps=1):
+  """`steps` corrector updates for t < t_star, none above."""
+  return lambda i, t: steps if t < t_star else 0
+
+
+def get_corrector_schedule_fn(config, corrector_schedule='default'):
+  """The corrector schedule selected by `corrector_schedule`, else by `config.eval.corrector_schedule`,
+  else by `config.sampling.corrector_schedule` (default 'constant'). Its options are read from
+  the same section: corrector_steps, corrector_boundaries and corrector_values (piecewise),
+  corrector_t_star (below).
+  Args:
+    corrector_schedule: 'default', 'constant', 'piecewise', 'below' or a function (i, t) -> int.
+  Returns:
+    A function (i, t) -> number of corrector updates.
+  """
+  section = config.sampling
+  if corrector_schedule == 'default':
+    eval_config = config.get('eval', None)
+    if eval_config is not None and 'corrector_schedule' in eval_config:
+      section = eval_config
+    corrector_schedule = section.get('corrector_schedule', 'constant')
+  if callable(corrector_schedule):
+    return corrector_schedule
+
+  name = corrector_schedule.lower()
+  if name == 'constant':
+    return constant_corrector_schedule(section.get('corrector_steps', 1))
+  elif name == 'piecewise':
+    return piecewise_corrector_schedule(section.corrector_boundaries, section.corrector_values)
+  elif name == 'below':
+    return below_corrector_schedule(section.corrector_t_star, section.get('corrector_steps', 1))
+  else:
+    raise ValueError(f"Corrector schedule {corrector_schedule} unknown.")
+
+
+def get_corrector_budget(corrector_schedule, timesteps):
+  """The number of corrector updates at every time of the grid, as a list of ints."""
+  if corrector_schedule is None:
+    corrector_schedule = constant_corrector_schedule()
+  return [int(corrector_schedule(i, t)) for i, t in enumerate(timesteps.tolist())]
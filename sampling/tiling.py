@@ -0,0 +1,121 @@
+"""Tiled evaluation of the conditional score for inputs that are too large for one forward pass.
+
+The spatial dimensions of x and y are split into overlapping tiles, the score of all tiles is
+evaluated in batched forward passes and the tile scores are blended back with a window that
+rises smoothly over the overlaps. The score is blended at every step (not the samples at the end),
+so the neighbouring tiles see the same state and the seams stay consistent along the trajectory.
+The memory of the score network is bounded by the tile size times the number of tiles per pass.
+The tiles can have any number of spatial dimensions (images, or sub-volumes of 3D volumes).
+"""
+import functools
+import itertools
+import numpy as np
+import torch
+
+
+def _to_tuple(value, ndim):
+  if isinstance(value, (tuple, list)):
+    if len(value) != ndim:
+      raise ValueError(f'Expected {ndim} values, got {list(value)}.')
+    return tuple(value)
+  return (value,) * ndim
+
+
+def tile_starts(length, tile_size, overlap):
+  """The first index of every tile along a dimension of size `length`. The last tile ends at `length`."""
+  if tile_size >= length:
+    return [0]
+  stride = tile_size - overlap
+  if stride <= 0:
+    raise ValueError(f'The overlap {overlap} must be smaller than the tile size {tile_size}.')
+  starts = list(range(0, length - tile_size, stride))
+  starts.append(length - tile_size)
+  return starts
+
+
+def blending_window(tile_size, overlap):
+  """Separable weights of a tile: 1 in the interior, rising as sin^2 over the overlap at both ends.
+  The weights are positive everywhere, so the borders of the image (covered by one tile) keep their score."""
+  window = torch.ones(())
+  for size, width in zip(tile_size, overlap):
+    ramp = torch.ones(size)
+    width = min(width, size)
+    if width > 0:
+      rise = torch.sin(0.5 * np.pi * (torch.arange(width) + 0.5) / width) ** 2
+      ramp[:width] = rise
+      ramp[size - width:] = torch.minimum(ramp[size - width:], rise.flip(0))
+    window = window[..., None] * ramp
+  return window
+
+
+class TiledScoreFn:
+  """Conditional score function (x, y, t) -> score evaluated on overlapping tiles of x and y."""
+
+  def __init__(self, score_fn, tile_size, overlap=None, batch_size=None, stride=None):
+    """Configure the tiling.
+    Args:
+      score_fn: A conditional score function (x, y, t) -> score of x.
+      tile_size: The size of the tiles, an integer or one integer per spatial dimension.
+      overlap: The overlap of neighbouring tiles (same format). A quarter of the tile size if `None`.
+      batch_size: The maximum number of samples (tiles times batch size) per forward pass. All tiles
+        go through the network in one forward pass if `None`.
+      stride: The distance of neighbouring tiles (same format). It replaces `overlap` if given.
+    """
+    self.score_fn = score_fn
+    self.tile_size = tile_size
+    self.overlap = overlap
+    self.batch_size = batch_size
+    self.stride = stride
+    self.grids = {}
+
+  def get_grid(self, spatial_shape, device):
+    """The tiles of an input of the given spatial shape and the blending weights (cached)."""
+    key = (tuple(spatial_shape), device)
+    if key not in self.grids:
+      ndim = len(spatial_shape)
+      tile_size = tuple(min(t, s) for t, s in zip(_to_tuple(self.tile_size, ndim), spatial_shape))
+      if self.stride is not None:
+        overlap = tuple(max(0, t - s) for t, s in zip(tile_size, _to_tuple(self.stride, ndim)))
+      elif self.overlap is not None:
+        overlap = _to_tuple(self.overlap, ndim)
+      else:
+        overlap = tuple(t // 4 for t in tile_size)
+      starts = [tile_starts(s, t, o) for s, t, o in zip(spatial_shape, tile_size, overlap)]
+      regions = [tuple(slice(a, a + t) for a, t in zip(start, tile_size)) for start in itertools.product(*starts)]
+      window = blending_window(tile_size, overlap).to(device)
+      normalization = torch.zeros(spatial_shape, device=device)
+      for region in regions:
+        normalization[region] += window
+      self.grids[key] = (regions, window, normalization)
+    return self.grids[key]
+
+  def __call__(self, x, y, t):
+    spatial_shape = x.shape[2:]
+    if y.shape[2:] != spatial_shape:
+      raise ValueError(f'Tiled sampling needs a condition of the spatial size of x, got {list(y.shape[2:])} and {list(spatial_shape)}.')
+    regions, window, normalization = self.get_grid(spatial_shape, x.device)
+    batch_size = x.shape[0]
+    tiles_per_pass = len(regions) if self.batch_size is None else max(1, self.batch_size // batch_size)
+
+    score = torch.zeros_like(x)
+    for first in range(0, len(regions), tiles_per_pass):
+      chunk = regions[first:first + tiles_per_pass]
+      x_tiles = torch.cat([x[(..., *region)] for region in chunk], dim=0)
+      y_tiles = torch.cat([y[(..., *region)] for region in chunk], dim=0)
+      tile_scores = self.score_fn(x_tiles, y_tiles, t.repeat(len(chunk)))
+      for j, region in enumerate(chunk):
+        score[(..., *region)] += tile_scores[j * batch_size:(j + 1) * batch_size] * window
+    return score / normalization
+
+
+def get_tiling_fn(config):
+  """A function score_fn -> `TiledScoreFn` configured by `config.sampling.tile_size`,
+  `tile_overlap` (or `tile_stride`) and `tile_batch_size`, or `None` if `tile_size` is not set."""
+  tile_size = config.sampling.get('tile_size', None)
+  if tile_size is None:
+    return None
+  return functools.partial(TiledScoreFn,
+                           tile_size=tile_size,
+                           overlap=config.sampling.get('tile_overlap', None),
+                           batch_size=config.sampling.get('tile_batch_size', None),
+                           stride=config.sampling.get('tile_stride', None))
@@ -1,5 +1,16 @@
-from sampling.predictors import get_predictor, ReverseDiffusionPredictor, NonePredictor
-from sampling.correctors import get_corrector, NoneCorrector
+from sampling.predictors import get_predictor, ReverseDiffusionPredictor
+from sampling.correctors import get_corrector
+from sampling import ode_solvers
+from sampling import adaptive
+from sampling import schedules
+from sampling import evolution
+from sampling import rng
+from sampling import checkpoint as checkpoint_lib
+from sampling import compilation
+from sampling import precision as precision_lib
+from sampling.dpm_solver import get_dpm_solver_sampler
+from sampling.parallel import get_picard_sampler
+from sampling.plan import SamplingPlan
 from tqdm import tqdm
 import functools
 import torch
@@ -8,11 +19,10 @@ import abc
 from models.utils import from_flattened_numpy, to_flattened_numpy, get_score_fn
 from scipy import integrate
 import sde_lib
-from models import utils as mutils
 
 def get_sampling_fn(config, sde, shape, eps,
                     predictor='default', corrector='default', p_steps='default', 
-                    c_steps='default', snr='default', denoise='default'):
+                    c_steps='default', snr='default', denoise='default', schedule='default', precision='default'):
 
   """Create a sampling function.
   Args:
@@ -20,6 +30,9 @@ def get_sampling_fn(config, sde, shape, eps,
     sde: A `sde_lib.SDE` object that represents the forward SDE.
     shape: A sequence of integers representing the expected shape of a single sample.
     eps: A `float` number. The reverse-time SDE is only integrated to `eps` for numerical stability.
+    schedule: The name of a time schedule of `sampling.schedules`, or 'default' for `config.sampling.schedule`.
+    precision: The precision of the score network (see `sampling.precision`), or 'default' for
+      `config.sampling.precision` (float32 if not set).
   Returns:
     A function that takes random states and a replicated training state and outputs samples with the
       trailing dimensions matching `shape`.
@@ -35,8 +48,13 @@ def get_sampling_fn(config, sde, shape, eps,
   else:
     corrector = get_corrector(corrector.lower())
 
+  sampler_name = config.sampling.method
+
   if p_steps == 'default':
-    p_steps = config.model.num_scales
+    if sampler_name.lower() == 'dpm_solver':
+      p_steps = config.sampling.get('dpm_solver_steps', 20)
+    else:
+      p_steps = config.model.num_scales
 
   if c_steps == 'default':
     c_steps = config.sampling.n_steps_each
@@ -47,14 +65,21 @@ def get_sampling_fn(config, sde, shape, eps,
   if denoise == 'default':
     denoise = config.sampling.noise_removal
 
-  sampler_name = config.sampling.method
+  if precision == 'default':
+    precision = config.sampling.get('precision', 'float32')
+
+  # The DPM-Solver keeps its own logSNR spacing unless a schedule is selected explicitly.
+  use_schedule = schedule != 'default' or 'schedule' in config.sampling
+  schedule = schedules.get_schedule_fn(config, schedule)
 
   # Probability flow ODE sampling with black-box ODE solvers
   if sampler_name.lower() == 'ode':
     sampling_fn = get_ode_sampler(sde=sde,
                                   shape=shape,
                                   denoise=denoise,
-                                  eps=eps)
+                                  eps=eps,
+                                  solver=config.sampling.get('ode_solver', 'torch'),
+                                  step_control=config.sampling.get('ode_step_control', 'batch'))
 
   # Predictor-Corrector sampling. Predictor-only and Corrector-only samplers are special cases.
   elif sampler_name.lower() == 'pc':
@@ -68,14 +93,41 @@ def get_sampling_fn(config, sde, shape, eps,
                                  probability_flow=config.sampling.probability_flow,
                                  continuous=config.training.continuous,
                                  denoise=denoise,
-                                 eps=eps)
+                                 eps=eps,
+                                 predictor_kwargs=adaptive.get_predictor_kwargs(config, predictor),
+                                 schedule=schedule,
+                                 inplace=config.sampling.get('inplace', False),
+                                 compiler=compilation.get_step_compiler(config))
+  # Multistep DPM-Solver++ for the probability flow ODE. p_steps is the number of solver steps.
+  elif sampler_name.lower() == 'dpm_solver':
+    sampling_fn = get_dpm_solver_sampler(sde=sde,
+                                         shape=shape,
+                                         steps=p_steps,
+                                         order=config.sampling.get('dpm_solver_order', 2),
+                                         skip_type=config.sampling.get('dpm_solver_skip_type', 'logSNR'),
+                                         continuous=config.training.continuous,
+                                         denoise=denoise,
+                                         eps=eps,
+                                         schedule=schedule if use_schedule else None)
+  # Parallel-in-time Euler-Maruyama sampling by Picard iterations over windows of steps.
+  elif sampler_name.lower() == 'picard':
+    sampling_fn = get_picard_sampler(sde=sde,
+                                     shape=shape,
+                                     p_steps=p_steps,
+                                     window=config.sampling.get('picard_window', 16),
+                                     tolerance=config.sampling.get('picard_tolerance', 0.1),
+                                     probability_flow=config.sampling.probability_flow,
+                                     continuous=config.training.continuous,
+                                     denoise=denoise,
+                                     eps=eps,
+                                     schedule=schedule)
   else:
     raise ValueError(f"Sampler name {sampler_name} unknown.")
 
-  return sampling_fn
+  return precision_lib.with_precision(sampling_fn, precision)
 
 
-def get_inpainting_fn(config, sde, eps, n_steps_each=1):
+def get_inpainting_fn(config, sde, eps, n_steps_each=1, schedule='default', corrector_schedule='default'):
   '''create the inpainting function'''
   predictor = get_predictor(config.sampling.predictor.lower())
   corrector = get_corrector(config.sampling.corrector.lower())
@@ -87,12 +139,14 @@ def get_inpainting_fn(config, sde, eps, n_steps_each=1):
                                  probability_flow=config.sampling.probability_flow, 
                                  continuous=config.training.continuous,
                                  denoise=config.sampling.noise_removal, 
-                                 eps=eps)
+                                 eps=eps,
+                                 schedule=schedules.get_schedule_fn(config, schedule),
+                                 corrector_schedule=schedules.get_corrector_schedule_fn(config, corrector_schedule))
   return sampling_fn
 
 def get_ode_sampler(sde, shape,
                     denoise=False, rtol=1e-5, atol=1e-5,
-                    method='RK45', eps=1e-3):
+                    method='RK45', eps=1e-3, solver='torch', step_control='batch'):
   """Probability flow ODE sampler with the black-box ODE solver.
   Args:
     sde: An `sde_lib.SDE` object that represents the forward SDE.
@@ -103,6 +157,10 @@ def get_ode_sampler(sde, shape,
     method: A `str`. The algorithm used for the black-box ODE solver.
       See the documentation of `scipy.integrate.solve_ivp`.
     eps: A `float` number. The reverse-time SDE/ODE will be integrated to `eps` for numerical stability.
+    solver: 'torch' keeps the state on the device and uses `sampling.ode_solvers.solve_ivp`.
+      'scipy' uses the black-box solver of `scipy.integrate.solve_ivp` on the host.
+    step_control: 'batch' treats the whole batch as one ODE system. 'per_sample' gives every sample
+      its own step size and error norm (torch solver only). The NFE is then reported per sample.
   Returns:
     A sampling function that returns samples and the number of function evaluations during sampling.
   """
@@ -137,17 +195,39 @@ def get_ode_sampler(sde, shape,
       else:
         x = z
 
-      def ode_func(t, x):
-        x = from_flattened_numpy(x, shape).to(model.device).type(torch.float32)
-        vec_t = torch.ones(shape[0], device=x.device) * t
-        drift = drift_fn(model, x, vec_t)
-        return to_flattened_numpy(drift)
-
-      # Black-box ODE solver for the probability flow ODE
-      solution = integrate.solve_ivp(ode_func, (sde.T, eps), to_flattened_numpy(x),
-                                     rtol=rtol, atol=atol, method=method)
-      nfe = solution.nfev
-      x = torch.tensor(solution.y[:, -1]).reshape(shape).to(model.device).type(torch.float32)
+      if solver == 'torch' and step_control == 'per_sample':
+        def ode_func(vec_t, x, index):
+          return drift_fn(model, x, vec_t)
+
+        # Adaptive RK45 with one step size per sample. Converged samples drop out of the batch.
+        solution = ode_solvers.solve_ivp_per_sample(ode_func, (sde.t_start, eps), x.type(torch.float32),
+                                                    rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = solution.y
+      elif solver == 'torch':
+        def ode_func(t, x):
+          vec_t = torch.ones(shape[0], device=x.device) * t
+          return drift_fn(model, x, vec_t)
+
+        # Adaptive RK45 on the device of the state
+        solution = ode_solvers.solve_ivp(ode_func, (sde.t_start, eps), x.type(torch.float32),
+                                         rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = solution.y
+      elif solver == 'scipy':
+        def ode_func(t, x):
+          x = from_flattened_numpy(x, shape).to(model.device).type(torch.float32)
+          vec_t = torch.ones(shape[0], device=x.device) * t
+          drift = drift_fn(model, x, vec_t)
+          return to_flattened_numpy(drift)
+
+        # Black-box ODE solver for the probability flow ODE
+        solution = integrate.solve_ivp(ode_func, (sde.t_start, eps), to_flattened_numpy(x),
+                                       rtol=rtol, atol=atol, method=method)
+        nfe = solution.nfev
+        x = torch.tensor(solution.y[:, -1]).reshape(shape).to(model.device).type(torch.float32)
+      else:
+        raise NotImplementedError(f"ODE solver {solver} unknown.")
 
       # Denoising is equivalent to running one predictor step without adding noise
       if denoise:
@@ -160,7 +240,7 @@ def get_ode_sampler(sde, shape,
 
 def get_pc_sampler(sde, shape, predictor, corrector, snr, 
                    p_steps, c_steps, probability_flow=False, continuous=False,
-                   denoise=True, eps=1e-3):
+                   denoise=True, eps=1e-3, predictor_kwargs=None, schedule=None, inplace=False, compiler=None):
 
   """Create a Predictor-Corrector (PC) sampler.
   Args:
@@ -169,67 +249,84 @@ def get_pc_sampler(sde, shape, predictor, corrector, snr,
     predictor: A subclass of `sampling.Predictor` representing the predictor algorithm.
     corrector: A subclass of `sampling.Corrector` representing the corrector algorithm.
     inverse_scaler: The inverse data normalizer. -> not used anymore
-    snr: A `float` number. The signal-to-noise ratio for configuring correctors.
+    snr: A `float` number or a tensor with the SNR of every sample. The signal-to-noise ratio for configuring correctors.
     n_steps: An integer. The number of corrector steps per predictor update.
     probability_flow: If `True`, solve the reverse-time probability flow ODE when running the predictor.
     continuous: `True` indicates that the score model was continuously trained.
     denoise: If `True`, add one-step denoising to the final samples.
     eps: A `float` number. The reverse-time SDE and ODE are integrated to `epsilon` to avoid numerical issues.
+    predictor_kwargs: Optional dict of extra arguments of the predictor. With an adaptive predictor
+      the fixed grid of `p_steps` times is replaced by adaptive step sizes.
+    schedule: The time schedule (see `sampling.schedules.get_timesteps`). Uniform if `None`.
+    inplace: If `True`, the updates write into preallocated buffers (see `sampling.plan`).
+    compiler: Optional `sampling.compilation.StepCompiler` compiling the predictor and corrector updates.
   Returns:
     A sampling function that returns samples and the number of function evaluations during sampling.
   """
-  # Create predictor & corrector update functions
-  predictor_update_fn = functools.partial(shared_predictor_update_fn,
-                                          sde=sde,
-                                          predictor=predictor,
-                                          probability_flow=probability_flow,
-                                          continuous=continuous)
-  corrector_update_fn = functools.partial(shared_corrector_update_fn,
-                                          sde=sde,
-                                          corrector=corrector,
-                                          continuous=continuous,
-                                          snr=snr,
-                                          n_steps=c_steps)
-
-  def pc_sampler(model, show_evolution=False):
+  def pc_sampler(model, show_evolution=False, checkpoint=None, seeds=None):
     """ The PC sampler funciton.
     Args:
       model: A score model.
+      checkpoint: Optional `sampling.checkpoint.SamplingCheckpointer`. The trajectory continues
+        from its last snapshot and is snapshotted periodically.
+      seeds: Optional seed of every sample. The noise then comes from per-sample streams (see `sampling.rng`).
     Returns:
       Samples, number of function evaluations.
     """
-    if show_evolution:
-      evolution = []
+    recorder = evolution.get_recorder(show_evolution)
+    noise = rng.get_sample_noise(seeds)
 
     with torch.no_grad():
       # Initial sample
-      x = sde.prior_sampling(shape).to(model.device).type(torch.float32)
-      timesteps = torch.linspace(sde.T, eps, p_steps, device=model.device)
-
-      for i in tqdm(range(p_steps)):
-        t = timesteps[i]
-        vec_t = torch.ones(shape[0], device=t.device) * t
-        x, x_mean = corrector_update_fn(x, vec_t, model=model)
-        x, x_mean = predictor_update_fn(x, vec_t, model=model)
+      x = rng.prior_sampling(sde, shape, noise).to(model.device).type(torch.float32)
+      timesteps = schedules.get_timesteps(sde, p_steps, eps, schedule, device=model.device)
+      num_steps = timesteps.size(0)
+      plan = SamplingPlan(sde, model, predictor, corrector, timesteps, shape[0],
+                          snr=snr, n_steps=c_steps, probability_flow=probability_flow, continuous=continuous,
+                          predictor_kwargs=predictor_kwargs, inplace=inplace, noise=noise, compiler=compiler)
+
+      if getattr(plan.predictor, 'adaptive', False):
+        if checkpoint is not None:
+          raise ValueError('Checkpointing is not supported by the adaptive solver.')
+        x, x_mean, sampling_info = adaptive.solve_reverse_sde(plan, x, eps, show_evolution=show_evolution)
+        return x_mean if denoise else x, sampling_info
+
+      start = 0
+      if checkpoint is not None:
+        fingerprint = checkpoint_lib.get_fingerprint(model, predictor=predictor, corrector=corrector, snr=snr, c_steps=c_steps,
+                                                     timesteps=timesteps, denoise=denoise, probability_flow=probability_flow, seeds=seeds)
+        state = checkpoint.load(model.device, num_steps, x.shape, noise, fingerprint)
+        if state is not None and state['done']:
+          return state['samples'], state['sampling_info']
+        if state is not None:
+          x, x_mean, start = state['x'], state['x_mean'], state['step'] + 1
+
+      if recorder is not None:
+        recorder.start(num_steps)
+
+      for i in tqdm(range(start, num_steps)):
+        x, x_mean = plan.step(i, x)
         
-        if show_evolution:
-          evolution.append(x.cpu())
+        if recorder is not None:
+          recorder.record(i, x)
+
+        if checkpoint is not None:
+          checkpoint.step(i, num_steps, x.shape, model.device, noise=noise, x=x, x_mean=x_mean)
 
       samples = x_mean if denoise else x
 
-      if show_evolution:
-        sampling_info = {'evolution': torch.stack(evolution), 
-                        'times':timesteps, 'steps': p_steps * (c_steps + 1)}
-        return samples, sampling_info
-      else:
-        sampling_info = {'times':timesteps, 'steps': p_steps * (c_steps + 1)}
-        return samples, sampling_info
+      sampling_info = {'times':timesteps, 'steps': num_steps * (c_steps + 1)}
+      if checkpoint is not None:
+        checkpoint.finish(samples, sampling_info, num_steps, x.shape, model.device)
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return samples, sampling_info
 
   return pc_sampler
 
 def get_pc_inpainter(sde, predictor, corrector, snr,
                      n_steps=1, probability_flow=False, continuous=False,
-                     denoise=True, eps=1e-5):
+                     denoise=True, eps=1e-5, schedule=None, corrector_schedule=None):
   """Create an image inpainting function that uses PC samplers.
   Args:
     sde: An `sde_lib.SDE` object that represents the forward SDE.
@@ -241,32 +338,21 @@ def get_pc_inpainter(sde, predictor, corrector, snr,
     continuous: `True` indicates that the score-based model was trained with continuous time.
     denoise: If `True`, add one-step denoising to final samples.
     eps: A `float` number. The reverse-time SDE/ODE is integrated to `eps` for numerical stability.
+    schedule: The time schedule of `sde.N` steps (see `sampling.schedules.get_timesteps`). Uniform if `None`.
+    corrector_schedule: A function (i, t) -> number of corrector updates before the i-th predictor
+      update (see `sampling.schedules.get_corrector_schedule_fn`). One update per step if `None`.
   Returns:
     An inpainting function.
   """
-  # Define predictor & corrector
-  predictor_update_fn = functools.partial(shared_predictor_update_fn,
-                                          sde=sde,
-                                          predictor=predictor,
-                                          probability_flow=probability_flow,
-                                          continuous=continuous)
-  corrector_update_fn = functools.partial(shared_corrector_update_fn,
-                                          sde=sde,
-                                          corrector=corrector,
-                                          continuous=continuous,
-                                          snr=snr,
-                                          n_steps=n_steps)
-
   def get_inpaint_update_fn(update_fn):
     """Modify the update function of predictor & corrector to incorporate data information."""
 
-    def inpaint_update_fn(model, data, mask, x, t):
+    def inpaint_update_fn(plan, data, mask, x, i):
       with torch.no_grad():
-        vec_t = torch.ones(data.shape[0]).type_as(data) * t
-        x, x_mean = update_fn(x, vec_t, model=model)
+        x, x_mean = update_fn(plan, i, x)
         
-        masked_data_mean, std = sde.marginal_prob(data, vec_t)
-        masked_data = masked_data_mean + torch.randn_like(x) * std[(...,) + (None,) * len(x.shape[1:])]
+        masked_data_mean = plan.mean_coeff[i] * data
+        masked_data = masked_data_mean + torch.randn_like(x) * plan.std[i]
         x = x * (1. - mask) + masked_data * mask
         x_mean = x * (1. - mask) + masked_data_mean * mask
 
@@ -274,8 +360,8 @@ def get_pc_inpainter(sde, predictor, corrector, snr,
 
     return inpaint_update_fn
 
-  projector_inpaint_update_fn = get_inpaint_update_fn(predictor_update_fn)
-  corrector_inpaint_update_fn = get_inpaint_update_fn(corrector_update_fn)
+  projector_inpaint_update_fn = get_inpaint_update_fn(SamplingPlan.predictor_step)
+  corrector_inpaint_update_fn = get_inpaint_update_fn(SamplingPlan.corrector_step)
 
   def pc_inpainter(model, data, mask, show_evolution=False):
     """Predictor-Corrector (PC) sampler for image inpainting.
@@ -288,25 +374,6 @@ def get_pc_inpainter(sde, predictor, corrector, snr,
       Inpainted (complete) images.
     """
 
-    '''
-    def corrections_steps(i):
-      changing_points = [500, 750, 875, 937, 969, 985, 992]
-      if i < changing_points[0]:
-        return 1
-      elif i >= changing_points[-1]:
-        return 2**len(changing_points)
-      else:
-        for j in range(len(changing_points)-1):
-          if i >= changing_points[j] and i<changing_points[j+1]:
-            break
-        exp = j+1
-        return 2**exp
-    '''
-
-    def corrections_steps(i):
-      return 1
-
-
     with torch.no_grad():
       # Initial sample
 
@@ -321,47 +388,32 @@ def get_pc_inpainter(sde, predictor, corrector, snr,
 
       x = data * mask + sde.prior_sampling(data.shape).type_as(data) * (1. - mask) 
       
-      if show_evolution:
-        evolution = [x.cpu()]
-
-      timesteps = torch.linspace(sde.T, eps, sde.N)
-      for i in tqdm(range(sde.N)):
-        t = timesteps[i]
-
-        for _ in range(corrections_steps(i)):
-          x, x_mean = corrector_inpaint_update_fn(model, data, mask, x, t)
-
-        x, x_mean = projector_inpaint_update_fn(model, data, mask, x, t)
-
-        if show_evolution:
-          evolution.append(x.cpu())
+      recorder = evolution.get_recorder(show_evolution)
+
+      timesteps = schedules.get_timesteps(sde, sde.N, eps, schedule, device=data.device).type_as(data)
+      if recorder is not None:
+        #the initial state is frame 0
+        recorder.start(timesteps.size(0) + 1)
+        recorder.record(0, x)
+      plan = SamplingPlan(sde, model, predictor, corrector, timesteps, data.shape[0],
+                          snr=snr, n_steps=n_steps, probability_flow=probability_flow, continuous=continuous)
+      #the number of corrector updates is a function of the diffusion time, e.g. doubling it
+      #towards t=eps concentrates the budget on the low noise levels
+      corrections_steps = schedules.get_corrector_budget(corrector_schedule, timesteps)
+      nfe = timesteps.size(0) + getattr(plan.corrector, 'n_steps', 0) * sum(corrections_steps)
+
+      for i in tqdm(range(timesteps.size(0))):
+        for _ in range(corrections_steps[i]):
+          x, x_mean = corrector_inpaint_update_fn(plan, data, mask, x, i)
+
+        x, x_mean = projector_inpaint_update_fn(plan, data, mask, x, i)
+
+        if recorder is not None:
+          recorder.record(i + 1, x)
       
-      if show_evolution:
-        sampling_info = {'evolution': torch.stack(evolution)}
-        return x_mean if denoise else x, sampling_info
-      else:
-        return x_mean if denoise else x, {}
+      sampling_info = {'steps': nfe}
+      if recorder is not None:
+        evolution.add_to_sampling_info(sampling_info, recorder)
+      return x_mean if denoise else x, sampling_info
 
   return pc_inpainter
-
-def shared_predictor_update_fn(x, t, sde, model, predictor, probability_flow, continuous):
-  """A wrapper that configures and returns the update function of predictors."""
-  score_fn = mutils.get_score_fn(sde, model, conditional=False, train=False, continuous=continuous)
-
-  if predictor is None:
-    # Corrector-only sampler
-    predictor_obj = NonePredictor(sde, score_fn, probability_flow)
-  else:
-    predictor_obj = predictor(sde, score_fn, probability_flow)
-  return predictor_obj.update_fn(x, t)
-
-def shared_corrector_update_fn(x, t, sde, model, corrector, continuous, snr, n_steps):
-  """A wrapper that configures and returns the update function of correctors."""
-  score_fn = mutils.get_score_fn(sde, model, conditional=False, train=False, continuous=continuous)
-
-  if corrector is None:
-    # Predictor-only sampler
-    corrector_obj = NoneCorrector(sde, score_fn, snr, n_steps)
-  else:
-    corrector_obj = corrector(sde, score_fn, snr, n_steps)
-  return corrector_obj.update_fn(x, t)
\ No newline at end of file
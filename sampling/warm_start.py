@@ -0,0 +1,66 @@
+"""Warm-started (truncated) reverse diffusion for the conditional samplers.
+
+Instead of starting from the prior at `T`, the sampler diffuses an initial estimate of x (computed
+from the condition y) forward to an intermediate time `t0 < T` and runs the reverse process only
+from there ("Come-Closer-Diffuse-Faster", Chung et al., 2022). The time grid of the sampler is
+truncated to the times `<= t0`, so the number of steps drops by about `t0 / T` for uniform grids.
+"""
+import functools
+import torch
+import torch.nn.functional as F
+
+from sampling import rng
+
+
+def bicubic_upsampling(y, shape, scale=None):
+  """Bicubic upsampling of the low resolution condition to the spatial size of x.
+  A condition that is already at the high resolution (nearest-neighbour upsampled by the
+  datamodule) is first averaged over `scale` x `scale` blocks to recover the low resolution image.
+  """
+  size = tuple(shape[2:])
+  if y.dim() != 4:
+    raise NotImplementedError('Bicubic initial estimates are only supported for images.')
+  if tuple(y.shape[2:]) == size and scale is not None and scale > 1:
+    y = F.avg_pool2d(y, kernel_size=scale)
+  if tuple(y.shape[2:]) == size:
+    return y
+  return F.interpolate(y, size=size, mode='bicubic', align_corners=False)
+
+
+def masked_input(y, shape):
+  """The masked input itself (inpainting, or any task where y already lives in the space of x)."""
+  if tuple(y.shape[1:]) != tuple(shape[1:]):
+    raise ValueError(f'The condition of shape {list(y.shape[1:])} cannot be an initial estimate of x of shape {list(shape[1:])}.')
+  return y
+
+
+def get_initial_estimate_fn(config):
+  """The initial estimate of x for the task of `config.data`: the bicubic upsample of y for
+  super-resolution and y itself (e.g. the masked input) otherwise. Only needed with a warm start."""
+  task = config.data.get('task', None)
+  if task is None:
+    raise ValueError('The warm start (sampling.warm_start_t0) needs config.data.task to choose the initial estimate of x.')
+  if task == 'super-resolution':
+    return functools.partial(bicubic_upsampling, scale=config.data.get('scale', None))
+  return masked_input
+
+
+def truncate_timesteps(timesteps, t0):
+  """The times of the grid that are not larger than `t0`."""
+  truncated = timesteps[timesteps <= t0]
+  if truncated.numel() == 0:
+    raise ValueError(f'No time of the sampling grid is below the warm start time {t0}.')
+  return truncated
+
+
+def warm_start(sde, x0, timesteps, t0, noise=None):
+  """Truncate the time grid at `t0` and diffuse the initial estimate `x0` to its first time.
+  The diffusion noise comes from the per-sample streams of `noise` if given.
+  Returns:
+    The truncated time grid and the initial state of the reverse process.
+  """
+  timesteps = truncate_timesteps(timesteps, t0)
+  vec_t = torch.ones(x0.shape[0], device=x0.device) * timesteps[0]
+  mean, std = sde.marginal_prob(x0, vec_t)
+  x = mean + std[(...,) + (None,) * len(x0.shape[1:])] * rng.randn_like(x0, noise)
+  return timesteps, x
@@ -0,0 +1,174 @@
+"""Multi-process sampling on CPU-only nodes.
+
+Intra-op threading does not scale for the small convolutions of the score models, so a single
+process with small batches leaves most cores idle. The farm runs K worker processes instead, each
+pinned to its own subset of cores with as many intra-op threads as cores. The lightning module is
+loaded once by the driver and its weights are moved to shared memory before the workers are forked,
+so the workers share a single copy of the checkpoint. The workers pull (key, y, sampling arguments)
+tasks from a queue and send the samples back. Every sample is seeded by its image index, snr and
+draw (see `sampling.rng`), so the results do not depend on the worker that sampled them.
+
+The `sampling_farm` mode is configured with the following optional keys of `config.eval`:
+  farm_workers, farm_threads_per_worker, farm_queue_size, sampling_seed (defaults to config.seed).
+"""
+from lightning_modules.utils import create_lightning_module
+from lightning_data_modules.utils import create_lightning_datamodule
+from sampling.rng import mix_seed
+from torchvision.utils import save_image
+import torch.multiprocessing as mp
+import traceback
+import time
+import os
+import torch
+from pathlib import Path
+
+
+def get_core_groups(num_workers=None, threads_per_worker=None):
+  """Split the cores available to this process into contiguous groups, one per worker. The groups
+  wrap around (and the workers share cores) if there are fewer cores than workers times threads."""
+  cores = sorted(os.sched_getaffinity(0))
+  if threads_per_worker is None:
+    num_workers = num_workers or len(cores)
+    threads_per_worker = max(1, len(cores) // num_workers)
+  elif num_workers is None:
+    num_workers = max(1, len(cores) // threads_per_worker)
+  return [sorted({cores[(k * threads_per_worker + j) % len(cores)] for j in range(threads_per_worker)})
+          for k in range(num_workers)]
+
+
+def _work(module, cores, tasks, results):
+  os.sched_setaffinity(0, cores)
+  torch.set_num_threads(len(cores))
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    key, y, kwargs = task
+    try:
+      start = time.time()
+      with torch.no_grad():
+        samples, _ = module.sample(y, **kwargs)
+      results.put((key, samples, time.time() - start, None))
+    except Exception:
+      results.put((key, None, 0., traceback.format_exc()))
+
+
+class SamplingFarm:
+  """A pool of pinned cpu workers that call `module.sample`."""
+
+  def __init__(self, module, num_workers=None, threads_per_worker=None):
+    """Fork the workers.
+    Args:
+      module: A lightning module with a `sample(y, **kwargs)` method. Its weights are moved to shared memory.
+      num_workers: The number of worker processes. By default one per `threads_per_worker` cores.
+      threads_per_worker: The number of cores (and intra-op threads) of every worker. By default
+        the cores are split evenly between the workers.
+    """
+    self.core_groups = get_core_groups(num_workers, threads_per_worker)
+    module = module.cpu().eval()
+    module.share_memory()
+    #fork, so that the workers inherit the module instead of unpickling a copy of it
+    context = mp.get_context('fork')
+    self.tasks = context.Queue()
+    self.results = context.Queue()
+    self.workers = [context.Process(target=_work, args=(module, cores, self.tasks, self.results), daemon=True)
+                    for cores in self.core_groups]
+    for worker in self.workers:
+      worker.start()
+    self.pending = 0
+
+  @property
+  def num_workers(self):
+    return len(self.workers)
+
+  def submit(self, key, y, **kwargs):
+    """Queue `module.sample(y, **kwargs)`. The samples are returned by `get` with `key`."""
+    self.tasks.put((key, y.cpu(), kwargs))
+    self.pending += 1
+
+  def get(self):
+    """The next finished task: (key, samples, sampling time in seconds). Raises if the task failed."""
+    key, samples, duration, error = self.results.get()
+    self.pending -= 1
+    if error is not None:
+      raise RuntimeError('Sampling task %s failed:\n%s' % (key, error))
+    return key, samples, duration
+
+  def close(self):
+    for _ in self.workers:
+      self.tasks.put(None)
+    for worker in self.workers:
+      worker.join(timeout=10)
+      if worker.is_alive():
+        worker.terminate()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def run_sampling_farm(config, checkpoint_path):
+  """Sample the test batches between eval.first_test_batch and eval.last_test_batch for every snr of
+  eval.snr and every draw of eval.draws, and save them in the layout of the `test` mode."""
+  evaluate = config.eval
+  seed = evaluate.get('sampling_seed', None)
+  seed = config.seed if seed is None else seed
+  snrs = evaluate.snr if isinstance(evaluate.snr, list) else [evaluate.snr]
+  sample_kwargs = {'predictor': evaluate.get('predictor', 'default'), 'corrector': evaluate.get('corrector', 'default'),
+                   'p_steps': evaluate.get('p_steps', 'default'), 'c_steps': evaluate.get('c_steps', 'default'),
+                   'denoise': evaluate.get('denoise', 'default'), 'use_path': evaluate.get('use_path', 'default'),
+                   'schedule': evaluate.get('schedule', 'default'), 'warm_start_t0': evaluate.get('warm_start_t0', 'default')}
+
+  base_path = os.path.join(evaluate.base_log_dir, config.data.task, config.data.dataset, config.training.conditioning_approach, 'images')
+  samples_dir, gt_x_dir, gt_y_dir = [os.path.join(base_path, name) for name in ['samples', 'x_gt', 'y_gt']]
+  for directory in [gt_x_dir, gt_y_dir] + [os.path.join(samples_dir, 'snr_%.3f' % snr, 'draw_%d' % draw) for snr in snrs for draw in evaluate.draws]:
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+  DataModule = create_lightning_datamodule(config)
+  DataModule.setup()
+  LightningModule = create_lightning_module(config, checkpoint_path)
+
+  def tasks():
+    images_tested = evaluate.batch_size * evaluate.first_test_batch
+    for batch_idx, (y, x) in enumerate(DataModule.test_dataloader()):
+      if batch_idx < evaluate.first_test_batch:
+        continue
+      if batch_idx >= evaluate.last_test_batch:
+        break
+      for i in range(x.size(0)):
+        save_image(x[i], fp=os.path.join(gt_x_dir, '%d.png' % (images_tested + i + 1)))
+        save_image(y[i], fp=os.path.join(gt_y_dir, '%d.png' % (images_tested + i + 1)))
+      for snr in snrs:
+        for draw in evaluate.draws:
+          seeds = [mix_seed(seed, images_tested + i, int(round(snr * 1e6)), draw) for i in range(y.size(0))]
+          yield (images_tested, snr, draw), y, dict(sample_kwargs, snr=snr, seeds=seeds)
+      images_tested += y.size(0)
+
+  start, busy_time, num_samples = time.time(), 0., 0
+  with SamplingFarm(LightningModule, evaluate.get('farm_workers', None), evaluate.get('farm_threads_per_worker', None)) as farm:
+    #a bounded number of batches waits in the queue
+    queue_size = evaluate.get('farm_queue_size', 2 * farm.num_workers)
+    source = tasks()
+    exhausted = False
+    while not exhausted or farm.pending:
+      while not exhausted and farm.pending < queue_size:
+        task = next(source, None)
+        if task is None:
+          exhausted = True
+          break
+        farm.submit(task[0], task[1], **task[2])
+      if not farm.pending:
+        break
+      (first_index, snr, draw), samples, duration = farm.get()
+      samples = torch.clamp(samples, min=0, max=1)
+      for i in range(samples.size(0)):
+        save_image(samples[i], fp=os.path.join(samples_dir, 'snr_%.3f' % snr, 'draw_%d' % draw, '%d.png' % (first_index + i + 1)))
+      busy_time += duration
+      num_samples += samples.size(0)
+      print('images %d-%d, snr %.3f, draw %d: %.1fs' % (first_index + 1, first_index + samples.size(0), snr, draw, duration))
+
+  elapsed = time.time() - start
+  print('%d samples in %.1fs with %d workers (%.2f samples/s, worker utilisation %.0f%%)'
+        % (num_samples, elapsed, farm.num_workers, num_samples / max(elapsed, 1e-9), 100 * busy_time / max(elapsed * farm.num_workers, 1e-9)))
@@ -1,5 +1,6 @@
 """Abstract SDE classes, Reverse SDE, and VE/VP SDEs."""
 import abc
+import functools
 import torch
 import numpy as np
 
@@ -21,6 +22,11 @@ class SDE(abc.ABC):
     """End time of the SDE."""
     pass
 
+  @property
+  def t_start(self):
+    """Time of the prior distribution, where sampling starts. `T` unless a fitted prior starts earlier."""
+    return self.T
+
   @abc.abstractmethod
   def sde(self, x, t):
     pass
@@ -46,20 +52,86 @@ class SDE(abc.ABC):
     """
     pass
 
-  def discretize(self, x, t):
+  def register_buffer(self, name, tensor):
+    """Register a schedule tensor that is moved together with the SDE by `to`.
+    Mirrors `torch.nn.Module.register_buffer`. The tensor stays accessible as an attribute.
+    """
+    if not hasattr(self, '_buffer_names'):
+      self._buffer_names = []
+    if name not in self._buffer_names:
+      self._buffer_names.append(name)
+    setattr(self, name, tensor)
+
+  def to(self, device):
+    """Move all registered buffers to `device`. Returns the SDE itself."""
+    for name in getattr(self, '_buffer_names', []):
+      tensor = getattr(self, name)
+      if tensor is not None:
+        setattr(self, name, tensor.to(device))
+    return self
+
+  def get_buffer(self, name, device):
+    """Return the buffer `name` on `device`.
+    All buffers are moved the first time a new device is requested, so the discrete
+    schedules are copied once per device and not once per sampling step.
+    """
+    tensor = getattr(self, name)
+    if tensor.device != device:
+      self.to(device)
+      tensor = getattr(self, name)
+    return tensor
+
+  def get_step_coefficients(self, timesteps):
+    """Precompute the coefficients used by the predictors and correctors on a time grid.
+    The grid may be non-uniform: the i-th step goes from timesteps[i] to timesteps[i+1] and the
+    last one from timesteps[-1] to 0.
+    Args:
+      timesteps: A 1-D PyTorch tensor with the decreasing time grid.
+    Returns:
+      A dict of tensors with one entry per time step:
+        t, timestep (index into the discrete schedules), dt (size of the step),
+        mean_coeff and std (perturbation kernel), drift_coeff and diffusion (the SDE drift is
+        drift_coeff * x for the linear SDEs), f_coeff and G (the discretization of the step is
+        f = f_coeff * x and G), alpha (scale of the Langevin step size), next_mean_coeff and
+        next_std (perturbation kernel at the next time of the grid; after the last time the
+        sample lands on the data, i.e. 1 and 0).
+    """
+    ones = torch.ones_like(timesteps)
+    dt = timesteps - torch.cat([timesteps[1:], torch.zeros_like(timesteps[:1])])
+    mean_coeff, std = self.marginal_prob(ones, timesteps)
+    next_mean_coeff = torch.cat([mean_coeff[1:], torch.ones_like(mean_coeff[:1])])
+    next_std = torch.cat([std[1:], torch.zeros_like(std[:1])])
+    drift_coeff, diffusion = self.sde(ones, timesteps)
+    return {'t': timesteps,
+            'timestep': (timesteps * (self.N - 1) / self.T).long(),
+            'dt': dt,
+            'mean_coeff': mean_coeff,
+            'std': std,
+            'next_mean_coeff': next_mean_coeff,
+            'next_std': next_std,
+            'drift_coeff': drift_coeff,
+            'diffusion': diffusion,
+            'f_coeff': drift_coeff * dt,
+            'G': diffusion * torch.sqrt(dt),
+            'alpha': ones}
+
+  def discretize(self, x, t, coeffs=None):
     """Discretize the SDE in the form: x_{i+1} = x_i + f_i(x_i) + G_i z_i.
     Useful for reverse diffusion sampling and probabiliy flow sampling.
     Defaults to Euler-Maruyama discretization.
     Args:
       x: a torch tensor
       t: a torch float representing the time step (from 0 to `self.T`)
+      coeffs: optional precomputed coefficients of this step (see `get_step_coefficients`).
     Returns:
       f, G
     """
+    if coeffs is not None:
+      return coeffs['f_coeff'] * x, coeffs['G']
     dt = 1 / self.N
     drift, diffusion = self.sde(x, t)
     f = drift * dt
-    G = diffusion * torch.sqrt(torch.tensor(dt, device=t.device))
+    G = diffusion * np.sqrt(dt)
     return f, G
 
   def reverse(self, score_fn, probability_flow=False):
@@ -68,38 +140,7 @@ class SDE(abc.ABC):
       score_fn: A time-dependent score-based model that takes x and t and returns the score.
       probability_flow: If `True`, create the reverse-time ODE used for probability flow sampling.
     """
-    N = self.N
-    T = self.T
-    sde_fn = self.sde
-    discretize_fn = self.discretize
-
-    # Build the class for reverse-time SDE.
-    class RSDE(self.__class__):
-      def __init__(self):
-        self.N = N
-        self.probability_flow = probability_flow
-
-      @property
-      def T(self):
-        return T
-
-      def sde(self, x, t):
-        """Create the drift and diffusion functions for the reverse SDE/ODE."""
-        drift, diffusion = sde_fn(x, t)
-        score = score_fn(x, t)
-        drift = drift - diffusion[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score * (0.5 if self.probability_flow else 1.)
-        # Set the diffusion function to zero for ODEs.
-        diffusion = 0. if self.probability_flow else diffusion
-        return drift, diffusion
-
-      def discretize(self, x, t):
-        """Create discretized iteration rules for the reverse diffusion sampler."""
-        f, G = discretize_fn(x, t)
-        rev_f = f - G[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score_fn(x, t) * (0.5 if self.probability_flow else 1.)
-        rev_G = torch.zeros_like(G) if self.probability_flow else G
-        return rev_f, rev_G
-
-    return RSDE()
+    return _reverse_sde_class(self.__class__)(self, score_fn, probability_flow)
 
 class cSDE(SDE): #conditional setting. Allow for conditional time-dependent score.
   def reverse(self, score_fn, probability_flow=False):
@@ -108,38 +149,73 @@ class cSDE(SDE): #conditional setting. Allow for conditional time-dependent scor
       score_fn: A time-dependent score-based model that takes x and t and returns the score.
       probability_flow: If `True`, create the reverse-time ODE used for probability flow sampling.
     """
-    N = self.N
-    T = self.T
-    sde_fn = self.sde
-    discretize_fn = self.discretize
-
-    # Build the class for reverse-time SDE.
-    class RSDE(self.__class__):
-      def __init__(self):
-        self.N = N
-        self.probability_flow = probability_flow
-
-      @property
-      def T(self):
-        return T
-
-      def sde(self, x, y, t):
-        """Create the drift and diffusion functions for the reverse SDE/ODE."""
-        drift, diffusion = sde_fn(x, t)
-        score_x = score_fn(x, y, t) #conditional score on y
-        drift = drift - diffusion[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score_x * (0.5 if self.probability_flow else 1.)
-        # Set the diffusion function to zero for ODEs.
-        diffusion = 0. if self.probability_flow else diffusion
-        return drift, diffusion
-
-      def discretize(self, x, y, t):
-        """Create discretized iteration rules for the reverse diffusion sampler."""
-        f, G = discretize_fn(x, t)
-        rev_f = f - G[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score_fn(x, y, t) * (0.5 if self.probability_flow else 1.)
-        rev_G = torch.zeros_like(G) if self.probability_flow else G
-        return rev_f, rev_G
-
-    return RSDE()
+    return _reverse_csde_class(self.__class__)(self, score_fn, probability_flow)
+
+
+# The classes of the reverse SDEs are built once per SDE class and hold the forward SDE and the
+# score function, so that compiled samplers see the same class in every trajectory.
+@functools.lru_cache(maxsize=None)
+def _reverse_sde_class(sde_class):
+  class RSDE(sde_class):
+    def __init__(self, forward_sde, score_fn, probability_flow):
+      self.N = forward_sde.N
+      self.probability_flow = probability_flow
+      self.forward_sde = forward_sde
+      self.score_fn = score_fn
+
+    @property
+    def T(self):
+      return self.forward_sde.T
+
+    def sde(self, x, t):
+      """Create the drift and diffusion functions for the reverse SDE/ODE."""
+      drift, diffusion = self.forward_sde.sde(x, t)
+      score = self.score_fn(x, t)
+      drift = drift - diffusion[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score * (0.5 if self.probability_flow else 1.)
+      # Set the diffusion function to zero for ODEs.
+      diffusion = 0. if self.probability_flow else diffusion
+      return drift, diffusion
+
+    def discretize(self, x, t, coeffs=None):
+      """Create discretized iteration rules for the reverse diffusion sampler."""
+      f, G = self.forward_sde.discretize(x, t, coeffs)
+      rev_f = f - G[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * self.score_fn(x, t) * (0.5 if self.probability_flow else 1.)
+      rev_G = torch.zeros_like(G) if self.probability_flow else G
+      return rev_f, rev_G
+
+  return RSDE
+
+
+@functools.lru_cache(maxsize=None)
+def _reverse_csde_class(sde_class):
+  class RSDE(sde_class):
+    def __init__(self, forward_sde, score_fn, probability_flow):
+      self.N = forward_sde.N
+      self.probability_flow = probability_flow
+      self.forward_sde = forward_sde
+      self.score_fn = score_fn
+
+    @property
+    def T(self):
+      return self.forward_sde.T
+
+    def sde(self, x, y, t):
+      """Create the drift and diffusion functions for the reverse SDE/ODE."""
+      drift, diffusion = self.forward_sde.sde(x, t)
+      score_x = self.score_fn(x, y, t) #conditional score on y
+      drift = drift - diffusion[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * score_x * (0.5 if self.probability_flow else 1.)
+      # Set the diffusion function to zero for ODEs.
+      diffusion = 0. if self.probability_flow else diffusion
+      return drift, diffusion
+
+    def discretize(self, x, y, t, coeffs=None):
+      """Create discretized iteration rules for the reverse diffusion sampler."""
+      f, G = self.forward_sde.discretize(x, t, coeffs)
+      rev_f = f - G[(..., ) + (None, ) * len(x.shape[1:])] ** 2 * self.score_fn(x, y, t) * (0.5 if self.probability_flow else 1.)
+      rev_G = torch.zeros_like(G) if self.probability_flow else G
+      return rev_f, rev_G
+
+  return RSDE
 
 class VPSDE(SDE):
   def __init__(self, beta_min=0.1, beta_max=20, N=1000):
@@ -153,11 +229,14 @@ class VPSDE(SDE):
     self.beta_0 = beta_min
     self.beta_1 = beta_max
     self.N = N
-    self.discrete_betas = torch.linspace(beta_min / N, beta_max / N, N)
-    self.alphas = 1. - self.discrete_betas
-    self.alphas_cumprod = torch.cumprod(self.alphas, dim=0)
-    self.sqrt_alphas_cumprod = torch.sqrt(self.alphas_cumprod)
-    self.sqrt_1m_alphas_cumprod = torch.sqrt(1. - self.alphas_cumprod)
+    self.register_buffer('discrete_betas', torch.linspace(beta_min / N, beta_max / N, N))
+    self.register_buffer('alphas', 1. - self.discrete_betas)
+    self.register_buffer('alphas_cumprod', torch.cumprod(self.alphas, dim=0))
+    self.register_buffer('sqrt_alphas_cumprod', torch.sqrt(self.alphas_cumprod))
+    self.register_buffer('sqrt_1m_alphas_cumprod', torch.sqrt(1. - self.alphas_cumprod))
+    #per-index DDPM discretization tables
+    self.register_buffer('sqrt_alphas', torch.sqrt(self.alphas))
+    self.register_buffer('sqrt_discrete_betas', torch.sqrt(self.discrete_betas))
 
   @property
   def T(self):
@@ -184,14 +263,28 @@ class VPSDE(SDE):
     logps = -N / 2. * np.log(2 * np.pi) - torch.sum(z ** 2, dim=(1, 2, 3)) / 2.
     return logps
 
-  def discretize(self, x, t):
+  def get_step_coefficients(self, timesteps):
+    coeffs = super().get_step_coefficients(timesteps)
+    # DDPM step from the grid time to the next one, from the continuous alpha_bar(t) = mean_coeff(t)^2
+    # at the grid times, so that grids denser than the discrete chain do not produce empty steps.
+    sqrt_alpha = coeffs['mean_coeff'] / coeffs['next_mean_coeff']
+    beta = 1. - sqrt_alpha ** 2
+    coeffs['beta'] = beta
+    coeffs['sqrt_alpha'] = sqrt_alpha
+    coeffs['G'] = torch.sqrt(beta)
+    coeffs['f_coeff'] = coeffs['sqrt_alpha'] - 1.
+    coeffs['alpha'] = self.get_buffer('alphas', timesteps.device)[coeffs['timestep']]
+    return coeffs
+
+  def discretize(self, x, t, coeffs=None):
     """DDPM discretization."""
-    timestep = (t * (self.N - 1) / self.T).long()
-    beta = self.discrete_betas.to(x.device)[timestep]
-    alpha = self.alphas.to(x.device)[timestep]
-    sqrt_beta = torch.sqrt(beta)
-    f = torch.sqrt(alpha)[(...,) + (None,) * len(x.shape[1:])] * x - x
-    G = sqrt_beta
+    if coeffs is not None:
+      sqrt_alpha, G = coeffs['sqrt_alpha'], coeffs['G']
+    else:
+      timestep = (t * (self.N - 1) / self.T).long()
+      sqrt_alpha = self.get_buffer('sqrt_alphas', t.device)[timestep]
+      G = self.get_buffer('sqrt_discrete_betas', t.device)[timestep]
+    f = sqrt_alpha[(...,) + (None,) * len(x.shape[1:])] * x - x
     return f, G
 
 class cVPSDE(cSDE):
@@ -206,11 +299,14 @@ class cVPSDE(cSDE):
     self.beta_0 = beta_min
     self.beta_1 = beta_max
     self.N = N
-    self.discrete_betas = torch.linspace(beta_min / N, beta_max / N, N)
-    self.alphas = 1. - self.discrete_betas
-    self.alphas_cumprod = torch.cumprod(self.alphas, dim=0)
-    self.sqrt_alphas_cumprod = torch.sqrt(self.alphas_cumprod)
-    self.sqrt_1m_alphas_cumprod = torch.sqrt(1. - self.alphas_cumprod)
+    self.register_buffer('discrete_betas', torch.linspace(beta_min / N, beta_max / N, N))
+    self.register_buffer('alphas', 1. - self.discrete_betas)
+    self.register_buffer('alphas_cumprod', torch.cumprod(self.alphas, dim=0))
+    self.register_buffer('sqrt_alphas_cumprod', torch.sqrt(self.alphas_cumprod))
+    self.register_buffer('sqrt_1m_alphas_cumprod', torch.sqrt(1. - self.alphas_cumprod))
+    #per-index DDPM discretization tables
+    self.register_buffer('sqrt_alphas', torch.sqrt(self.alphas))
+    self.register_buffer('sqrt_discrete_betas', torch.sqrt(self.discrete_betas))
 
   @property
   def T(self):
@@ -237,14 +333,28 @@ class cVPSDE(cSDE):
     logps = -N / 2. * np.log(2 * np.pi) - torch.sum(z ** 2, dim=(1, 2, 3)) / 2.
     return logps
 
-  def discretize(self, x, t):
+  def get_step_coefficients(self, timesteps):
+    coeffs = super().get_step_coefficients(timesteps)
+    # DDPM step from the grid time to the next one, from the continuous alpha_bar(t) = mean_coeff(t)^2
+    # at the grid times, so that grids denser than the discrete chain do not produce empty steps.
+    sqrt_alpha = coeffs['mean_coeff'] / coeffs['next_mean_coeff']
+    beta = 1. - sqrt_alpha ** 2
+    coeffs['beta'] = beta
+    coeffs['sqrt_alpha'] = sqrt_alpha
+    coeffs['G'] = torch.sqrt(beta)
+    coeffs['f_coeff'] = coeffs['sqrt_alpha'] - 1.
+    coeffs['alpha'] = self.get_buffer('alphas', timesteps.device)[coeffs['timestep']]
+    return coeffs
+
+  def discretize(self, x, t, coeffs=None):
     """DDPM discretization."""
-    timestep = (t * (self.N - 1) / self.T).long()
-    beta = self.discrete_betas.to(x.device)[timestep]
-    alpha = self.alphas.to(x.device)[timestep]
-    sqrt_beta = torch.sqrt(beta)
-    f = torch.sqrt(alpha)[(...,) + (None,) * len(x.shape[1:])] * x - x
-    G = sqrt_beta
+    if coeffs is not None:
+      sqrt_alpha, G = coeffs['sqrt_alpha'], coeffs['G']
+    else:
+      timestep = (t * (self.N - 1) / self.T).long()
+      sqrt_alpha = self.get_buffer('sqrt_alphas', t.device)[timestep]
+      G = self.get_buffer('sqrt_discrete_betas', t.device)[timestep]
+    f = sqrt_alpha[(...,) + (None,) * len(x.shape[1:])] * x - x
     return f, G
 
 
@@ -288,42 +398,61 @@ class subVPSDE(SDE):
 
 
 class VESDE(SDE):
-  def __init__(self, sigma_min=0.01, sigma_max=50, N=1000, data_mean=None):
+  def __init__(self, sigma_min=0.01, sigma_max=50, N=1000, data_mean=None, gaussian_prior=None, t_start=None):
     """Construct a Variance Exploding SDE.
     Args:
       sigma_min: smallest sigma.
       sigma_max: largest sigma.
       N: number of discretization steps
+      data_mean: mean of the isotropic prior.
+      gaussian_prior: a fitted `gaussian_prior.LowRankGaussian`. If given, it replaces the isotropic prior.
+      t_start: time of the prior (default T). A smaller time needs `gaussian_prior`.
     """
     super().__init__(N)
-    self.sigma_min = sigma_min
-    self.sigma_max = sigma_max
-    self.discrete_sigmas = torch.exp(torch.linspace(np.log(self.sigma_min), np.log(self.sigma_max), N))
+    self.sigma_min = float(sigma_min)
+    self.sigma_max = float(sigma_max)
+    self.register_buffer('discrete_sigmas', torch.exp(torch.linspace(np.log(self.sigma_min), np.log(self.sigma_max), N)))
+    #per-index SMLD discretization tables
+    self.register_buffer('adjacent_discrete_sigmas', torch.cat([torch.zeros(1), self.discrete_sigmas[:-1]]))
+    self.register_buffer('discrete_G', torch.sqrt(self.discrete_sigmas ** 2 - self.adjacent_discrete_sigmas ** 2))
     self.N = N
 
     self.diffused_mean = data_mean #new
+    self.gaussian_prior = gaussian_prior
+    if t_start is not None and not 0 < t_start <= self.T:
+      raise ValueError(f'The start time {t_start} must be in (0, {self.T}].')
+    if t_start is not None and t_start < self.T and gaussian_prior is None:
+      raise ValueError('A start time before T needs a fitted Gaussian prior.')
+    self.prior_t = t_start
 
   @property
   def T(self):
     return 1
 
+  @property
+  def t_start(self):
+    return self.T if self.prior_t is None else self.prior_t
+
+  @property
+  def prior_std(self):
+    """The noise level of the prior."""
+    return self.sigma_min * (self.sigma_max / self.sigma_min) ** self.t_start
+
   def sde(self, x, t):
     sigma = self.sigma_min * (self.sigma_max / self.sigma_min) ** t
     drift = torch.zeros_like(x)
-    diffusion = sigma * torch.sqrt(torch.tensor(2 * (np.log(self.sigma_max) - np.log(self.sigma_min))).type_as(t))
+    diffusion = sigma * np.sqrt(2 * (np.log(self.sigma_max) - np.log(self.sigma_min)))
     return drift, diffusion
 
   def marginal_prob(self, x, t): #perturbation kernel P(X(t)|X(0)) parameters
-    sigma_min = torch.tensor(self.sigma_min).type_as(t)
-    sigma_max = torch.tensor(self.sigma_max).type_as(t)
-    std = sigma_min * (sigma_max / sigma_min) ** t
+    std = self.sigma_min * (self.sigma_max / self.sigma_min) ** t
     mean = x
     return mean, std
   
   def compute_backward_kernel(self, x0, x_tplustau, t, tau):
     #x_forward = x(t+\tau)
     #compute the parameters of p(x(t)|x(0), x(t+\tau)) - the reverse kernel of width tau at time step t.
-    sigma_min, sigma_max = torch.tensor(self.sigma_min).type_as(t), torch.tensor(self.sigma_max).type_as(t)
+    sigma_min, sigma_max = self.sigma_min, self.sigma_max
 
     sigma_t_square = (sigma_min * (sigma_max / sigma_min) ** t)**2
     sigma_tplustau_square = (sigma_min * (sigma_max / sigma_min) ** (t+tau))**2
@@ -339,7 +468,10 @@ class VESDE(SDE):
     return mean_backward, std_backward
 
   def prior_sampling(self, shape):
-    if self.diffused_mean is not None:
+    if self.gaussian_prior is not None:
+      #the fitted Gaussian diffused to t_start
+      return self.gaussian_prior.sample(shape, std=self.prior_std)
+    elif self.diffused_mean is not None:
       repeat_tuple = tuple([shape[0]]+[1 for _ in shape[1:]])
       diffused_mean = self.diffused_mean.unsqueeze(0).repeat(repeat_tuple)
       return torch.randn(*shape) * self.sigma_max + diffused_mean
@@ -347,55 +479,89 @@ class VESDE(SDE):
       return torch.randn(*shape) * self.sigma_max
 
   def prior_logp(self, z):
+    if self.gaussian_prior is not None:
+      return self.gaussian_prior.log_prob(z, std=self.prior_std)
     shape = z.shape
     N = np.prod(shape[1:])
     return -N / 2. * np.log(2 * np.pi * self.sigma_max ** 2) - torch.sum(z ** 2, dim=(1, 2, 3)) / (2 * self.sigma_max ** 2)
 
-  def discretize(self, x, t):
+  def get_step_coefficients(self, timesteps):
+    coeffs = super().get_step_coefficients(timesteps)
+    # SMLD step from the noise level of the grid time to the one of the next grid time (0 after the
+    # last one). The levels are those of the continuous schedule at the grid times, so that grids
+    # denser than the discrete sigmas do not produce empty steps.
+    sigma, adjacent_sigma = coeffs['std'], coeffs['next_std']
+    coeffs['sigma'] = sigma
+    coeffs['adjacent_sigma'] = adjacent_sigma
+    coeffs['G'] = torch.sqrt(sigma ** 2 - adjacent_sigma ** 2)
+    coeffs['f_coeff'] = torch.zeros_like(sigma)
+    return coeffs
+
+  def discretize(self, x, t, coeffs=None):
     """SMLD(NCSN) discretization."""
-    timestep = (t * (self.N - 1) / self.T).long()
-    sigma = self.discrete_sigmas.to(t.device)[timestep]
-    adjacent_sigma = torch.where(timestep == 0, torch.zeros_like(t),
-                                 self.discrete_sigmas[timestep - 1].to(t.device))
     f = torch.zeros_like(x)
-    G = torch.sqrt(sigma ** 2 - adjacent_sigma ** 2)
+    if coeffs is not None:
+      return f, coeffs['G']
+    timestep = (t * (self.N - 1) / self.T).long()
+    G = self.get_buffer('discrete_G', t.device)[timestep]
     return f, G
 
 class cVESDE(cSDE):
-  def __init__(self, sigma_min=0.01, sigma_max=50, N=1000, data_mean=None):
+  def __init__(self, sigma_min=0.01, sigma_max=50, N=1000, data_mean=None, gaussian_prior=None, t_start=None):
     """Construct a Variance Exploding SDE.
     Args:
       sigma_min: smallest sigma.
       sigma_max: largest sigma.
       N: number of discretization steps
+      data_mean: mean of the isotropic prior.
+      gaussian_prior: a fitted `gaussian_prior.LowRankGaussian`. If given, it replaces the isotropic prior.
+      t_start: time of the prior (default T). A smaller time needs `gaussian_prior`.
     """
     super().__init__(N)
-    self.sigma_min = sigma_min
-    self.sigma_max = sigma_max
-    self.discrete_sigmas = torch.exp(torch.linspace(np.log(self.sigma_min), np.log(self.sigma_max), N))
+    self.sigma_min = float(sigma_min)
+    self.sigma_max = float(sigma_max)
+    self.register_buffer('discrete_sigmas', torch.exp(torch.linspace(np.log(self.sigma_min), np.log(self.sigma_max), N)))
+    #per-index SMLD discretization tables
+    self.register_buffer('adjacent_discrete_sigmas', torch.cat([torch.zeros(1), self.discrete_sigmas[:-1]]))
+    self.register_buffer('discrete_G', torch.sqrt(self.discrete_sigmas ** 2 - self.adjacent_discrete_sigmas ** 2))
     self.N = N
     self.diffused_mean = data_mean #new
+    self.gaussian_prior = gaussian_prior
+    if t_start is not None and not 0 < t_start <= self.T:
+      raise ValueError(f'The start time {t_start} must be in (0, {self.T}].')
+    if t_start is not None and t_start < self.T and gaussian_prior is None:
+      raise ValueError('A start time before T needs a fitted Gaussian prior.')
+    self.prior_t = t_start
 
   @property
   def T(self):
     return 1
 
+  @property
+  def t_start(self):
+    return self.T if self.prior_t is None else self.prior_t
+
+  @property
+  def prior_std(self):
+    """The noise level of the prior."""
+    return self.sigma_min * (self.sigma_max / self.sigma_min) ** self.t_start
+
   def sde(self, x, t):
     sigma = self.sigma_min * (self.sigma_max / self.sigma_min) ** t
     drift = torch.zeros_like(x)
-    diffusion = sigma * torch.sqrt(torch.tensor(2 * (np.log(self.sigma_max) - np.log(self.sigma_min)),
-                                                device=t.device))
+    diffusion = sigma * np.sqrt(2 * (np.log(self.sigma_max) - np.log(self.sigma_min)))
     return drift, diffusion
 
   def marginal_prob(self, x, t): #perturbation kernel P(X(t)|X(0)) parameters 
-    sigma_min = torch.tensor(self.sigma_min).type_as(t)
-    sigma_max = torch.tensor(self.sigma_max).type_as(t)
-    std = sigma_min * (sigma_max / sigma_min) ** t
+    std = self.sigma_min * (self.sigma_max / self.sigma_min) ** t
     mean = x
     return mean, std
 
   def prior_sampling(self, shape):
-    if self.diffused_mean is not None:
+    if self.gaussian_prior is not None:
+      #the fitted Gaussian diffused to t_start
+      return self.gaussian_prior.sample(shape, std=self.prior_std)
+    elif self.diffused_mean is not None:
       repeat_tuple = tuple([shape[0]]+[1 for _ in shape[1:]])
       diffused_mean = self.diffused_mean.unsqueeze(0).repeat(repeat_tuple)
       return torch.randn(*shape) * self.sigma_max + diffused_mean
@@ -403,17 +569,30 @@ class cVESDE(cSDE):
       return torch.randn(*shape) * self.sigma_max
 
   def prior_logp(self, z):
+    if self.gaussian_prior is not None:
+      return self.gaussian_prior.log_prob(z, std=self.prior_std)
     shape = z.shape
     N = np.prod(shape[1:])
     return -N / 2. * np.log(2 * np.pi * self.sigma_max ** 2) - torch.sum(z ** 2, dim=(1, 2, 3)) / (2 * self.sigma_max ** 2)
 
-  def discretize(self, x, t):
+  def get_step_coefficients(self, timesteps):
+    coeffs = super().get_step_coefficients(timesteps)
+    # SMLD step from the noise level of the grid time to the one of the next grid time (0 after the
+    # last one). The levels are those of the continuous schedule at the grid times, so that grids
+    # denser than the discrete sigmas do not produce empty steps.
+    sigma, adjacent_sigma = coeffs['std'], coeffs['next_std']
+    coeffs['sigma'] = sigma
+    coeffs['adjacent_sigma'] = adjacent_sigma
+    coeffs['G'] = torch.sqrt(sigma ** 2 - adjacent_sigma ** 2)
+    coeffs['f_coeff'] = torch.zeros_like(sigma)
+    return coeffs
+
+  def discretize(self, x, t, coeffs=None):
     """SMLD(NCSN) discretization."""
-    timestep = (t * (self.N - 1) / self.T).long()
-    sigma = self.discrete_sigmas.to(t.device)[timestep]
-    adjacent_sigma = torch.where(timestep == 0, torch.zeros_like(t),
-                                 self.discrete_sigmas[timestep - 1].to(t.device))
     f = torch.zeros_like(x)
-    G = torch.sqrt(sigma ** 2 - adjacent_sigma ** 2)
+    if coeffs is not None:
+      return f, coeffs['G']
+    timestep = (t * (self.N - 1) / self.T).long()
+    G = self.get_buffer('discrete_G', t.device)[timestep]
     return f, G
   
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""Sample the test set with several worker processes, one contiguous shard of test batches each.
+
+Every worker samples its batches with `TestPairedVisualizationCallback`, so the samples land in the
+layout of the `test` mode (images/samples/snr_x/draw_d/<index>.png, numbered by the position in
+the test set) and the metrics of the shard are saved in test_metrics/shard_<k>_of_<n>.pkl. The noise
+comes from per-sample streams seeded by (eval.sampling_seed, image index, snr, draw) (see
+`sampling.rng`), so the samples do not depend on the number of shards and re-running a single
+failed shard (`shard=k`) reproduces it exactly. The per-sample streams reseed a generator for every
+sample at every step (an O(batch size) Python loop per draw), which is slower than the batched global
+RNG of the `test` mode. The workers only share a gloo process group to wait
+for each other at the end.
+
+The driver is configured with the following optional keys of `config.eval`:
+  sampling_seed (defaults to config.seed), shard_port.
+"""
+from lightning_modules.utils import create_lightning_module
+from lightning_data_modules.utils import create_lightning_datamodule
+from lightning_callbacks.PairedCallback import TestPairedVisualizationCallback
+from torch.utils.data import DataLoader, Subset
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import pickle
+import math
+import os
+import torch
+import numpy as np
+from pathlib import Path
+
+
+def get_shard_batches(num_batches, first_batch, last_batch, num_shards, shard):
+  """The contiguous range of test batches of the shard."""
+  batches = np.array_split(np.arange(first_batch, min(last_batch, num_batches)), num_shards)[shard]
+  if len(batches) == 0:
+    return range(0)
+  return range(int(batches[0]), int(batches[-1]) + 1)
+
+
+def get_device(rank):
+  if torch.cuda.is_available():
+    return 'cuda:%d' % (rank % torch.cuda.device_count())
+  return 'cpu'
+
+
+def sample_shard(config, checkpoint_path, num_shards, shard, device):
+  """Sample the batches of one shard and save their metrics. Returns the number of sampled images."""
+  eval_config = config.eval.copy_and_resolve_references()
+  if eval_config.get('sampling_seed', None) is None:
+    eval_config.sampling_seed = config.seed
+
+  DataModule = create_lightning_datamodule(config)
+  DataModule.setup()
+  dataset = DataModule.test_dataset
+  batch_size = eval_config.batch_size
+  batches = get_shard_batches(math.ceil(len(dataset) / batch_size), eval_config.first_test_batch,
+                              eval_config.last_test_batch, num_shards, shard)
+  if len(batches) == 0:
+    return 0
+  #the same batches as the test dataloader of the full run
+  indices = range(batches[0] * batch_size, min(len(dataset), (batches[-1] + 1) * batch_size))
+  dataloader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=eval_config.workers)
+
+  LightningModule = create_lightning_module(config, checkpoint_path).to(device)
+  LightningModule.eval()
+
+  callback = TestPairedVisualizationCallback(show_evolution=False, eval_config=eval_config,
+                                             data_config=config.data, approach=config.training.conditioning_approach)
+  callback.on_test_start(None, LightningModule)
+  callback.images_tested = batches[0] * batch_size
+  for batch_idx, (y, x) in zip(batches, dataloader):
+    callback.on_test_batch_start(None, LightningModule, (y.to(device), x.to(device)), batch_idx, 0)
+
+  results_file = os.path.join(os.path.dirname(callback.save_results_file), 'shard_%d_of_%d.pkl' % (shard, num_shards))
+  Path(os.path.dirname(results_file)).mkdir(parents=True, exist_ok=True)
+  with open(results_file, 'wb') as f:
+    pickle.dump(callback.results, f)
+  return len(indices)
+
+
+def _worker(rank, config, checkpoint_path, num_shards, port):
+  dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=num_shards)
+  device = get_device(rank)
+  if device == 'cpu':
+    #share the cores between the workers
+    torch.set_num_threads(max(1, os.cpu_count() // num_shards))
+  num_images = sample_shard(config, checkpoint_path, num_shards, rank, device)
+  print('shard %d/%d: %d images sampled on %s' % (rank, num_shards, num_images, device))
+  dist.barrier()
+  dist.destroy_process_group()
+
+
+def sharded_test(config, checkpoint_path, num_shards, shard=None):
+  """Sample the test set with `num_shards` worker processes, or only the shard `shard` in this process."""
+  if shard is not None:
+    if not 0 <= shard < num_shards:
+      raise ValueError(f'The shard {shard} does not exist for {num_shards} shards.')
+    return sample_shard(config, checkpoint_path, num_shards, shard, get_device(shard))
+  port = config.eval.get('shard_port', 29511)
+  mp.spawn(_worker, args=(config, checkpoint_path, num_shards, port), nprocs=num_shards, join=True)
@@ -0,0 +1,62 @@
+import sys
+import os
+import ml_collections
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sde_lib
+
+
+class ScoreModel(torch.nn.Module):
+  """A small convolutional score model. A dict input {'x', 'y'} is treated as a conditional model."""
+
+  def __init__(self, channels=3, conditional=False):
+    super().__init__()
+    self.channels = channels
+    self.conv = torch.nn.Conv2d(2 * channels if conditional else channels, 2 * channels if conditional else channels, 3, padding=1)
+    self.embedding_type = 'positional'
+
+  @property
+  def device(self):
+    return next(self.parameters()).device
+
+  def forward(self, x, labels):
+    if isinstance(x, dict):
+      h = torch.cat([x['x'], x['y']], 1)
+      out = 0.1 * self.conv(h) - h
+      return {'x': out[:, :self.channels], 'y': out[:, self.channels:]}
+    return 0.1 * self.conv(x) - x
+
+
+def make_config(**sampling):
+  """A config of the conditional VE samplers of 3 x 8 x 8 images, with the `sampling` settings overridden."""
+  config = ml_collections.ConfigDict()
+  config.seed = 0
+  config.training = ml_collections.ConfigDict({'continuous': True, 'sde': 'vesde'})
+  settings = {'method': 'pc', 'predictor': 'conditional_reverse_diffusion', 'corrector': 'conditional_langevin',
+              'n_steps_each': 1, 'noise_removal': True, 'probability_flow': False, 'snr': 0.15}
+  settings.update(sampling)
+  config.sampling = ml_collections.ConfigDict(settings)
+  config.eval = ml_collections.ConfigDict({'snr': [0.15]})
+  config.model = ml_collections.ConfigDict({'num_scales': 20, 'sigma_max_x': float(np.sqrt(3 * 8 * 8)), 'sigma_min_x': 5e-3})
+  config.data = ml_collections.ConfigDict({'shape_x': [3, 8, 8]})
+  return config
+
+
+def conditional_sde(N=20):
+  return {'x': sde_lib.cVESDE(sigma_min=5e-3, sigma_max=float(np.sqrt(3 * 8 * 8)), N=N),
+          'y': sde_lib.VESDE(sigma_min=5e-3, sigma_max=0.5, N=N)}
+
+
+@pytest.fixture
+def score_model():
+  torch.manual_seed(0)
+  return ScoreModel().eval()
+
+
+@pytest.fixture
+def conditional_score_model():
+  torch.manual_seed(0)
+  return ScoreModel(conditional=True).eval()
@@ -0,0 +1,71 @@
+import types
+import pytest
+import torch
+import sde_lib
+from conftest import make_config
+from sampling import adaptive, predictors, correctors
+
+
+def gaussian_score_fn(sde, mu, s0):
+  """The exact score of data distributed as N(mu, s0^2) in every dimension."""
+  def score_fn(x, t):
+    mean_coeff, std = sde.marginal_prob(torch.ones_like(t), t)
+    expand = (...,) + (None,) * len(x.shape[1:])
+    return -(x - mean_coeff[expand] * mu) / (mean_coeff[expand] ** 2 * s0 ** 2 + std[expand] ** 2)
+  return score_fn
+
+
+def make_plan(sde, score_fn, eps, corrector=None, **predictor_kwargs):
+  predictor = predictors.get_predictor('adaptive')(sde, score_fn, **predictor_kwargs)
+  corrector = correctors.get_corrector(corrector or 'none')(sde, score_fn, 0.16, 1)
+  return types.SimpleNamespace(predictor=predictor, corrector=corrector, timesteps=torch.tensor([sde.T, eps]),
+                               noise=None, diffuse_y=False)
+
+
+def test_reverse_sde_reaches_the_data_distribution():
+  sde, mu, s0 = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000), 0.5, 2.
+  plan = make_plan(sde, gaussian_score_fn(sde, mu, s0), 1e-5)
+  torch.manual_seed(0)
+  #the error of a proposal is a norm over the dimensions of a sample: with images the accepted
+  #steps do not select the noise
+  x = sde.prior_sampling([16, 3 * 16 * 16])
+  x, x_mean, info = adaptive.solve_reverse_sde(plan, x, 1e-5)
+  assert abs(x.mean().item() - mu) < 0.05 and abs(x.std().item() - s0) < 0.05
+  assert torch.all(info['accepted'] > 0)
+  #two score evaluations per proposal, accepted or rejected
+  assert torch.equal(info['steps'], 2 * (info['accepted'] + info['rejected']))
+
+
+def test_tighter_tolerances_take_more_steps():
+  sde = sde_lib.VPSDE(N=1000)
+  mean_steps = []
+  for reltol in [0.05, 0.01]:
+    plan = make_plan(sde, gaussian_score_fn(sde, 0.5, 2.), 1e-3, reltol=reltol)
+    torch.manual_seed(0)
+    _, _, info = adaptive.solve_reverse_sde(plan, torch.randn(8, 3 * 16 * 16), 1e-3)
+    mean_steps.append(info['accepted'].double().mean().item())
+  assert mean_steps[1] > 2 * mean_steps[0]
+
+
+def test_corrector_runs_after_the_accepted_steps():
+  sde = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000)
+  plan = make_plan(sde, gaussian_score_fn(sde, 0., 1.), 1e-5, corrector='langevin')
+  plan.corrector.snr_groups = None
+  torch.manual_seed(0)
+  _, _, info = adaptive.solve_reverse_sde(plan, sde.prior_sampling([8, 2]), 1e-5)
+  #no correction after the step that lands on eps
+  assert torch.equal(info['steps'], 2 * (info['accepted'] + info['rejected']) + info['accepted'] - 1)
+
+
+def test_per_sample_noise_is_refused():
+  sde = sde_lib.VPSDE(N=1000)
+  plan = make_plan(sde, gaussian_score_fn(sde, 0., 1.), 1e-3)
+  plan.noise = object()
+  with pytest.raises(ValueError, match='per-sample noise'):
+    adaptive.solve_reverse_sde(plan, torch.randn(2, 3), 1e-3)
+
+
+def test_predictor_kwargs():
+  assert adaptive.get_predictor_kwargs(make_config(), predictors.get_predictor('euler_maruyama')) is None
+  kwargs = adaptive.get_predictor_kwargs(make_config(adaptive_reltol=0.02), predictors.get_predictor('adaptive'))
+  assert kwargs == {'abstol': 0.0078, 'reltol': 0.02, 'h_init': 0.01}
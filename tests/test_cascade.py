@@ -0,0 +1,64 @@
+import time
+import pytest
+import torch
+from sampling.cascade import CascadeStage, run_cascade
+
+
+def make_source(num_batches):
+  for i in range(num_batches):
+    yield 'batch_%d' % i, torch.full((3, 2), float(i)), i
+
+
+def test_outputs_in_source_order():
+  #the stages sleep for different times, so the batches overlap in the pipeline
+  def stage_fn(scale, delay):
+    def fn(x, name):
+      time.sleep(delay)
+      return x * scale + 1
+    return fn
+  stages = [CascadeStage(stage_fn(2, 0.01)), CascadeStage(stage_fn(3, 0.002))]
+  results = list(run_cascade(make_source(6), stages, queue_size=1))
+  assert [name for name, _, _ in results] == ['batch_%d' % i for i in range(6)]
+  assert [payload for _, _, payload in results] == list(range(6))
+  for i, (_, outputs, _) in enumerate(results):
+    assert len(outputs) == 3
+    assert torch.equal(outputs[1], torch.full((3, 2), 2. * i + 1))
+    assert torch.equal(outputs[2], torch.full((3, 2), 3. * (2 * i + 1) + 1))
+
+
+def test_only_last_output_without_keep_outputs():
+  results = list(run_cascade(make_source(3), [CascadeStage(lambda x, name: x + 1)], keep_outputs=False))
+  assert [len(outputs) for _, outputs, _ in results] == [1, 1, 1]
+  assert torch.equal(results[2][1][0], torch.full((3, 2), 3.))
+
+
+def test_stage_batch_size_splits_the_batch():
+  names = []
+
+  def fn(x, name):
+    names.append((name, x.size(0)))
+    return x * 2
+  stage = CascadeStage(fn, batch_size=2)
+  out = stage.process(torch.arange(5.)[:, None], 'batch_0')
+  assert torch.equal(out, 2 * torch.arange(5.)[:, None])
+  assert names == [('batch_0_part_0', 2), ('batch_0_part_1', 2), ('batch_0_part_2', 1)]
+
+
+def test_errors_of_a_stage_reach_the_consumer():
+  def fn(x, name):
+    if name == 'batch_2':
+      raise RuntimeError('stage failed on %s' % name)
+    return x
+  seen = []
+  with pytest.raises(RuntimeError, match='batch_2'):
+    for name, _, _ in run_cascade(make_source(5), [CascadeStage(lambda x, name: x), CascadeStage(fn)]):
+      seen.append(name)
+  assert seen == ['batch_0', 'batch_1']
+
+
+def test_errors_of_the_source_reach_the_consumer():
+  def source():
+    yield 'batch_0', torch.zeros(1), None
+    raise ValueError('loader failed')
+  with pytest.raises(ValueError, match='loader failed'):
+    list(run_cascade(source(), [CascadeStage(lambda x, name: x)]))
@@ -0,0 +1,110 @@
+import pytest
+import torch
+import sde_lib
+from conftest import ScoreModel, conditional_sde
+from sampling import conditional, unconditional, predictors, correctors
+from sampling.checkpoint import SamplingCheckpointer, get_checkpointer, get_fingerprint
+
+
+class Preempted(Exception):
+  pass
+
+
+class PreemptedModel(torch.nn.Module):
+  """The wrapped score model, interrupted at its `preempt_at`-th call."""
+
+  def __init__(self, model, preempt_at):
+    super().__init__()
+    self.model = model
+    self.calls = 0
+    self.preempt_at = preempt_at
+
+  @property
+  def device(self):
+    return self.model.device
+
+  def forward(self, *inputs):
+    self.calls += 1
+    if self.calls == self.preempt_at:
+      raise Preempted()
+    return self.model(*inputs)
+
+
+def get_conditional_sampler(snr=0.15, use_path=False):
+  return conditional.get_pc_conditional_sampler(conditional_sde(), (2, 3, 8, 8), predictors.get_predictor('conditional_euler_maruyama'),
+                                                correctors.get_corrector('conditional_langevin'), snr, 20, 1, use_path=use_path, eps=1e-5)
+
+
+@pytest.mark.parametrize('use_path', [False, True])
+def test_resume_is_bit_identical(tmp_path, conditional_score_model, use_path):
+  sampler, y = get_conditional_sampler(use_path=use_path), torch.rand(2, 3, 8, 8)
+  torch.manual_seed(5)
+  reference, _ = sampler(conditional_score_model, y)
+
+  checkpoint = SamplingCheckpointer(str(tmp_path / 'trajectory.pt'), every=6)
+  torch.manual_seed(5)
+  with pytest.raises(Preempted):
+    sampler(PreemptedModel(conditional_score_model, 25), y, checkpoint=checkpoint)
+  assert torch.load(checkpoint.path)['step'] == 11
+  #the restarted job has another RNG state, the snapshot restores it
+  torch.manual_seed(123)
+  resumed, info = sampler(conditional_score_model, y, checkpoint=checkpoint)
+  assert torch.equal(resumed, reference)
+  assert info == {'steps': 40}
+  #the final samples are kept
+  torch.manual_seed(7)
+  assert torch.equal(sampler(conditional_score_model, y, checkpoint=checkpoint)[0], reference)
+
+
+def test_unconditional_resume_is_bit_identical(tmp_path, score_model):
+  sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                         correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3)
+  torch.manual_seed(5)
+  reference, _ = sampler(score_model, seeds=[3, 4])
+  checkpoint = SamplingCheckpointer(str(tmp_path / 'trajectory.pt'), every=4)
+  with pytest.raises(Preempted):
+    sampler(PreemptedModel(score_model, 30), checkpoint=checkpoint, seeds=[3, 4])
+  resumed, _ = sampler(score_model, checkpoint=checkpoint, seeds=[3, 4])
+  assert torch.equal(resumed, reference)
+
+
+def test_snapshot_of_another_call_is_refused(tmp_path, conditional_score_model):
+  y = torch.rand(2, 3, 8, 8)
+  checkpoint = SamplingCheckpointer(str(tmp_path / 'trajectory.pt'), every=6)
+  with pytest.raises(Preempted):
+    get_conditional_sampler()(PreemptedModel(conditional_score_model, 25), y, checkpoint=checkpoint, seeds=[1, 2])
+  torch.manual_seed(0)
+  calls = {'y': lambda: get_conditional_sampler()(conditional_score_model, torch.rand(2, 3, 8, 8), checkpoint=checkpoint, seeds=[1, 2]),
+           'snr': lambda: get_conditional_sampler(snr=0.2)(conditional_score_model, y, checkpoint=checkpoint, seeds=[1, 2]),
+           'seeds': lambda: get_conditional_sampler()(conditional_score_model, y, checkpoint=checkpoint, seeds=[1, 3]),
+           'model': lambda: get_conditional_sampler()(ScoreModel(conditional=True), y, checkpoint=checkpoint, seeds=[1, 2])}
+  for name, call in calls.items():
+    with pytest.raises(ValueError, match='different sampler arguments'):
+      call()
+  samples, _ = get_conditional_sampler()(conditional_score_model, y, checkpoint=checkpoint, seeds=[1, 2])
+  assert samples.shape == (2, 3, 8, 8)
+
+
+def test_done_snapshot_of_another_condition_is_refused(tmp_path, conditional_score_model):
+  checkpoint = SamplingCheckpointer(str(tmp_path / 'trajectory.pt'), every=6)
+  y = torch.rand(2, 3, 8, 8)
+  get_conditional_sampler()(conditional_score_model, y, checkpoint=checkpoint)
+  assert torch.load(checkpoint.path)['done']
+  with pytest.raises(ValueError):
+    get_conditional_sampler()(conditional_score_model, y.flip(0), checkpoint=checkpoint)
+
+
+def test_fingerprint(score_model):
+  y = torch.rand(2, 3)
+  assert get_fingerprint(score_model, y=y, snr=0.15) == get_fingerprint(score_model, snr=0.15, y=y.clone())
+  assert get_fingerprint(score_model, y=y) != get_fingerprint(score_model, y=y + 1e-3)
+  assert get_fingerprint(score_model, y=y) != get_fingerprint(score_model, y=y.flip(0))
+  assert get_fingerprint(score_model, predictor=predictors.get_predictor('euler_maruyama')) != \
+         get_fingerprint(score_model, predictor=predictors.get_predictor('reverse_diffusion'))
+
+
+def test_get_checkpointer(tmp_path):
+  assert get_checkpointer(str(tmp_path), 'batch_0', None) is None
+  assert get_checkpointer(str(tmp_path), 'batch_0', 0) is None
+  checkpointer = get_checkpointer(str(tmp_path), 'batch_0', 10)
+  assert checkpointer.path == str(tmp_path / 'batch_0.pt') and checkpointer.every == 10
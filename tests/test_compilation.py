@@ -0,0 +1,62 @@
+import os
+import pytest
+import torch
+import sde_lib
+from conftest import make_config, conditional_sde
+from sampling import compilation, conditional, unconditional, predictors, correctors
+
+
+def sample_conditional(model, **sampling):
+  sampling_fn = conditional.get_conditional_sampling_fn(make_config(**sampling), conditional_sde(N=10), [2, 3, 8, 8], eps=1e-5)
+  torch.manual_seed(1)
+  return sampling_fn(model, torch.rand(2, 3, 8, 8, generator=torch.Generator().manual_seed(0)))[0]
+
+
+def test_step_compiler_from_config(tmp_path):
+  assert compilation.get_step_compiler(make_config()) is None
+  assert compilation.get_step_compiler(make_config(compile='none')) is None
+  with pytest.raises(ValueError):
+    compilation.get_step_compiler(make_config(compile='xla'))
+  compiler = compilation.get_step_compiler(make_config(compile='torchscript', compile_cache_dir=str(tmp_path)))
+  assert compiler.backend == 'torchscript' and compiler.get_cache_dir().startswith(str(tmp_path))
+  #one cache directory per configuration
+  other = compilation.get_step_compiler(make_config(compile='torchscript', compile_cache_dir=str(tmp_path), snr=0.2))
+  assert other.get_cache_dir() != compiler.get_cache_dir()
+
+
+def test_environ_is_restored(monkeypatch):
+  monkeypatch.delenv('TORCHINDUCTOR_CACHE_DIR', raising=False)
+  with compilation._environ('TORCHINDUCTOR_CACHE_DIR', '/tmp/cache'):
+    assert os.environ['TORCHINDUCTOR_CACHE_DIR'] == '/tmp/cache'
+  assert 'TORCHINDUCTOR_CACHE_DIR' not in os.environ
+
+
+def test_torchscript_sampler_equals_eager(conditional_score_model):
+  eager = sample_conditional(conditional_score_model)
+  traced = sample_conditional(conditional_score_model, compile='torchscript')
+  assert torch.allclose(traced, eager, atol=1e-6)
+  #the weights are trainable again after the tracing
+  assert all(p.requires_grad for p in conditional_score_model.parameters())
+
+
+def test_torchscript_unconditional_sampler(score_model):
+  compiler = compilation.StepCompiler('torchscript')
+  sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                         correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3)
+  compiled_sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                                  correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3, compiler=compiler)
+  torch.manual_seed(0)
+  eager = sampler(score_model)[0]
+  torch.manual_seed(0)
+  assert torch.allclose(compiled_sampler(score_model)[0], eager, atol=1e-6)
+  with pytest.raises(ValueError, match='per-sample noise'):
+    compiled_sampler(score_model, seeds=[1, 2])
+
+
+def test_torch_compile_sampler_equals_eager(conditional_score_model, tmp_path):
+  torch._dynamo.reset()
+  eager = sample_conditional(conditional_score_model)
+  compiled = sample_conditional(conditional_score_model, compile='torch_compile', compile_cache_dir=str(tmp_path))
+  #the same noise (fallback_random), fused arithmetic
+  assert torch.allclose(compiled, eager, atol=1e-5)
+  assert len(os.listdir(tmp_path)) == 1
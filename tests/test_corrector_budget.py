@@ -0,0 +1,41 @@
+import pytest
+import torch
+from conftest import make_config, conditional_sde
+from sampling import conditional, schedules
+
+
+def test_corrector_schedules():
+  timesteps = torch.tensor([1., 0.8, 0.5, 0.3, 0.1])
+  assert schedules.get_corrector_budget(None, timesteps) == [1, 1, 1, 1, 1]
+  assert schedules.get_corrector_budget(schedules.constant_corrector_schedule(3), timesteps) == [3] * 5
+  assert schedules.get_corrector_budget(schedules.below_corrector_schedule(0.5, 2), timesteps) == [0, 0, 0, 2, 2]
+  piecewise = schedules.piecewise_corrector_schedule([0.2, 0.6], [4, 2, 0])
+  assert schedules.get_corrector_budget(piecewise, timesteps) == [0, 0, 2, 2, 4]
+  with pytest.raises(ValueError):
+    schedules.piecewise_corrector_schedule([0.2, 0.6], [4, 2])
+
+
+def test_corrector_schedule_from_config():
+  timesteps = torch.tensor([0.9, 0.4, 0.1])
+  config = make_config(corrector_schedule='below', corrector_t_star=0.5, corrector_steps=3)
+  assert schedules.get_corrector_budget(schedules.get_corrector_schedule_fn(config), timesteps) == [0, 3, 3]
+  #config.eval overrides config.sampling
+  config.eval.corrector_schedule = 'piecewise'
+  config.eval.corrector_boundaries = [0.5]
+  config.eval.corrector_values = [2, 1]
+  assert schedules.get_corrector_budget(schedules.get_corrector_schedule_fn(config), timesteps) == [1, 2, 2]
+  #an explicit schedule reads its options from config.sampling
+  assert schedules.get_corrector_budget(schedules.get_corrector_schedule_fn(config, 'constant'), timesteps) == [3, 3, 3]
+  with pytest.raises(ValueError):
+    schedules.get_corrector_schedule_fn(config, 'linear')
+
+
+def test_sampler_spends_the_budget(conditional_score_model):
+  calls = []
+  conditional_score_model.register_forward_hook(lambda module, inputs, output: calls.append(1))
+  config = make_config(corrector_schedule='below', corrector_t_star=0.5, corrector_steps=2)
+  sampling_fn = conditional.get_conditional_sampling_fn(config, conditional_sde(), [2, 3, 8, 8], eps=1e-5)
+  _, info = sampling_fn(conditional_score_model, torch.rand(2, 3, 8, 8))
+  budget = schedules.get_corrector_budget(schedules.below_corrector_schedule(0.5, 2), torch.linspace(1., 1e-5, 20))
+  assert sum(budget) == 2 * 10
+  assert info['steps'] == 20 + sum(budget) == len(calls)
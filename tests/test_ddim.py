@@ -0,0 +1,64 @@
+import pytest
+import torch
+import sde_lib
+from sampling import predictors, correctors, unconditional
+from sampling.schedules import get_timesteps
+
+
+def gaussian_score_fn(sde, mu, s0):
+  """The exact score of data distributed as N(mu, s0^2) in every dimension."""
+  def score_fn(x, t):
+    mean_coeff, std = sde.marginal_prob(torch.ones_like(t), t)
+    expand = (...,) + (None,) * len(x.shape[1:])
+    return -(x - mean_coeff[expand] * mu) / (mean_coeff[expand] ** 2 * s0 ** 2 + std[expand] ** 2)
+  return score_fn
+
+
+def run_ddim(sde, score_fn, x, num_steps, eps):
+  predictor = predictors.get_predictor('ddim')(sde, score_fn)
+  timesteps = get_timesteps(sde, num_steps, eps)
+  coeffs = sde.get_step_coefficients(timesteps)
+  for i in range(num_steps):
+    x, x_mean = predictor.update_fn(x, timesteps[i].expand(x.shape[0]), {key: value[i] for key, value in coeffs.items()})
+  return x_mean
+
+
+@pytest.mark.parametrize('sde, eps', [(sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000), 1e-5),
+                                      (sde_lib.VPSDE(N=1000), 1e-3)], ids=['ve', 'vp'])
+def test_point_mass_is_reached_in_any_number_of_steps(sde, eps):
+  #the data estimate of the exact score of a point mass is the point itself
+  mu = torch.tensor([0.3, -1.2])
+  x = sde.prior_sampling([4, 2]).double()
+  for num_steps in [1, 3, 10]:
+    assert torch.allclose(run_ddim(sde, gaussian_score_fn(sde, mu.double(), 0.), x, num_steps, eps), mu.double().expand(4, 2), atol=1e-6)
+
+
+def test_ve_ddim_follows_the_probability_flow():
+  #for Gaussian data the probability flow ODE scales x - mu by sqrt(s0^2 + sigma(t)^2)
+  sde, mu, s0 = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000), 0.5, 2.
+  torch.manual_seed(0)
+  x = sde.prior_sampling([1000, 1]).double()
+  samples = run_ddim(sde, gaussian_score_fn(sde, mu, s0), x, 500, 1e-5)
+  expected = mu + (x - mu) * s0 / (s0 ** 2 + 50. ** 2) ** 0.5
+  assert torch.allclose(samples, expected, rtol=1e-2, atol=1e-2)
+
+
+def test_ddim_needs_the_grid():
+  sde = sde_lib.VPSDE(N=10)
+  predictor = predictors.get_predictor('ddim')(sde, gaussian_score_fn(sde, 0., 1.))
+  with pytest.raises(ValueError, match='coefficients'):
+    predictor.update_fn(torch.zeros(2, 3), torch.ones(2))
+
+
+def test_ddim_sampler_is_deterministic(score_model):
+  sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=1000), (2, 3, 8, 8), predictors.get_predictor('ddim'),
+                                         correctors.get_corrector('none'), 0.16, 25, 1, eps=1e-3)
+  calls = []
+  score_model.register_forward_hook(lambda module, inputs, output: calls.append(1))
+  samples = []
+  for seed in [0, 0, 1]:
+    torch.manual_seed(seed)
+    samples.append(sampler(score_model)[0])
+  #one score evaluation per predictor step
+  assert len(calls) == 3 * 25
+  assert torch.equal(samples[0], samples[1]) and not torch.allclose(samples[0], samples[2])
@@ -0,0 +1,69 @@
+import pytest
+import torch
+import sde_lib
+from conftest import conditional_sde
+from sampling import dpm_solver
+
+SDES = {'ve': (lambda: sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000), 1e-5),
+        'vp': (lambda: sde_lib.VPSDE(N=1000), 1e-3)}
+
+
+def gaussian_problem(sde, mu=0.5, s0=2.):
+  """Data distributed as N(mu, s0^2): the exact data prediction and the exact probability flow."""
+  def coefficients(t):
+    return sde.marginal_prob(torch.ones_like(t, dtype=torch.float64), t.double())
+
+  def data_pred_fn(x, vec_t, i):
+    mean_coeff, std = coefficients(vec_t[:1])
+    return mu + mean_coeff * s0 ** 2 * (x - mean_coeff * mu) / (mean_coeff ** 2 * s0 ** 2 + std ** 2)
+
+  def flow(x, t_from, t_to):
+    (m0, std0), (m1, std1) = coefficients(torch.tensor([t_from])), coefficients(torch.tensor([t_to]))
+    return m1 * mu + (x - m0 * mu) * torch.sqrt((m1 ** 2 * s0 ** 2 + std1 ** 2) / (m0 ** 2 * s0 ** 2 + std0 ** 2))
+  return data_pred_fn, flow
+
+
+@pytest.mark.parametrize('name', SDES)
+def test_inverse_lambda(name):
+  sde, eps = SDES[name][0](), SDES[name][1]
+  t = torch.linspace(1., eps, 7, dtype=torch.float64)
+  assert torch.allclose(dpm_solver.inverse_lambda(sde, dpm_solver.marginal_lambda(sde, t)), t, atol=1e-9)
+
+
+def test_log_snr_grid():
+  sde = SDES['vp'][0]()
+  timesteps = dpm_solver.get_time_steps(sde, 10, 1e-3)
+  assert timesteps.shape == (11,) and timesteps[0] == 1. and torch.isclose(timesteps[-1], torch.tensor(1e-3))
+  steps = torch.diff(dpm_solver.marginal_lambda(sde, timesteps.double()))
+  assert torch.allclose(steps, steps.mean().expand(10), rtol=1e-4)
+
+
+@pytest.mark.parametrize('name', SDES)
+def test_higher_orders_converge_faster(name):
+  sde, eps = SDES[name][0](), SDES[name][1]
+  data_pred_fn, flow = gaussian_problem(sde)
+  prior_std = sde.marginal_prob(torch.ones(1), torch.ones(1))[1].item()
+  x = torch.linspace(-3., 3., 7, dtype=torch.float64)[:, None] * prior_std
+  errors = {}
+  for order in [1, 2, 3]:
+    for steps in [20, 40]:
+      timesteps = dpm_solver.get_time_steps(sde, steps, eps).double()
+      samples, nfe, _ = dpm_solver.multistep_dpm_solver(data_pred_fn, sde, x, timesteps, order, lower_order_final=False)
+      assert nfe == steps
+      errors[order, steps] = (samples - flow(x, 1., timesteps[-1].item())).abs().max().item()
+  assert errors[3, 40] < errors[2, 40] < errors[1, 40]
+  #halving the step of a method of order k divides the error by about 2^k
+  assert 1.7 < errors[1, 20] / errors[1, 40] < 2.3
+  assert 3.3 < errors[2, 20] / errors[2, 40] < 4.7
+
+
+def test_samplers(score_model, conditional_score_model):
+  sampler = dpm_solver.get_dpm_solver_sampler(SDES['vp'][0](), (2, 3, 8, 8), steps=10, order=3, denoise=True)
+  samples, info = sampler(score_model)
+  assert samples.shape == (2, 3, 8, 8) and torch.all(torch.isfinite(samples))
+  assert info['steps'] == 11 and info['times'].shape == (11,)
+
+  sampler = dpm_solver.get_conditional_dpm_solver_sampler(conditional_sde(), (2, 3, 8, 8), steps=8)
+  torch.manual_seed(0)
+  samples, info = sampler(conditional_score_model, torch.rand(2, 3, 8, 8), seeds=[1, 2])
+  assert info['steps'] == 8 and torch.all(torch.isfinite(samples))
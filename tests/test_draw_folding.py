@@ -0,0 +1,79 @@
+import ml_collections
+import pytest
+import torch
+from conftest import make_config, conditional_sde
+from sampling.conditional import get_conditional_sampling_fn
+
+pytest.importorskip('pytorch_lightning')
+pytest.importorskip('lpips')
+pytest.importorskip('torchvision')
+from lightning_callbacks import PairedCallback
+
+
+class ConditionalModule:
+  """The sampling interface of the conditional lightning modules around a small score model."""
+
+  def __init__(self, score_model):
+    self.config = make_config()
+    self.sde = conditional_sde(N=10)
+    self.score_model = score_model
+
+  def sample(self, y, show_evolution=False, checkpoint=None, seeds=None, **kwargs):
+    sampling_fn = get_conditional_sampling_fn(self.config, self.sde, [y.size(0), 3, 8, 8], 1e-5, **kwargs)
+    return sampling_fn(self.score_model, y, show_evolution, checkpoint=checkpoint, seeds=seeds)
+
+
+def get_callback(tmp_path, **eval_settings):
+  eval_config = ml_collections.ConfigDict({
+    'predictor': 'conditional_reverse_diffusion', 'corrector': 'conditional_langevin', 'p_steps': 10, 'c_steps': 1,
+    'denoise': True, 'use_path': False, 'save_samples': False, 'base_log_dir': str(tmp_path), 'draws': [1, 2, 3],
+    'evaluation_metrics': ['psnr'], 'snr': [0.15], 'batch_size': 4, 'first_test_batch': 0, 'last_test_batch': 1})
+  eval_config.update(eval_settings)
+  data_config = ml_collections.ConfigDict({'dataset': 'test', 'task': 'super-resolution'})
+  return PairedCallback.TestPairedVisualizationCallback(False, eval_config, data_config, 'test')
+
+
+@pytest.mark.parametrize('max_size', [None, 5, 12, 13, 40])
+def test_micro_batches(tmp_path, max_size):
+  callback = get_callback(tmp_path, max_sampling_batch_size=max_size)
+  micro_batches = callback.get_micro_batches(36, 12)
+  #a partition of the tiled batch into micro-batches of at most max_size samples
+  assert [start for start, _ in micro_batches] == [0] + [end for _, end in micro_batches[:-1]] and micro_batches[-1][1] == 36
+  assert all(end - start <= (max_size or 36) for start, end in micro_batches)
+  #that hold whole groups or a part of one group
+  for start, end in micro_batches:
+    assert (start % 12 == 0 and end % 12 == 0) or start // 12 == (end - 1) // 12
+  if max_size == 13:
+    assert micro_batches == [(0, 12), (12, 24), (24, 36)]
+
+
+def test_tiled_conditions(tmp_path):
+  callback = get_callback(tmp_path)
+  y = torch.arange(4.).view(4, 1, 1, 1).expand(4, 3, 2, 2).contiguous()
+  tiled = y.repeat(3, 1, 1, 1)
+  for start in range(12):
+    for end in range(start + 1, 13):
+      assert torch.equal(callback.get_tiled_conditions(y, start, end), tiled[start:end])
+  #the conditions within a draw are a view of y
+  assert callback.get_tiled_conditions(y, 5, 7).data_ptr() == y[1].data_ptr()
+
+
+@pytest.mark.parametrize('max_size', [None, 5, 8])
+def test_folded_draws_equal_separate_draws(tmp_path, conditional_score_model, max_size):
+  module = ConditionalModule(conditional_score_model)
+  y = torch.rand(4, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+  separate = get_callback(tmp_path, sampling_seed=7).sample_draws(y, module, 0.15)
+  folded = get_callback(tmp_path, sampling_seed=7, batch_draws=True, max_sampling_batch_size=max_size).sample_draws(y, module, 0.15)
+  assert folded.shape == separate.shape == (3, 4, 3, 8, 8)
+  assert torch.allclose(folded, separate, atol=1e-5)
+  #the draws are distinct samples
+  assert not torch.allclose(folded[0], folded[1])
+
+
+def test_folded_draws_use_one_sampler_pass(tmp_path, conditional_score_model):
+  module = ConditionalModule(conditional_score_model)
+  sizes = []
+  module.score_model.register_forward_hook(lambda model, inputs, output: sizes.append(inputs[0]['x'].size(0)))
+  get_callback(tmp_path, batch_draws=True).sample_draws(torch.rand(4, 3, 8, 8), module, 0.15)
+  #10 corrector and 10 predictor steps on the 3 draws of the 4 images
+  assert sizes == [12] * 20
@@ -0,0 +1,75 @@
+import pytest
+import torch
+import sde_lib
+from conftest import make_config
+from sampling import evolution, unconditional, predictors, correctors
+
+
+def run(recorder, num_steps, num_steps_known=True):
+  recorder.start(num_steps if num_steps_known else None)
+  for i in range(num_steps):
+    recorder.record(i, torch.full((2, 3), float(i)))
+  return recorder
+
+
+def test_stride_keeps_the_last_step():
+  recorder = run(evolution.EvolutionRecorder(stride=4), 10)
+  assert recorder.get_steps() == [0, 4, 8, 9]
+  assert torch.equal(recorder.get()[:, 0, 0], torch.tensor([0., 4., 8., 9.]))
+  assert run(evolution.EvolutionRecorder(stride=4), 10, num_steps_known=False).get_steps() == [0, 4, 8]
+
+
+def test_max_frames_increases_the_stride():
+  recorder = run(evolution.EvolutionRecorder(max_frames=5), 100)
+  assert recorder.stride == 20
+  assert recorder.get_steps() == [0, 20, 40, 60, 80, 99]
+
+
+def test_ring_buffer_keeps_the_latest_frames():
+  recorder = run(evolution.EvolutionRecorder(stride=2, buffer_size=3), 11)
+  assert recorder.get_steps() == [6, 8, 10]
+  assert torch.equal(recorder.get()[:, 1, 2], torch.tensor([6., 8., 10.]))
+
+
+@pytest.mark.parametrize('dtype, atol', [('float16', 1e-2), ('uint8', None)])
+def test_quantisation(dtype, atol):
+  torch.manual_seed(0)
+  x = torch.randn(4, 3, 8, 8) * torch.tensor([1., 10., 100., 0.])[:, None, None, None]
+  recorder = evolution.EvolutionRecorder(dtype=dtype)
+  recorder.record(0, x)
+  frame, _ = recorder.frames[0]
+  assert frame.dtype == getattr(torch, dtype)
+  restored = recorder.get()[0]
+  if dtype == 'uint8':
+    #half a quantisation step of the range of every sample
+    ranges = x.reshape(4, -1).max(1).values - x.reshape(4, -1).min(1).values
+    assert torch.all((restored - x).abs().reshape(4, -1).max(1).values <= ranges / 255. / 2 + 1e-5)
+  else:
+    assert torch.allclose(restored, x, rtol=1e-3, atol=atol)
+
+
+def test_streamed_frames(tmp_path):
+  path = str(tmp_path / 'evolution.pkl')
+  recorder = run(evolution.EvolutionRecorder(stride=3, path=path), 7)
+  assert recorder.get() is None
+  frames, steps = evolution.load_evolution(path)
+  assert steps == [0, 3, 6] and torch.equal(frames[:, 0, 0], torch.tensor([0., 3., 6.]))
+
+
+def test_frames_of_dicts():
+  recorder = evolution.EvolutionRecorder()
+  for i in range(2):
+    recorder.record(i, {'x': torch.full((1, 2), float(i)), 'y': torch.full((1, 2), -float(i))})
+  frames = recorder.get()
+  assert frames['x'].shape == (2, 1, 2) and torch.equal(frames['y'][:, 0, 0], torch.tensor([0., -1.]))
+
+
+def test_inplace_sampler_records_distinct_frames(score_model):
+  sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                         correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3, inplace=True)
+  config = make_config(evolution_stride=5, evolution_max_frames=None)
+  _, info = sampler(score_model, show_evolution=evolution.get_evolution_recorder(config))
+  frames = info['evolution']
+  assert info['evolution_steps'] == [0, 5, 10, 15, 19]
+  #the frames are copies, not the buffers the in-place updates overwrite
+  assert all(not torch.equal(frames[k], frames[k + 1]) for k in range(len(frames) - 1))
@@ -0,0 +1,94 @@
+import pytest
+import torch
+import sde_lib
+import gaussian_prior
+from sampling import schedules
+
+
+def get_data(n=4000, seed=0):
+  """Samples of shape 2 x 3 of a Gaussian with a dominant direction."""
+  generator = torch.Generator().manual_seed(seed)
+  direction = torch.tensor([1., 2., 0., -1., 0.5, 0.])
+  x = torch.randn(n, 1, generator=generator) * 3. * direction / direction.norm() + 0.2 * torch.randn(n, 6, generator=generator)
+  return (x + torch.arange(6.)).reshape(n, 2, 3)
+
+
+def covariance(gaussian, std=0.):
+  U = gaussian.components
+  return U.t() @ torch.diag(gaussian.eigenvalues) @ U + torch.diag(gaussian.diagonal + std ** 2)
+
+
+def test_streaming_fit_equals_the_sample_statistics():
+  data = get_data()
+  fit = gaussian_prior.StreamingGaussianFit(rank=6)
+  for batch in data.split(300):
+    fit.update(batch)
+  gaussian = fit.get_gaussian()
+  x = data.reshape(data.size(0), -1).double()
+  assert torch.allclose(gaussian.mean, data.mean(0), atol=1e-5)
+  #with the full rank the components carry the whole sample covariance
+  assert torch.allclose(covariance(gaussian).double(), torch.cov(x.t()), atol=1e-4)
+  assert torch.allclose(gaussian.diagonal, torch.full((6,), 1e-6))
+
+
+def test_low_rank_fit_keeps_the_variances():
+  data = get_data()
+  fit = gaussian_prior.StreamingGaussianFit(rank=1)
+  for batch in data.split(500):
+    fit.update(batch)
+  gaussian = fit.get_gaussian()
+  sample_covariance = torch.cov(data.reshape(data.size(0), -1).t().double()).float()
+  assert gaussian.rank == 1
+  assert torch.allclose(torch.diag(covariance(gaussian)), torch.diag(sample_covariance), atol=1e-4)
+  #the top component is the dominant direction
+  direction = torch.tensor([1., 2., 0., -1., 0.5, 0.])
+  assert abs(gaussian.components[0] @ direction / direction.norm()) > 0.999
+  with pytest.raises(ValueError):
+    gaussian_prior.StreamingGaussianFit(rank=1).get_gaussian()
+
+
+@pytest.mark.parametrize('std', [0., 1.5])
+def test_log_prob_equals_the_dense_gaussian(std):
+  fit = gaussian_prior.StreamingGaussianFit(rank=2)
+  fit.update(get_data(500))
+  gaussian = fit.get_gaussian()
+  z = get_data(5, seed=1)
+  dense = torch.distributions.MultivariateNormal(gaussian.mean.reshape(-1).double(), covariance(gaussian, std).double())
+  assert torch.allclose(gaussian.log_prob(z, std).double(), dense.log_prob(z.reshape(5, -1).double()), atol=1e-3)
+
+
+def test_samples_have_the_covariance(tmp_path):
+  fit = gaussian_prior.StreamingGaussianFit(rank=2)
+  fit.update(get_data(500))
+  gaussian = fit.get_gaussian()
+  gaussian.save(str(tmp_path / 'prior.pt'))
+  loaded = gaussian_prior.load_gaussian_prior(str(tmp_path / 'prior.pt'))
+  torch.manual_seed(0)
+  samples = loaded.sample([50000, 2, 3], std=2.)
+  assert samples.shape == (50000, 2, 3)
+  assert torch.allclose(samples.mean(0), gaussian.mean, atol=0.05)
+  assert torch.allclose(torch.cov(samples.reshape(50000, -1).t()), covariance(gaussian, 2.), atol=0.1)
+  with pytest.raises(ValueError):
+    loaded.sample([4, 3, 2])
+
+
+def test_ve_sde_starts_at_the_fitted_prior():
+  fit = gaussian_prior.StreamingGaussianFit(rank=2)
+  fit.update(get_data(500))
+  gaussian = fit.get_gaussian()
+  sde = sde_lib.VESDE(sigma_min=0.01, sigma_max=50., N=100, gaussian_prior=gaussian, t_start=0.5)
+  assert sde.t_start == 0.5 and sde.prior_std == pytest.approx(0.01 * 5000 ** 0.5)
+  torch.manual_seed(0)
+  prior = sde.prior_sampling([4, 2, 3])
+  torch.manual_seed(0)
+  assert torch.equal(prior, gaussian.sample([4, 2, 3], std=sde.prior_std))
+  assert torch.allclose(sde.prior_logp(prior), gaussian.log_prob(prior, std=sde.prior_std))
+  #the sampler grid starts at t_start
+  timesteps = schedules.get_timesteps(sde, 10, 1e-5)
+  assert timesteps[0] == 0.5 and torch.all(timesteps[1:] < 0.5)
+  #without t_start the prior is the fitted Gaussian at T
+  assert sde_lib.VESDE(sigma_max=50., gaussian_prior=gaussian).prior_std == pytest.approx(50.)
+  with pytest.raises(ValueError):
+    sde_lib.VESDE(t_start=0.5)
+  with pytest.raises(ValueError):
+    sde_lib.VESDE(gaussian_prior=gaussian, t_start=1.5)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+import sde_lib
+from conftest import conditional_sde
+from sampling import conditional, unconditional, predictors, correctors
+from sampling.plan import StepBuffers
+from sampling.rng import SampleNoise
+
+
+@pytest.mark.parametrize('predictor, corrector', [('euler_maruyama', 'langevin'), ('reverse_diffusion', 'none'),
+                                                  ('none', 'langevin')])
+@pytest.mark.parametrize('seeds', [None, [3, 4]])
+def test_inplace_sampler_matches(score_model, predictor, corrector, seeds):
+  samples = []
+  for inplace in [False, True]:
+    sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor(predictor),
+                                           correctors.get_corrector(corrector), 0.15, 20, 1, eps=1e-3, inplace=inplace)
+    torch.manual_seed(5)
+    samples.append(sampler(score_model, seeds=seeds)[0])
+  assert torch.allclose(samples[0], samples[1], atol=1e-5)
+
+
+@pytest.mark.parametrize('seeds', [None, [3, 4]])
+def test_inplace_conditional_sampler_matches(conditional_score_model, seeds):
+  y, samples = torch.rand(2, 3, 8, 8), []
+  for inplace in [False, True]:
+    sampler = conditional.get_pc_conditional_sampler(conditional_sde(), (2, 3, 8, 8), predictors.get_predictor('conditional_reverse_diffusion'),
+                                                     correctors.get_corrector('conditional_langevin'), 0.15, 20, 1, eps=1e-5, inplace=inplace)
+    torch.manual_seed(5)
+    samples.append(sampler(conditional_score_model, y, seeds=seeds)[0])
+  assert torch.allclose(samples[0], samples[1], atol=1e-5)
+
+
+def test_buffers_draw_into_place():
+  like = torch.zeros(3, 2, 4, 5)
+  buffers = StepBuffers()
+  buffer = buffers.get('noise', like)
+  torch.manual_seed(0)
+  noise = buffers.randn('noise', like)
+  assert noise.data_ptr() == buffer.data_ptr()
+  torch.manual_seed(0)
+  assert torch.equal(noise, torch.randn_like(like))
+
+  #the per-sample streams write every sample into its slice of the buffer
+  buffers.noise = SampleNoise([7, 8, 9])
+  noise = buffers.randn('noise', like)
+  assert noise.data_ptr() == buffer.data_ptr()
+  assert torch.equal(noise, SampleNoise([7, 8, 9]).randn_like(like))
+  assert buffers.noise.counter == 1
+
+
+def test_buffers_of_another_shape_are_reallocated():
+  buffers = StepBuffers()
+  first = buffers.get('x', torch.zeros(2, 3))
+  assert buffers.get('x', torch.ones(2, 3)) is first
+  assert buffers.get('x', torch.zeros(4, 3)).shape == (4, 3)
+  assert buffers.get('x', torch.zeros(4, 3, dtype=torch.float64)).dtype == torch.float64
+  #the buffers are contiguous, so that the slices of the samples are too
+  assert buffers.get('y', torch.zeros(2, 3, 4, 5).to(memory_format=torch.channels_last)).is_contiguous()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+from scipy import integrate
+import sde_lib
+from sampling import ode_solvers, unconditional
+
+
+def decay(t, y):
+  return -2. * y + torch.sin(t * torch.ones_like(y))
+
+
+def test_rk45_matches_scipy():
+  y0 = torch.tensor([1., -0.5, 2.], dtype=torch.float64)
+  solution = ode_solvers.solve_ivp(decay, (0., 3.), y0, rtol=1e-6, atol=1e-8)
+  reference = integrate.solve_ivp(lambda t, y: -2. * y + np.sin(t), (0., 3.), y0.numpy(), rtol=1e-6, atol=1e-8, method='RK45')
+  assert solution.success and solution.t == 3.
+  #same tableau and step size control as scipy: same steps, same evaluations
+  assert solution.nfev == reference.nfev
+  assert np.allclose(solution.y.numpy(), reference.y[:, -1], rtol=1e-12, atol=1e-12)
+
+
+def test_rk45_backwards_in_time():
+  y0 = torch.tensor([1., 3.], dtype=torch.float64)
+  solution = ode_solvers.solve_ivp(lambda t, y: -y, (1., 1e-3), y0, rtol=1e-8, atol=1e-10)
+  assert solution.t == 1e-3
+  assert torch.allclose(solution.y, y0 * np.exp(1. - 1e-3), rtol=1e-7)
+
+
+def test_rk45_step_is_fifth_order():
+  #halving the step divides the error of one step by about 2^5
+  errors = []
+  for h in [0.2, 0.1]:
+    y0 = torch.tensor([1.], dtype=torch.float64)
+    y, _, _ = ode_solvers.rk45_step(lambda t, y: -y, 0., y0, -y0, h, 1.)
+    errors.append(abs(y.item() - np.exp(-h)))
+  assert 40 < errors[0] / errors[1] < 80
+
+
+def test_only_rk45():
+  with pytest.raises(NotImplementedError):
+    ode_solvers.solve_ivp(decay, (0., 1.), torch.ones(2), method='RK23')
+
+
+def test_torch_ode_sampler_matches_scipy(score_model):
+  sde = sde_lib.VPSDE(N=20)
+  z = torch.randn(2, 3, 8, 8)
+  samples = {}
+  for solver in ['torch', 'scipy']:
+    sampler = unconditional.get_ode_sampler(sde, (2, 3, 8, 8), rtol=1e-4, atol=1e-4, solver=solver)
+    samples[solver], nfe = sampler(score_model, z=z)
+    assert nfe > 10
+  assert torch.allclose(samples['torch'], samples['scipy'], atol=1e-3)
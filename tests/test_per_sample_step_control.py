@@ -0,0 +1,56 @@
+import torch
+import sde_lib
+import likelihood
+from sampling import ode_solvers, unconditional
+
+RATES = torch.tensor([0.5, 50., 3.], dtype=torch.float64)
+
+
+def stiff_decay(vec_t, y, index):
+  #every sample decays at its own rate
+  return -RATES[index][:, None] * y
+
+
+def test_samples_are_solved_independently():
+  y0 = torch.ones(3, 2, dtype=torch.float64)
+  solution = ode_solvers.solve_ivp_per_sample(stiff_decay, (0., 1.), y0, rtol=1e-6, atol=1e-8)
+  assert solution.success and torch.all(solution.t == 1.)
+  assert torch.allclose(solution.y, torch.exp(-RATES)[:, None].expand(3, 2), rtol=1e-5)
+  #the stiff sample needs more evaluations, the others are not slowed down by it
+  assert solution.nfev[1] > solution.nfev[2] > solution.nfev[0]
+  for b in range(3):
+    rate = RATES[b].item()
+    alone = ode_solvers.solve_ivp(lambda t, y: -rate * y, (0., 1.), y0[b], rtol=1e-6, atol=1e-8)
+    assert solution.nfev[b] == alone.nfev
+    assert torch.allclose(solution.y[b], alone.y, rtol=1e-12)
+
+
+def test_finished_samples_leave_the_batch():
+  batch_sizes = []
+
+  def fun(vec_t, y, index):
+    batch_sizes.append(len(index))
+    return stiff_decay(vec_t, y, index)
+  solution = ode_solvers.solve_ivp_per_sample(fun, (0., 1.), torch.ones(3, 2, dtype=torch.float64), rtol=1e-6, atol=1e-8)
+  assert batch_sizes[0] == 3 and batch_sizes[-1] == 1
+  assert sum(batch_sizes) == int(solution.nfev.sum())
+
+
+def test_per_sample_ode_sampler(score_model):
+  sde, z = sde_lib.VPSDE(N=20), torch.randn(2, 3, 8, 8)
+  batch, _ = unconditional.get_ode_sampler(sde, (2, 3, 8, 8), rtol=1e-5, atol=1e-5)(score_model, z=z)
+  per_sample, nfe = unconditional.get_ode_sampler(sde, (2, 3, 8, 8), rtol=1e-5, atol=1e-5, step_control='per_sample')(score_model, z=z)
+  assert nfe.shape == (2,)
+  assert torch.allclose(per_sample, batch, atol=1e-3)
+
+
+def test_per_sample_likelihood(score_model):
+  sde, data = sde_lib.VPSDE(N=20), torch.rand(2, 3, 8, 8)
+  bpds = []
+  for step_control in ['batch', 'per_sample']:
+    likelihood_fn = likelihood.get_likelihood_fn(sde, lambda x: x, rtol=1e-5, atol=1e-5, step_control=step_control)
+    torch.manual_seed(0)
+    bpd, z, nfe = likelihood_fn(score_model, data)
+    bpds.append(bpd)
+  assert nfe.shape == (2,)
+  assert torch.allclose(bpds[0], bpds[1], rtol=1e-3)
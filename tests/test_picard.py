@@ -0,0 +1,46 @@
+import pytest
+import torch
+import sde_lib
+from sampling import parallel, unconditional, predictors, correctors
+
+
+def em_sampler(sde, num_steps):
+  return unconditional.get_pc_sampler(sde, (3, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                      correctors.get_corrector('none'), 0., num_steps, 1, eps=1e-3)
+
+
+@pytest.mark.parametrize('window', [1, 4, 30])
+def test_zero_tolerance_equals_euler_maruyama(score_model, window):
+  sde = sde_lib.VPSDE(N=30)
+  expected, _ = em_sampler(sde, 30)(score_model, seeds=[1, 2, 3])
+  sampler = parallel.get_picard_sampler(sde, (3, 3, 8, 8), 30, window=window, tolerance=0.)
+  samples, info = sampler(score_model, seeds=[1, 2, 3])
+  assert torch.allclose(samples, expected, atol=1e-5)
+  #with a zero tolerance the window slides by one step per iteration
+  assert info['iterations'] == 30
+  assert info['steps'] == sum(min(window, 30 - k) for k in range(30))
+
+
+def test_tolerance_trades_iterations_for_accuracy(score_model):
+  sde = sde_lib.VPSDE(N=40)
+  expected, _ = em_sampler(sde, 40)(score_model, seeds=[1, 2, 3])
+  errors, iterations = [], []
+  for tolerance in [0.01, 0.5]:
+    samples, info = parallel.get_picard_sampler(sde, (3, 3, 8, 8), 40, window=8, tolerance=tolerance)(score_model, seeds=[1, 2, 3])
+    errors.append((samples - expected).abs().max().item())
+    iterations.append(info['iterations'])
+  assert iterations[1] < iterations[0] < 40
+  assert errors[0] < errors[1] < 0.5
+
+
+def test_model_calls_batch_the_window(score_model):
+  sizes = []
+  score_model.register_forward_hook(lambda module, inputs, output: sizes.append(inputs[0].size(0)))
+  _, info = parallel.get_picard_sampler(sde_lib.VPSDE(N=10), (3, 3, 8, 8), 10, window=4, tolerance=0.)(score_model)
+  assert sizes == [12] * 7 + [9, 6, 3]
+  assert len(sizes) == info['iterations']
+
+
+def test_checkpointing_is_refused(score_model):
+  with pytest.raises(ValueError):
+    parallel.get_picard_sampler(sde_lib.VPSDE(N=10), (3, 3, 8, 8), 10)(score_model, checkpoint=object())
@@ -0,0 +1,69 @@
+import torch
+import sde_lib
+from conftest import conditional_sde
+from sampling import conditional, unconditional, predictors, correctors, plan as plan_lib
+from sampling.plan import SamplingPlan, ConditionalSamplingPlan
+
+
+def count_score_fns(monkeypatch):
+  calls = []
+  get_score_fn = plan_lib.mutils.get_score_fn
+
+  def counting_get_score_fn(*args, **kwargs):
+    calls.append(1)
+    return get_score_fn(*args, **kwargs)
+  monkeypatch.setattr(plan_lib.mutils, 'get_score_fn', counting_get_score_fn)
+  return calls
+
+
+def test_samplers_build_the_score_fn_once(monkeypatch, score_model, conditional_score_model):
+  calls = count_score_fns(monkeypatch)
+  sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (2, 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                         correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3)
+  _, info = sampler(score_model)
+  assert info['steps'] == 40 and len(calls) == 1
+
+  calls.clear()
+  sampler = conditional.get_pc_conditional_sampler(conditional_sde(), (2, 3, 8, 8), predictors.get_predictor('conditional_reverse_diffusion'),
+                                                   correctors.get_corrector('conditional_langevin'), 0.15, 20, 1, eps=1e-5)
+  _, info = sampler(conditional_score_model, torch.rand(2, 3, 8, 8))
+  assert info['steps'] == 40 and len(calls) == 1
+
+
+def test_plan_tabulates_the_grid(score_model):
+  timesteps = torch.linspace(1., 1e-3, 20)
+  plan = SamplingPlan(sde_lib.VPSDE(N=20), score_model, predictors.get_predictor('euler_maruyama'), None, timesteps, 2, snr=0.15)
+  assert plan.num_steps == 20 and plan.vec_t.shape == (20, 2)
+  assert torch.equal(plan.vec_t[3], torch.full((2,), float(timesteps[3])))
+  assert torch.isclose(plan.step_coeffs[3]['dt'], timesteps[3] - timesteps[4])
+  #the steps go from T down to 0
+  assert torch.isclose(plan.coefficients['dt'].sum(), torch.tensor(1.))
+  assert isinstance(plan.corrector, correctors.NoneCorrector)
+
+
+def test_predictor_step_is_an_euler_maruyama_step(score_model):
+  sde, timesteps = sde_lib.VPSDE(N=20), torch.linspace(1., 1e-3, 20)
+  plan = SamplingPlan(sde, score_model, predictors.get_predictor('euler_maruyama'), None, timesteps, 2, snr=0.15)
+  x, i = torch.randn(2, 3, 8, 8), 5
+  torch.manual_seed(0)
+  x_next, x_mean = plan.predictor_step(i, x)
+  t, dt = timesteps[i], timesteps[i] - timesteps[i + 1]
+  beta = sde.beta_0 + t * (sde.beta_1 - sde.beta_0)
+  expected_mean = x + (0.5 * beta * x + beta * plan.score_fn(x, plan.vec_t[i])) * dt
+  assert torch.allclose(x_mean, expected_mean, atol=1e-5)
+  torch.manual_seed(0)
+  assert torch.allclose(x_next, expected_mean + torch.sqrt(beta * dt) * torch.randn_like(x), atol=1e-5)
+
+
+def test_conditional_plan_perturbs_y_with_the_kernel_of_y(conditional_score_model):
+  sde, timesteps = conditional_sde(), torch.linspace(1., 1e-5, 20)
+  plan = ConditionalSamplingPlan(sde, conditional_score_model, predictors.get_predictor('conditional_euler_maruyama'),
+                                 None, timesteps, 2, snr=0.15)
+  assert plan.diffuse_y
+  y = torch.rand(2, 3, 8, 8)
+  torch.manual_seed(0)
+  y_t, y_mean = plan.perturb_y(4, y)
+  std = sde['y'].sigma_min * (sde['y'].sigma_max / sde['y'].sigma_min) ** timesteps[4]
+  assert torch.equal(y_mean, y)
+  torch.manual_seed(0)
+  assert torch.allclose(y_t, y + std * torch.randn_like(y), atol=1e-6)
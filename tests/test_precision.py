@@ -0,0 +1,54 @@
+import pytest
+import torch
+from conftest import ScoreModel, make_config, conditional_sde
+from sampling import conditional, precision
+
+
+def test_dtypes():
+  assert precision.get_dtype('float32') is None and precision.get_dtype(None) is None
+  assert precision.get_dtype('bfloat16') == torch.bfloat16 and precision.get_dtype('float16') == torch.float16
+  with pytest.raises(ValueError):
+    precision.get_dtype('int8')
+
+
+@pytest.mark.parametrize('conditional_model', [False, True])
+def test_autocast_model_runs_the_network_in_bfloat16(conditional_model):
+  torch.manual_seed(0)
+  model = ScoreModel(conditional=conditional_model).eval()
+  dtypes = []
+  model.conv.register_forward_hook(lambda module, inputs, output: dtypes.append(output.dtype))
+  wrapped = precision.AutocastScoreModel(model, torch.bfloat16)
+  x = torch.randn(2, 3, 8, 8)
+  x = {'x': x, 'y': torch.rand(2, 3, 8, 8)} if conditional_model else x
+  with torch.no_grad():
+    output, reference = wrapped(x, torch.ones(2)), model(x, torch.ones(2))
+  assert dtypes == [torch.bfloat16, torch.float32]
+  outputs = output.values() if conditional_model else [output]
+  references = reference.values() if conditional_model else [reference]
+  for value, expected in zip(outputs, references):
+    #the output is cast back to float32, with the error of the bfloat16 convolution
+    assert value.dtype == torch.float32
+    assert 0. < (value - expected).abs().max() < 0.05
+  #the attributes of the wrapped model
+  assert wrapped.embedding_type == 'positional' and wrapped.device == model.device
+
+
+def test_sampling_fn_with_precision(conditional_score_model):
+  y = torch.rand(2, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+  samples = {}
+  for name in ['float32', 'bfloat16']:
+    sampling_fn = conditional.get_conditional_sampling_fn(make_config(precision=name), conditional_sde(), [2, 3, 8, 8], eps=1e-5)
+    samples[name] = sampling_fn(conditional_score_model, y, seeds=[1, 2])[0]
+  assert samples['bfloat16'].dtype == torch.float32
+  drift = (samples['bfloat16'] - samples['float32']).abs()
+  assert 0. < drift.max() and drift.mean() < 0.05 * samples['float32'].abs().mean()
+
+
+def test_float32_keeps_the_sampling_fn():
+  sampling_fn = lambda model, y: model
+  assert precision.with_precision(sampling_fn, 'float32') is sampling_fn
+  #one wrapper per model for all the calls of the sampling function
+  wrapped_fn = precision.with_precision(sampling_fn, 'bfloat16')
+  model = ScoreModel()
+  assert wrapped_fn(model, None) is wrapped_fn(model, None)
+  assert isinstance(wrapped_fn(model, None), precision.AutocastScoreModel)
@@ -0,0 +1,72 @@
+import pytest
+import torch
+import sde_lib
+from conftest import conditional_sde
+from sampling import conditional, unconditional, predictors, correctors, rng
+
+
+def test_mix_seed():
+  assert rng.mix_seed(1, 2, 3) == rng.mix_seed(1, 2, 3)
+  assert len({rng.mix_seed(1, 2, 3), rng.mix_seed(1, 3, 2), rng.mix_seed(2, 1, 3), rng.mix_seed(1, 2)}) == 4
+  assert 0 <= rng.mix_seed(-1, 2 ** 70) < 2 ** 63
+  assert rng.sample_seeds(0, [4, 5], 7) == [rng.mix_seed(0, 4, 7), rng.mix_seed(0, 5, 7)]
+
+
+def test_streams_do_not_depend_on_the_batch():
+  x = torch.zeros(3, 2, 4)
+  batch = rng.SampleNoise([10, 11, 12])
+  single = rng.SampleNoise([11])
+  for _ in range(3):
+    assert torch.equal(batch.randn_like(x)[1:2], single.randn_like(x[:1]))
+  assert batch.counter == 3
+  #the k-th draw of a stream is seeded by (seed, k)
+  generator = torch.Generator().manual_seed(rng.mix_seed(12, 3))
+  assert torch.equal(batch.randn_like(x)[2], torch.randn(2, 4, generator=generator))
+
+
+def test_draws_into_out():
+  x, out = torch.zeros(2, 5), torch.empty(2, 5)
+  noise = rng.SampleNoise([1, 2]).randn_like(x, out=out)
+  assert noise is out
+  assert torch.equal(out, rng.SampleNoise([1, 2]).randn_like(x))
+  with pytest.raises(ValueError):
+    rng.SampleNoise([1, 2, 3]).randn_like(x)
+
+
+def test_prior_sampling_restores_the_global_rng():
+  sde = sde_lib.VESDE(sigma_max=10., N=20)
+  torch.manual_seed(0)
+  prior = rng.SampleNoise([5, 6]).prior_sampling(sde, [2, 3, 4])
+  after = torch.rand(3)
+  torch.manual_seed(0)
+  assert torch.equal(after, torch.rand(3))
+  assert prior.shape == (2, 3, 4)
+  assert torch.equal(prior[1:], rng.SampleNoise([6]).prior_sampling(sde, [1, 3, 4]))
+  #without seeds, the global RNG
+  torch.manual_seed(1)
+  prior = rng.prior_sampling(sde, [2, 3])
+  torch.manual_seed(1)
+  assert torch.equal(prior, sde.prior_sampling([2, 3]))
+
+
+def test_unconditional_samples_do_not_depend_on_the_batch(score_model):
+  def sample(seeds):
+    sampler = unconditional.get_pc_sampler(sde_lib.VPSDE(N=20), (len(seeds), 3, 8, 8), predictors.get_predictor('euler_maruyama'),
+                                           correctors.get_corrector('langevin'), 0.15, 20, 1, eps=1e-3)
+    torch.manual_seed(len(seeds))
+    return sampler(score_model, seeds=seeds)[0]
+  batch = sample([3, 4, 5])
+  assert torch.allclose(batch[1:2], sample([4]), atol=1e-6)
+  assert torch.allclose(batch[::2], sample([3, 5]), atol=1e-6)
+  assert not torch.allclose(batch[0], batch[1])
+
+
+def test_conditional_samples_do_not_depend_on_the_batch(conditional_score_model):
+  y = torch.rand(3, 3, 8, 8)
+
+  def sample(indices):
+    sampler = conditional.get_pc_conditional_sampler(conditional_sde(10), (len(indices), 3, 8, 8), predictors.get_predictor('conditional_reverse_diffusion'),
+                                                     correctors.get_corrector('conditional_langevin'), 0.15, 10, 1, eps=1e-5)
+    torch.manual_seed(len(indices))
+    return sampler(conditional_score_model, y[indices], seeds=[100 + i for i in indices])[0]
+  assert torch.allclose(sample([0, 1, 2])[2:], sample([2]), atol=1e-6)
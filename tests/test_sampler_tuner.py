@@ -0,0 +1,64 @@
+import ml_collections
+import pytest
+import torch
+from conftest import make_config, conditional_sde
+from sampling import conditional, predictors, correctors, schedules
+
+pytest.importorskip('pytorch_lightning')
+import sampler_tuner
+
+
+def get_settings(**eval_settings):
+  config = make_config()
+  config.eval.update(eval_settings)
+  return sampler_tuner.get_tuner_settings(config)
+
+
+def test_candidates():
+  settings = get_settings(tuner_predictors=['conditional_euler_maruyama'], tuner_schedules=['uniform', 'karras'],
+                          tuner_snrs=[0.1, 0.2], tuner_corrector_t_stars=[1., 0.5])
+  candidates = sampler_tuner.get_candidates(settings)
+  #without a corrector the snr and the corrector schedule do not matter
+  assert len(candidates) == 2 * (1 + 2 * 2)
+  settings['max_trials'] = 4
+  assert len(sampler_tuner.get_candidates(settings)) == 4
+
+
+@pytest.mark.parametrize('corrector, t_star', [('conditional_none', None), ('conditional_langevin', 1.), ('conditional_langevin', 0.5)])
+def test_count_nfe_is_the_nfe_of_the_sampler(conditional_score_model, corrector, t_star):
+  sde = conditional_sde()
+  candidate = {'predictor': 'conditional_euler_maruyama', 'corrector': corrector, 'snr': 0.15,
+               'schedule': 'karras', 'corrector_t_star': t_star}
+  calls = []
+  conditional_score_model.register_forward_hook(lambda module, inputs, output: calls.append(1))
+  sampler = conditional.get_pc_conditional_sampler(sde, (2, 3, 8, 8), predictors.get_predictor(candidate['predictor']),
+                                                   correctors.get_corrector(corrector), 0.15, 12, 1, eps=1e-5, schedule='karras',
+                                                   corrector_schedule=sampler_tuner.get_corrector_schedule(candidate, sde['x']))
+  _, info = sampler(conditional_score_model, torch.rand(2, 3, 8, 8))
+  nfe = sampler_tuner.count_nfe(sde['x'], 1e-5, candidate, 12, 1, 'karras')
+  assert nfe == info['steps'] == len(calls)
+
+
+def test_fit_p_steps():
+  sde = conditional_sde()['x']
+  candidate = {'predictor': 'conditional_euler_maruyama', 'corrector': 'conditional_langevin', 'snr': 0.15,
+               'schedule': 'uniform', 'corrector_t_star': 0.5}
+  p_steps = sampler_tuner.fit_p_steps(sde, 1e-5, candidate, 1, 'uniform', 100)
+  assert sampler_tuner.count_nfe(sde, 1e-5, candidate, p_steps, 1, 'uniform') <= 100
+  assert sampler_tuner.count_nfe(sde, 1e-5, candidate, p_steps + 1, 1, 'uniform') > 100
+  assert sampler_tuner.fit_p_steps(sde, 1e-5, candidate, 1, 'uniform', 2) is None
+
+
+def test_eval_block_reproduces_the_candidate():
+  sde = conditional_sde()['x']
+  best = {'predictor': 'conditional_reverse_diffusion', 'corrector': 'conditional_langevin', 'snr': 0.2, 'schedule': 'karras',
+          'corrector_t_star': 0.5, 'p_steps': 40, 'nfe': 60, 'metrics': {'lpips': 0.1}}
+  settings = get_settings()
+  evaluate = ml_collections.ConfigDict()
+  exec(sampler_tuner.format_eval_block(best, sde, settings, 1, True).replace('\n  ', '\n').strip())
+  assert evaluate.p_steps == 40 and evaluate.snr == [0.2] and evaluate.schedule == 'karras'
+  config = make_config()
+  config.eval = evaluate
+  timesteps = schedules.get_timesteps(sde, 40, 1e-5, 'karras')
+  assert schedules.get_corrector_budget(schedules.get_corrector_schedule_fn(config), timesteps) == \
+         schedules.get_corrector_budget(sampler_tuner.get_corrector_schedule(best, sde), timesteps)
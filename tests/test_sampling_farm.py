@@ -0,0 +1,61 @@
+import os
+import pytest
+import torch
+from conftest import ScoreModel, make_config, conditional_sde
+from sampling.conditional import get_conditional_sampling_fn
+
+pytest.importorskip('pytorch_lightning')
+pytest.importorskip('torchvision')
+import sampling_farm
+
+
+class ConditionalModule(torch.nn.Module):
+  """The sampling interface of the conditional lightning modules around a small score model."""
+
+  def __init__(self):
+    super().__init__()
+    torch.manual_seed(0)
+    self.score_model = ScoreModel(conditional=True).eval()
+    self.config = make_config()
+    self.sde = conditional_sde(N=10)
+
+  def sample(self, y, snr='default', seeds=None):
+    if snr < 0:
+      raise ValueError('Negative snr.')
+    sampling_fn = get_conditional_sampling_fn(self.config, self.sde, [y.size(0), 3, 8, 8], 1e-5, snr=snr)
+    return sampling_fn(self.score_model, y, seeds=seeds)
+
+
+def test_core_groups(monkeypatch):
+  monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3, 4, 5, 6, 7})
+  assert sampling_farm.get_core_groups() == [[k] for k in range(8)]
+  assert sampling_farm.get_core_groups(num_workers=3) == [[0, 1], [2, 3], [4, 5]]
+  assert sampling_farm.get_core_groups(threads_per_worker=3) == [[0, 1, 2], [3, 4, 5]]
+  #more workers times threads than cores: the groups wrap around
+  assert sampling_farm.get_core_groups(num_workers=3, threads_per_worker=4) == [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]]
+  assert sampling_farm.get_core_groups(num_workers=16) == [[k % 8] for k in range(16)]
+
+
+def test_farm_samples_equal_direct_samples():
+  module = ConditionalModule()
+  y = torch.rand(2, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+  tasks = {(snr, draw): [10 * draw + 1, 10 * draw + 2] for snr in [0.1, 0.2] for draw in [1, 2]}
+  results = {}
+  with sampling_farm.SamplingFarm(module, num_workers=2, threads_per_worker=1) as farm:
+    assert farm.num_workers == 2
+    for (snr, draw), seeds in tasks.items():
+      farm.submit((snr, draw), y, snr=snr, seeds=seeds)
+    while farm.pending:
+      key, samples, duration = farm.get()
+      results[key] = samples
+      assert duration > 0.
+  assert set(results) == set(tasks)
+  for (snr, draw), seeds in tasks.items():
+    assert torch.allclose(results[snr, draw], module.sample(y, snr=snr, seeds=seeds)[0], atol=1e-6)
+
+
+def test_failed_tasks_raise():
+  with sampling_farm.SamplingFarm(ConditionalModule(), num_workers=1) as farm:
+    farm.submit('task', torch.rand(1, 3, 8, 8), snr=-1.)
+    with pytest.raises(RuntimeError, match='Negative snr'):
+      farm.get()
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+import sde_lib
+from conftest import make_config
+from sampling import schedules
+
+
+def stds(sde, timesteps):
+  return sde.marginal_prob(torch.ones_like(timesteps, dtype=torch.float64), timesteps.double())[1]
+
+
+@pytest.mark.parametrize('name', ['uniform', 'quadratic', 'karras', 'log_sigma'])
+def test_grids_go_from_T_to_eps(name):
+  sde = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000)
+  timesteps = schedules.get_timesteps(sde, 50, 1e-5, name)
+  assert timesteps.shape == (50,) and timesteps.dtype == torch.float32
+  assert timesteps[0] == 1. and torch.isclose(timesteps[-1], torch.tensor(1e-5))
+  assert torch.all(timesteps[1:] < timesteps[:-1])
+
+
+def test_quadratic():
+  timesteps = schedules.get_timesteps(sde_lib.VPSDE(), 5, 1e-3, 'quadratic')
+  u = torch.tensor([1., 0.75, 0.5, 0.25, 0.])
+  assert torch.allclose(timesteps, 1e-3 + (1 - 1e-3) * u ** 2)
+
+
+def test_log_sigma_is_log_uniform():
+  sde = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000)
+  log_stds = torch.log(stds(sde, schedules.get_timesteps(sde, 20, 1e-5, 'log_sigma')))
+  steps = log_stds[:-1] - log_stds[1:]
+  assert torch.allclose(steps, steps.mean().expand(19), rtol=1e-3)
+  #for the VE SDE log sigma(t) is linear in t: the grid is uniform
+  assert torch.allclose(schedules.get_timesteps(sde, 20, 1e-5, 'log_sigma'), schedules.get_timesteps(sde, 20, 1e-5), atol=1e-4)
+
+
+@pytest.mark.parametrize('rho', [1., 7.])
+def test_karras(rho):
+  sde = sde_lib.VPSDE()
+  schedule = schedules.get_schedule_fn(make_config(schedule='karras', schedule_rho=rho))
+  roots = stds(sde, schedules.get_timesteps(sde, 30, 1e-3, schedule)) ** (1 / rho)
+  steps = roots[:-1] - roots[1:]
+  assert torch.allclose(steps, steps.mean().expand(29), rtol=1e-2)
+
+
+def test_file_schedule(tmp_path):
+  path = str(tmp_path / 'times.npy')
+  np.save(path, np.array([1., 0.4, 0.1, 1e-3]))
+  schedule = schedules.get_schedule_fn(make_config(schedule='file', schedule_file=path))
+  assert torch.allclose(schedules.get_timesteps(sde_lib.VPSDE(), 100, 1e-3, schedule), torch.tensor([1., 0.4, 0.1, 1e-3]))
+  np.save(path, np.array([1., 0.4, 0.5]))
+  with pytest.raises(ValueError, match='decreasing'):
+    schedules.get_timesteps(sde_lib.VPSDE(), 100, 1e-3, schedule)
+
+
+def test_start_at():
+  timesteps = schedules.start_at(torch.linspace(1., 0., 11), 0.45)
+  assert torch.allclose(timesteps, torch.tensor([0.45, 0.4, 0.3, 0.2, 0.1, 0.]))
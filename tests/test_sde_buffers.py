@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+import sde_lib
+
+META = torch.device('meta')
+
+
+@pytest.mark.parametrize('sde_class', [sde_lib.VESDE, sde_lib.VPSDE, sde_lib.cVESDE, sde_lib.cVPSDE])
+def test_get_buffer_moves_all_schedules_once(sde_class):
+  sde = sde_class(N=10)
+  assert sde.to(torch.device('cpu')) is sde
+  names = sde._buffer_names
+  assert len(names) >= 3
+  moved = sde.get_buffer(names[0], META)
+  assert all(getattr(sde, name).device == META for name in names)
+  #the next steps reuse the moved schedules
+  assert sde.get_buffer(names[0], META) is moved
+
+
+def test_ve_discretization_tables():
+  sde = sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=10)
+  sigmas = np.exp(np.linspace(np.log(0.01), np.log(50), 10))
+  t = torch.tensor([0., 4 / 9, 1.])
+  _, G = sde.discretize(torch.zeros(3, 2), t)
+  expected = [sigmas[0], np.sqrt(sigmas[4] ** 2 - sigmas[3] ** 2), np.sqrt(sigmas[9] ** 2 - sigmas[8] ** 2)]
+  assert np.allclose(G.numpy(), expected, rtol=1e-5)
+
+
+def test_vp_discretization_tables():
+  sde = sde_lib.VPSDE(beta_min=0.1, beta_max=20, N=10)
+  betas = np.linspace(0.01, 2., 10)
+  t = torch.tensor([0., 1 / 9])
+  x = torch.ones(2, 3)
+  f, G = sde.discretize(x, t)
+  assert np.allclose(G.numpy(), np.sqrt(betas[:2]))
+  assert np.allclose(f[:, 0].numpy(), np.sqrt(1. - betas[:2]) - 1.)
+
+
+def test_step_coefficients_follow_the_device_of_the_grid():
+  sde = sde_lib.VPSDE(N=10)
+  coeffs = sde.get_step_coefficients(torch.linspace(1., 1e-3, 5, device=META))
+  assert all(value.device == META for value in coeffs.values())
+  assert set(coeffs) >= {'t', 'dt', 'G', 'f_coeff', 'alpha', 'sqrt_alpha', 'beta'}
@@ -0,0 +1,52 @@
+import torch
+from conftest import conditional_sde
+from sampling import conditional, predictors, correctors, rng
+
+
+def test_snr_groups():
+  assert correctors.get_snr_groups(0.15) is None
+  assert correctors.get_snr_groups(torch.tensor(0.15)) is None
+  assert torch.equal(correctors.get_snr_groups(torch.tensor([0.2, 0.1, 0.2, 0.3])), torch.tensor([1, 0, 1, 2]))
+
+
+def test_batch_norm_means():
+  grad = torch.tensor([[3., 4.], [0., 1.], [6., 8.], [0., 3.]])
+  noise = torch.tensor([[1., 0.], [0., 2.], [0., 3.], [4., 0.]])
+  grad_norm, noise_norm = correctors.batch_norm_means(grad, noise)
+  assert grad_norm.item() == 4.75 and noise_norm.item() == 2.5
+  grad_norm, noise_norm = correctors.batch_norm_means(grad, noise, torch.tensor([0, 1, 0, 1]))
+  assert torch.equal(grad_norm, torch.tensor([7.5, 2., 7.5, 2.]))
+  assert torch.equal(noise_norm, torch.tensor([2., 3., 2., 3.]))
+
+
+def test_corrector_with_a_batch_of_snrs_equals_separate_runs():
+  sde = conditional_sde()['x']
+  score_fn = lambda x, y, t: -(x - 0.5 * y) / (1. + t[:, None, None, None] ** 2)
+  torch.manual_seed(0)
+  x, y = torch.randn(6, 3, 8, 8), torch.rand(6, 3, 8, 8)
+  t = torch.full((6,), 0.5)
+
+  def correct(snr, samples):
+    corrector = correctors.get_corrector('conditional_langevin')(sde, score_fn, snr, 2)
+    #the same noise for a sample in the batch and in the separate runs
+    corrector.noise = rng.SampleNoise([10 + k for k in samples])
+    return corrector.update_fn(x[samples], y[samples], t[samples])[0]
+  batch = correct(torch.tensor([0.1, 0.1, 0.1, 0.2, 0.2, 0.2]), list(range(6)))
+  assert torch.allclose(batch[:3], correct(0.1, [0, 1, 2]), atol=1e-6)
+  assert torch.allclose(batch[3:], correct(0.2, [3, 4, 5]), atol=1e-6)
+  #the step sizes of an snr group do not depend on the other groups
+  assert torch.allclose(batch[3:], correct(torch.tensor([0.1, 0.1, 0.2, 0.2, 0.2]), [0, 2, 3, 4, 5])[2:], atol=1e-6)
+
+
+def test_sampler_with_a_batch_of_snrs(conditional_score_model):
+  def sample(snr, y, seeds):
+    sampler = conditional.get_pc_conditional_sampler(conditional_sde(), (len(seeds), 3, 8, 8),
+                                                     predictors.get_predictor('conditional_reverse_diffusion'),
+                                                     correctors.get_corrector('conditional_langevin'), snr, 20, 1, eps=1e-5)
+    return sampler(conditional_score_model, y, seeds=seeds)[0]
+  y = torch.rand(2, 3, 8, 8, generator=torch.Generator().manual_seed(0))
+  batch = sample(torch.tensor([0.1, 0.1, 0.3, 0.3]), y.repeat(2, 1, 1, 1), [1, 2, 3, 4])
+  assert torch.allclose(batch[:2], sample(0.1, y, [1, 2]), atol=1e-5)
+  assert torch.allclose(batch[2:], sample(0.3, y, [3, 4]), atol=1e-5)
+  #the snr changes the samples
+  assert not torch.allclose(batch[2:], sample(0.1, y, [3, 4]), atol=1e-3)
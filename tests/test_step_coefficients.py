@@ -0,0 +1,56 @@
+import pytest
+import torch
+import sde_lib
+from sampling.schedules import get_timesteps
+
+SDES = {'ve': lambda: sde_lib.VESDE(sigma_min=0.01, sigma_max=50, N=1000),
+        'cve': lambda: sde_lib.cVESDE(sigma_min=0.01, sigma_max=50, N=1000),
+        'vp': lambda: sde_lib.VPSDE(beta_min=0.1, beta_max=20, N=1000),
+        'cvp': lambda: sde_lib.cVPSDE(beta_min=0.1, beta_max=20, N=1000)}
+
+
+@pytest.mark.parametrize('name', SDES)
+@pytest.mark.parametrize('schedule, num_steps', [('uniform', 1000), ('uniform', 2000), ('uniform', 100),
+                                                 ('quadratic', 1000), ('karras', 1000), ('log_sigma', 1000)])
+def test_every_step_moves(name, schedule, num_steps):
+  sde = SDES[name]()
+  eps = 1e-5 if name in ['ve', 'cve'] else 1e-3
+  timesteps = get_timesteps(sde, num_steps, eps, schedule)
+  coeffs = sde.get_step_coefficients(timesteps)
+  assert torch.all(torch.isfinite(coeffs['G']))
+  assert torch.all(coeffs['G'] > 0)
+
+
+@pytest.mark.parametrize('name', ['ve', 'cve'])
+def test_ve_steps_telescope(name):
+  #the variances of the steps add up to the variance of the first noise level
+  sde = SDES[name]()
+  coeffs = sde.get_step_coefficients(get_timesteps(sde, 2000, 1e-5, 'karras'))
+  total = torch.sum(coeffs['G'].double() ** 2)
+  assert torch.isclose(total, coeffs['sigma'][0].double() ** 2, rtol=1e-4)
+
+
+def test_ve_first_and_last_coefficients():
+  #reverse diffusion between the continuous noise levels sigma(t) of the grid, the last step from eps to 0
+  sde = SDES['ve']()
+  timesteps = get_timesteps(sde, 1000, 1e-5)
+  coeffs = sde.get_step_coefficients(timesteps)
+  sigma = lambda t: 0.01 * (50 / 0.01) ** t
+  assert torch.isclose(coeffs['G'][0], torch.sqrt(sigma(timesteps[0]) ** 2 - sigma(timesteps[1]) ** 2))
+  assert torch.isclose(coeffs['G'][-1], sigma(timesteps[-1]))
+  assert torch.allclose(coeffs['G'][[0, -1]], torch.tensor([6.5013146, 0.010000852]))
+  assert torch.allclose(coeffs['dt'][[0, -1]], torch.tensor([1.001001e-3, 1e-5]))
+  assert torch.all(coeffs['f_coeff'] == 0)
+
+
+def test_vp_first_and_last_coefficients():
+  #DDPM step from the continuous alpha_bar(t) of the grid times, the last step from eps to 0
+  sde = SDES['vp']()
+  timesteps = get_timesteps(sde, 1000, 1e-3)
+  coeffs = sde.get_step_coefficients(timesteps)
+  mean_coeff = sde.marginal_prob(torch.ones_like(timesteps), timesteps)[0]
+  assert torch.isclose(coeffs['f_coeff'][0], mean_coeff[0] / mean_coeff[1] - 1.)
+  assert torch.isclose(coeffs['G'][-1], torch.sqrt(1. - mean_coeff[-1] ** 2), rtol=1e-4)
+  assert torch.allclose(coeffs['G'][[0, -1]], torch.tensor([0.14068241, 0.010483843]))
+  assert torch.allclose(coeffs['f_coeff'][[0, -1]], torch.tensor([-9.9452138e-3, -5.4955482e-5]))
+  assert torch.allclose(coeffs['dt'][[0, -1]], torch.tensor([0.99998713e-3, 1e-3]))
@@ -0,0 +1,73 @@
+import pytest
+import torch
+from conftest import make_config, conditional_sde
+from sampling import conditional, tiling
+
+
+class PointwiseScoreModel(torch.nn.Module):
+  """A conditional score model of images whose output at a pixel only depends on the input at that pixel."""
+
+  def __init__(self):
+    super().__init__()
+    self.conv = torch.nn.Conv2d(6, 6, 1)
+    self.embedding_type = 'positional'
+
+  @property
+  def device(self):
+    return next(self.parameters()).device
+
+  def forward(self, x, labels):
+    out = torch.tanh(self.conv(torch.cat([x['x'], x['y']], 1))) - 0.1 * x['x'].repeat(1, 2, 1, 1)
+    return {'x': out[:, :3], 'y': out[:, 3:]}
+
+
+def image_score_fn(x, y, t):
+  return -x * (1. + t[:, None, None, None]) + torch.cos(y)
+
+
+@pytest.mark.parametrize('kwargs', [{'tile_size': 8}, {'tile_size': (8, 6), 'overlap': (3, 1)},
+                                    {'tile_size': 5, 'stride': 3, 'batch_size': 7}])
+def test_tiled_score_of_images_is_the_untiled_score(kwargs):
+  torch.manual_seed(0)
+  x, y = torch.randn(2, 3, 19, 14), torch.rand(2, 3, 19, 14)
+  t = torch.tensor([0.2, 0.9])
+  assert torch.allclose(tiling.TiledScoreFn(image_score_fn, **kwargs)(x, y, t), image_score_fn(x, y, t), atol=1e-6)
+
+
+def test_tile_batch_size_bounds_the_forward_passes():
+  sizes = []
+  def score_fn(x, y, t):
+    sizes.append(x.size(0))
+    return image_score_fn(x, y, t)
+  tiled_score_fn = tiling.TiledScoreFn(score_fn, tile_size=8, overlap=2, batch_size=5)
+  tiled_score_fn(torch.randn(2, 3, 20, 14), torch.rand(2, 3, 20, 14), torch.ones(2))
+  #3 x 2 tiles of the 2 samples, 2 tiles per pass
+  assert sizes == [4, 4, 4]
+  with pytest.raises(ValueError):
+    tiled_score_fn(torch.randn(2, 3, 20, 14), torch.rand(2, 3, 10, 7), torch.ones(2))
+
+
+def test_tiling_fn_from_config():
+  config = make_config()
+  assert tiling.get_tiling_fn(config) is None
+  config = make_config(tile_size=8, tile_stride=6, tile_batch_size=16)
+  tiled_score_fn = tiling.get_tiling_fn(config)(image_score_fn)
+  regions, _, normalization = tiled_score_fn.get_grid((20, 14), 'cpu')
+  assert tiled_score_fn.batch_size == 16
+  assert [(region[0].start, region[1].start) for region in regions] == [(0, 0), (0, 6), (6, 0), (6, 6), (12, 0), (12, 6)]
+  #the windows of two tiles add up to 1 over their overlap of 2, they only fall off at the borders of the image
+  assert torch.allclose(normalization[2:-2, 2:-2], torch.ones(16, 10)) and torch.all(normalization[0] < 1.)
+
+
+def test_tiled_sampling_of_large_images_matches_untiled():
+  torch.manual_seed(0)
+  model = PointwiseScoreModel().eval()
+  y = torch.rand(2, 3, 16, 12)
+  samples = []
+  for tile_size in [None, 8]:
+    config = make_config(tile_size=tile_size, tile_overlap=2)
+    #the diffused condition and the noise of every sample come from its own stream
+    sampling_fn = conditional.get_conditional_sampling_fn(config, conditional_sde(), [2, 3, 16, 12], eps=1e-5)
+    samples.append(sampling_fn(model, y, seeds=[3, 4])[0])
+  assert samples[1].shape == (2, 3, 16, 12)
+  assert torch.allclose(samples[0], samples[1], atol=1e-4)
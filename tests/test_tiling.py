@@ -0,0 +1,76 @@
+import pytest
+import torch
+import sde_lib
+from conftest import make_config
+from sampling import conditional, tiling
+
+
+def pointwise_score_fn(x, y, t):
+  #a position-independent score: the tiles see the same function as the whole input
+  return -x + 0.3 * y * t[(...,) + (None,) * len(x.shape[1:])] + torch.sin(x * y)
+
+
+class PointwiseSR3Model(torch.nn.Module):
+  """An SR3 score model of volumes whose output at a voxel only depends on the input at that voxel."""
+
+  def __init__(self):
+    super().__init__()
+    self.conv = torch.nn.Conv3d(2, 1, 1)
+    self.embedding_type = 'positional'
+
+  @property
+  def device(self):
+    return next(self.parameters()).device
+
+  def forward(self, x, labels):
+    return torch.tanh(self.conv(torch.cat([x['x'], x['y']], 1)))
+
+
+def test_tile_starts_shift_the_last_tile():
+  assert tiling.tile_starts(13, 6, 2) == [0, 4, 7]
+  assert tiling.tile_starts(16, 6, 2) == [0, 4, 8, 10]
+  assert tiling.tile_starts(5, 6, 2) == [0]
+
+
+def test_blending_window():
+  window = tiling.blending_window((6,), (2,))
+  assert torch.all(window > 0)
+  assert torch.equal(window[2:4], torch.ones(2))
+  #the rise of a tile and the fall of its neighbour add up to 1 over the overlap
+  assert torch.allclose(window[:2] + window[-2:], torch.ones(2))
+
+
+@pytest.mark.parametrize('spatial_shape, kwargs', [((13, 10, 7), {'tile_size': 6, 'overlap': 2}),
+                                                   ((13, 10, 7), {'tile_size': (6, 4, 5), 'stride': (4, 3, 2)}),
+                                                   ((9, 9, 9), {'tile_size': 4, 'batch_size': 5}),
+                                                   ((8, 8, 8), {'tile_size': 8})])
+def test_tiled_score_of_volumes_is_the_untiled_score(spatial_shape, kwargs):
+  torch.manual_seed(0)
+  x, y = torch.randn(2, 1, *spatial_shape), torch.randn(2, 1, *spatial_shape)
+  t = torch.tensor([0.3, 0.7])
+  tiled_score_fn = tiling.TiledScoreFn(pointwise_score_fn, **kwargs)
+  assert torch.allclose(tiled_score_fn(x, y, t), pointwise_score_fn(x, y, t), atol=1e-6)
+
+
+def test_tiled_score_covers_every_voxel_once_normalised():
+  regions, window, normalization = tiling.TiledScoreFn(pointwise_score_fn, tile_size=6, overlap=2).get_grid((13, 10, 7), 'cpu')
+  assert len(regions) == 3 * 2 * 2
+  assert torch.all(normalization > 0)
+
+
+def test_tiled_volume_sampling_matches_untiled():
+  #the sliding-window path of the DUAL-GLOW config, which has no data.task
+  config = make_config(predictor='conditional_euler_maruyama', corrector='conditional_none')
+  config.training.sde = 'vpsde'
+  config.data.shape_x = [1, 10, 9, 7]
+  sde = sde_lib.cVPSDE(N=20)
+  torch.manual_seed(0)
+  model = PointwiseSR3Model().eval()
+  y = torch.rand(2, 1, 10, 9, 7)
+  samples = []
+  for tile_size in [None, 4]:
+    config.sampling.tile_size = tile_size
+    sampling_fn = conditional.get_conditional_sampling_fn(config, sde, [2, 1, 10, 9, 7], eps=1e-3)
+    torch.manual_seed(1)
+    samples.append(sampling_fn(model, y)[0])
+  assert torch.allclose(samples[0], samples[1], atol=1e-5)
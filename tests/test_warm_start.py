@@ -0,0 +1,52 @@
+import pytest
+import torch
+from conftest import make_config, conditional_sde
+from sampling import conditional, warm_start
+
+
+def sample(config, model, y, seed=1):
+  sampling_fn = conditional.get_conditional_sampling_fn(config, conditional_sde(), [y.size(0), 3, 8, 8], eps=1e-5)
+  torch.manual_seed(seed)
+  return sampling_fn(model, y)
+
+
+def test_config_without_task_samples_without_warm_start(conditional_score_model):
+  y = torch.rand(2, 3, 8, 8)
+  config = make_config()
+  assert 'task' not in config.data
+  samples, info = sample(config, conditional_score_model, y)
+  assert info['steps'] == 40
+  #the task only selects the initial estimate of the warm start
+  config.data.task = 'super-resolution'
+  reference, _ = sample(config, conditional_score_model, y)
+  assert torch.equal(samples, reference)
+
+
+def test_warm_start_truncates_the_grid(conditional_score_model):
+  y = torch.rand(2, 3, 8, 8)
+  config = make_config(warm_start_t0=0.5)
+  config.data.task = 'inpainting'
+  _, info = sample(config, conditional_score_model, y)
+  #the times of the uniform grid of 20 steps from 1 to 1e-5 below 0.5, one corrector update each
+  num_steps = int((torch.linspace(1, 1e-5, 20) <= 0.5).sum())
+  assert info['steps'] == 2 * num_steps
+
+
+def test_warm_start_without_task_raises(conditional_score_model):
+  with pytest.raises(ValueError, match='data.task'):
+    sample(make_config(warm_start_t0=0.5), conditional_score_model, torch.rand(2, 3, 8, 8))
+
+
+def test_initial_estimates():
+  y = torch.arange(16.).reshape(1, 1, 4, 4)
+  config = make_config()
+  config.data.task = 'super-resolution'
+  config.data.scale = 2
+  estimate = warm_start.get_initial_estimate_fn(config)(torch.ones(1, 1, 2, 2), [1, 1, 4, 4])
+  assert torch.allclose(estimate, torch.ones(1, 1, 4, 4))
+  #a condition at the high resolution is averaged over the blocks of the scale first
+  blocks = torch.nn.functional.avg_pool2d(y, 2)
+  assert torch.allclose(warm_start.bicubic_upsampling(y, [1, 1, 4, 4], scale=2),
+                        torch.nn.functional.interpolate(blocks, size=(4, 4), mode='bicubic', align_corners=False))
+  config.data.task = 'inpainting'
+  assert torch.equal(warm_start.get_initial_estimate_fn(config)(y, [1, 1, 4, 4]), y)